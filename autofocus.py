@@ -0,0 +1,128 @@
+import math
+import time
+from io import BytesIO
+
+# off: every well at its planned Z (and its z-stack)
+# hill_climb: step from the planned Z towards sharper frames until one gets worse; few frames when the prediction is close
+# golden: golden-section search over the whole range; a fixed, small number of frames however far off the prediction is
+AUTOFOCUS_MODES = ("off", "hill_climb", "golden")
+# numpy is imported where frames are scored, so the GUI can list the modes without loading it at startup
+
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+def focus_score(luma):
+    import numpy as np
+
+    # Variance of the Laplacian: sharp edges give large second derivatives, blur flattens them
+    image = np.asarray(luma, dtype=np.float32)
+    laplacian = (image[1:-1, :-2] + image[1:-1, 2:] + image[:-2, 1:-1] + image[2:, 1:-1]) - 4 * image[1:-1, 1:-1]
+    return float(laplacian.var())
+
+class FocusFrames:
+    # Small greyscale frames for scoring, resized on the GPU and taken from a splitter port of their own,
+    # so a video-port capture encoder (or the preview) on the other ports is left alone
+    def __init__(self, camera, size=(320, 240), settle_frames=1, splitter_port=2):
+        # YUV frames are padded to 32 x 16 blocks; sizes that already fit leave nothing to crop
+        self.size = (int(size[0]) // 32 * 32 or 32, int(size[1]) // 16 * 16 or 16)
+        self.camera = camera
+        self.settle_frames = int(settle_frames)
+        self.frame_time = 1 / float(camera.framerate)
+        self.splitter_port = splitter_port
+        self.stage = BytesIO()
+        self.frames = None
+
+    def grab(self):
+        import numpy as np
+
+        # Luma plane of the first frame exposed after the gantry stopped
+        if self.frames is None:
+            self.frames = self.camera.capture_continuous(self.stage, format="yuv", use_video_port=True,
+                                                         resize=self.size, splitter_port=self.splitter_port)
+        if self.settle_frames > 0:
+            time.sleep(self.frame_time * self.settle_frames)
+        self.stage.seek(0)
+        self.stage.truncate()
+        next(self.frames)
+        width, height = self.size
+        return np.frombuffer(self.stage.getbuffer(), dtype=np.uint8, count=width * height).reshape(height, width)
+
+    def close(self):
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
+class FocusResult:
+    def __init__(self, z, score, samples, bracketed):
+        self.z = z                      # Best focus (mm)
+        self.score = score
+        self.samples = samples          # [(z, score)] in the order they were measured
+        self.bracketed = bracketed      # False when the best was at the edge of the range, so the peak may lie beyond it
+
+def _parabolic_peak(left, center, right):
+    # Vertex of the parabola through three equally spaced scores, in steps from the centre one (within +/- 0.5)
+    curvature = left - 2 * center + right
+    if curvature >= 0:
+        return 0.0
+    return min(0.5, max(-0.5, 0.5 * (left - right) / curvature))
+
+def hill_climb(measure, z0, step, max_steps):
+    # measure(z) moves there and returns the focus score; stops as soon as the peak has a worse frame either side
+    max_steps = max(1, int(max_steps))
+    scores = {}
+    order = []
+    def score(n):
+        if n not in scores:
+            scores[n] = measure(round(z0 + n * step, 3))
+            order.append(n)
+        return scores[n]
+
+    n = 0
+    direction = 1 if score(1) > score(0) else -1
+    if direction == 1:
+        n = 1
+    while abs(n + direction) <= max_steps and score(n + direction) > score(n):
+        n += direction
+    # Only a run into the end of the range stops the climb without a worse frame beyond the peak
+    bracketed = abs(n) < max_steps
+    offset = _parabolic_peak(scores[n - 1], scores[n], scores[n + 1]) if (n - 1) in scores and (n + 1) in scores else 0.0
+    samples = [(round(z0 + i * step, 3), scores[i]) for i in order]
+    return FocusResult(round(z0 + (n + offset) * step, 3), scores[n], samples, bracketed)
+
+def golden_section(measure, z0, step, max_steps):
+    # Narrows [z0 - range, z0 + range] by the golden ratio per frame until it is one step wide
+    low, high = z0 - max_steps * step, z0 + max_steps * step
+    samples = []
+    def score(z):
+        value = measure(round(z, 3))
+        samples.append((round(z, 3), value))
+        return value
+
+    c, d = high - GOLDEN * (high - low), low + GOLDEN * (high - low)
+    fc, fd = score(c), score(d)
+    while high - low > step:
+        if fc > fd:
+            high, d, fd = d, c, fc
+            c = high - GOLDEN * (high - low)
+            fc = score(c)
+        else:
+            low, c, fc = c, d, fd
+            d = low + GOLDEN * (high - low)
+            fd = score(d)
+    z, best = (c, fc) if fc > fd else (d, fd)
+    edge = z0 - max_steps * step + step, z0 + max_steps * step - step
+    return FocusResult(round(z, 3), best, samples, edge[0] < z < edge[1])
+
+def search(mode, measure, z0, step, max_steps):
+    if mode == "hill_climb":
+        return hill_climb(measure, z0, step, max_steps)
+    if mode == "golden":
+        return golden_section(measure, z0, step, max_steps)
+    raise ValueError(f"Unknown autofocus mode '{mode}', expected one of {', '.join(AUTOFOCUS_MODES)}")
+
+def expected_samples(mode, max_steps):
+    # Frames a search typically takes, for run time estimates
+    if mode == "off":
+        return 0
+    if mode == "golden":
+        return 2 + max(0, math.ceil(math.log(1 / (2 * max_steps)) / math.log(GOLDEN)))
+    return 4
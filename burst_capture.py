@@ -0,0 +1,61 @@
+import time
+from io import BytesIO
+
+CAPTURE_PORTS = ("still", "video")
+
+class VideoPortCapture:
+    # Takes frames from the running video port, so there is no still-port mode switch or AE/AWB re-settling per shot
+    # Has the camera's capture/capture_sequence/exposure_speed, so CaptureScheduler can use it in place of the camera
+    def __init__(self, camera, quality=85, settle_frames=1):
+        self.camera = camera
+        self.quality = int(quality)
+        self.settle_frames = int(settle_frames)
+        self.frame_time = 1 / float(camera.framerate)
+        self.stage = BytesIO()
+        self.frames = None
+
+    @property
+    def exposure_speed(self):
+        return self.camera.exposure_speed
+
+    def _settle(self):
+        # A frame that was already exposing while the gantry moved is blurred; let it pass before grabbing one
+        if self.settle_frames > 0:
+            time.sleep(self.frame_time * self.settle_frames)
+
+    def capture(self, output, **kwargs):
+        # One JPEG encoder stays attached to the video port for the whole run; each frame is staged and copied out
+        if self.frames is None:
+            self.frames = self.camera.capture_continuous(self.stage, format="jpeg", use_video_port=True, quality=self.quality)
+        self._settle()
+        self.stage.seek(0)
+        self.stage.truncate()
+        next(self.frames)
+        with self.stage.getbuffer() as data:
+            output.write(data)
+
+    def capture_sequence(self, outputs, **kwargs):
+        # Back-to-back frames at one position, as fast as the video port delivers them
+        # The port takes one encoder at a time, so a continuous capture left open has to go first
+        self.close()
+        self._settle()
+        self.camera.capture_sequence(outputs, format="jpeg", use_video_port=True, quality=self.quality)
+
+    def close(self):
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
+def capture_source(camera, port, quality=85, settle_frames=1):
+    # "still" keeps full-quality still-port captures; "video" trades some image quality for tens of ms per frame
+    if port not in CAPTURE_PORTS:
+        raise ValueError(f"Unknown capture port '{port}', expected one of {', '.join(CAPTURE_PORTS)}")
+    if port == "video":
+        return VideoPortCapture(camera, quality, settle_frames)
+    return camera
+
+def capture_overhead(port, framerate, settle_frames, still_overhead):
+    # Time per frame beyond the exposure, for run time estimates (s)
+    if port == "video":
+        return (settle_frames + 1) / float(framerate)
+    return float(still_overhead)
@@ -0,0 +1,78 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from config import config as cfg
+
+# Setting the key can change the listed properties behind our back, so they are set again next time
+RESETS = {"awb_mode": ("awb_gains",)}
+
+# Preview goes back to automatic exposure; a capture run sets its own values again when it starts
+PREVIEW_AUTO = {"iso": 0, "shutter_speed": 0, "exposure_mode": "auto", "awb_mode": "auto"}
+
+def preview_settings():
+    return {"resolution": (cfg.preview.width, cfg.preview.height), "rotation": int(cfg.rotation),
+            "framerate": float(cfg.preview_framerate), **PREVIEW_AUTO}
+
+class CameraSession:
+    # Owns one long-lived PiCamera; workers borrow it with use(), which also applies that worker's settings
+    def __init__(self, warmup=2.0, log=None):
+        self.warmup = float(warmup)     # Sensor settling after the camera is first opened (s)
+        self.log = log
+        self.lock = threading.Lock()
+        self.camera = None
+        self.applied = {}               # Last value set for each property, so unchanged ones are skipped
+        self.mode = None
+
+    def open(self):
+        if self.camera is None:
+            from picamera import PiCamera
+
+            started = time.monotonic()
+            self.camera = PiCamera()
+            self.applied = {}
+            time.sleep(self.warmup)
+            if self.log:
+                self.log.info(f"Camera opened in {time.monotonic() - started:.1f} s")
+        return self.camera
+
+    def configure(self, settings):
+        # Properties are set in the given order, e.g. resolution and framerate before exposure
+        changed = []
+        for name, value in settings.items():
+            if self.applied.get(name, object()) != value:
+                setattr(self.camera, name, value)
+                self.applied[name] = value
+                changed.append(name)
+                for reset in RESETS.get(name, ()):
+                    self.applied.pop(reset, None)
+        return changed
+
+    @contextmanager
+    def use(self, mode, settings, timeout=-1):
+        # Only one worker holds the camera at a time; the next one waits here instead of opening its own
+        if not self.lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Camera is busy ({self.mode})")
+        try:
+            started = time.monotonic()
+            self.open()
+            changed = self.configure(settings)
+            self.mode = mode
+            if self.log:
+                self.log.debug(f"Camera in {mode} mode after {(time.monotonic() - started) * 1000:.0f} ms ({len(changed)} settings changed)")
+            yield self.camera
+        finally:
+            self.lock.release()
+
+    def close(self, timeout=5):
+        # On shutdown a worker may still hold the camera; it is closed anyway after timeout
+        locked = self.lock.acquire(timeout=timeout)
+        try:
+            if self.camera is not None:
+                self.camera.close()
+                self.camera = None
+                self.applied = {}
+                self.mode = None
+        finally:
+            if locked:
+                self.lock.release()
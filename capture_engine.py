@@ -0,0 +1,453 @@
+"""
+Capture engine: plans and runs a plate capture with no GUI involved
+Used by the GUI, the run scheduler and the headless entry point alike
+"""
+import json
+import os
+import time
+import uuid
+
+from config import config as cfg
+import printer as printer
+import io_helper as ioh
+import path_planner as pp
+import capture_plan as cp
+import motion_estimator as me
+import motion_profiles as mprof
+import burst_capture as bc
+import run_journal as rj
+import well_location_calculator as wlc
+import autofocus as af
+import focus_stack as fs
+import image_container as ic
+import image_index as ii
+from image_writer import ImageWriter
+from capture_scheduler import CaptureScheduler
+
+# Camera properties in the order they have to be set, e.g. resolution and framerate before exposure
+CAMERA_SETTINGS = ("resolution", "framerate", "iso", "shutter_speed", "exposure_mode", "awb_mode",
+                   "brightness", "contrast", "sharpness", "saturation", "awb_gains")
+
+def default_camera_settings():
+    return {
+        # Core
+        "resolution": (cfg.picture.width, cfg.picture.height),
+        "framerate": float(cfg.framerate),
+        "iso": int(cfg.iso),
+        "shutter_speed": int(cfg.shutter),
+        "exposure_mode": str(cfg.exposure_mode),
+        "awb_mode": str(cfg.awb_mode),
+        # Tuning
+        "brightness": int(cfg.brightness),
+        "contrast": int(cfg.contrast),
+        "sharpness": int(cfg.sharpness),
+        "saturation": int(cfg.saturation),
+        "awb_gains": (float(cfg.red_gain), float(cfg.blue_gain)),
+    }
+
+class RunSettings:
+    # Everything a capture run is defined by; unset values come from config.yaml
+    def __init__(self, input_csv=None, output_dir=None, output_prefix=None, output_suffix=None, zstack_plus_minus=0,
+                 zstack_per_well=None, motion_profile=None, preview_mode=False, capture_port=None, frames_per_shot=None,
+                 camera=None, focal_surface=None, autofocus=None, autofocus_keep=None, focus_stack=None,
+                 output_format=None):
+        self.input_csv = input_csv or cfg.input_csv
+        self.output_dir = output_dir or cfg.output_dir
+        self.output_prefix = cfg.output_prefix if output_prefix is None else output_prefix
+        self.output_suffix = cfg.output_suffix if output_suffix is None else output_suffix
+        self.zstack_plus_minus = int(zstack_plus_minus)     # 0 for no z-stack
+        self.zstack_per_well = cfg.zstack_per_well if zstack_per_well is None else bool(zstack_per_well)
+        self.motion_profile = motion_profile or cfg.motion_profile
+        self.preview_mode = bool(preview_mode)
+        self.capture_port = capture_port or cfg.capture_port
+        self.frames_per_shot = max(1, int(frames_per_shot or cfg.frames_per_shot))
+        self.camera = {**default_camera_settings(), **(camera or {})}
+        self.focal_surface = focal_surface or None          # Saved focal surface name; Z per well comes from it, not the CSV
+        self.autofocus = autofocus or cfg.autofocus_mode    # Anything but "off" focuses every well and replaces the z-stack
+        self.autofocus_keep = int(cfg.autofocus_keep if autofocus_keep is None else autofocus_keep)
+        self.focus_stack = cfg.focus_stack if focus_stack is None else bool(focus_stack)    # Fuse each well's levels into one image
+        self.output_format = output_format or cfg.output_format     # "tar" appends images to a few shard files
+
+    def image_levels(self):
+        # Z levels each well's images are saved at; with autofocus they count from the best focus, not the planned Z
+        if self.autofocus != "off":
+            return cp.zstack_levels(self.autofocus_keep)
+        return cp.zstack_levels(self.zstack_plus_minus)
+
+    def camera_settings(self):
+        # What CameraSession applies; JSON turns tuples into lists, so they are turned back here
+        settings = {"rotation": int(cfg.rotation)}
+        for name in CAMERA_SETTINGS:
+            value = self.camera[name]
+            settings[name] = tuple(value) if isinstance(value, list) else value
+        return settings
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+class RunResult:
+    def __init__(self):
+        self.images = 0             # Images queued for writing
+        self.errors = []            # (path, error) for images that could not be written
+        self.stopped = False
+        self.skipped = 0            # Shots a resume found already done
+        self.stacked = []           # Focus-stacked images written
+        self.elapsed = 0.0
+        self.estimate = None
+
+def plan_run(settings, start, log=None):
+    # Waypoints in visiting order and the shot list, exactly as run_capture will take them
+    profile = mprof.get_profile(settings.motion_profile)
+    waypoints = ioh.load_waypoints_from_csv(settings.input_csv, int(cfg.num_cols))
+    if settings.focal_surface:
+        waypoints = wlc.apply_focal_surfaces(waypoints, wlc.run_focal_surfaces(settings.focal_surface, cfg.focal_surfaces), log)
+    # Autofocus finds each well's levels as it goes, so every well is planned as one shot
+    zstack_plus_minus = 0 if settings.autofocus != "off" else settings.zstack_plus_minus
+    waypoints, shots = cp.plan_capture(waypoints, start, zstack_plus_minus, settings.zstack_per_well, cfg.optimize_path,
+                                       cfg.clear_height, profile.hop_feedrate, cfg.max_feedrate)
+    return waypoints, shots, profile
+
+def estimate_shots(shots, start, settings, profile, shutter_speed):
+    images_per_shot = settings.frames_per_shot
+    autofocus_time = 0.0
+    if settings.autofocus != "off":
+        # Each focus frame is a Z step and a settled frame; the kept levels are images at the same well
+        images_per_shot *= len(settings.image_levels())
+        step = ((0.0, 0.0, 0.0), (0.0, 0.0, cfg.zstack_step_distance))
+        feedrate, acceleration = profile.for_move(*step)
+        frame_time = me.move_time(*step, feedrate / 60, acceleration=acceleration) + (cfg.settle_frames + 1) / float(cfg.framerate)
+        autofocus_time = af.expected_samples(settings.autofocus, cfg.autofocus_range) * frame_time
+    return me.estimate_run(shots, start, settings.preview_mode, shutter_speed, profile=profile, capture_port=settings.capture_port,
+                           frames_per_shot=images_per_shot, autofocus_time=autofocus_time)
+
+def estimate_run(settings, start):
+    waypoints, shots, profile = plan_run(settings, start)
+    return estimate_shots(shots, start, settings, profile, settings.camera["shutter_speed"])
+
+def remaining_shots(shots, resume, frames_per_shot, levels=None, stored=None):
+    # Shots of a resumed run still to take; resume is its JournalState
+    # levels: an autofocused well is one shot that needs all its kept levels; stored: names in the tar shards, since
+    # journaled images whose shard data did not survive a crash are taken again
+    done = resume.completed_shots(frames_per_shot)
+    if stored is not None:
+        done = {key for key in done if all(name in stored for name in resume.files[key].values())}
+    return [shot for shot in shots
+            if any(rj.shot_key(shot.waypoint.plate, shot.waypoint.well, level) not in done for level in (levels or [shot.level]))]
+
+def no_progress(event, **fields):
+    pass
+
+def run_capture(settings, session, log, stop_event, resume=False, progress=no_progress):
+    # Resume continues the run journaled in the output folder, with that run's own settings
+    journal_state = None
+    if resume and not settings.preview_mode:
+        journal_state = rj.load_journal(settings.output_dir)
+        if journal_state is None or journal_state.settings is None:
+            raise FileNotFoundError(f"No run journal to resume in {settings.output_dir}")
+        settings = RunSettings.from_dict(journal_state.settings)
+        log.info(f"Resuming the run journaled in {settings.output_dir}")
+
+    # Borrow the warm camera; only settings that differ from the last run or the preview are applied
+    with session.use("capture", settings.camera_settings()) as camera:
+        return capture_plate(camera, settings, log, stop_event, journal_state, progress)
+
+def capture_plate(camera, settings, log, stop_event, resume=None, progress=no_progress):
+    # progress(event, **fields) gets run_started, shot and run_finished, for structured output
+    result = RunResult()
+    # Safely grab printer connection
+    printer.get_printer()
+    preview_mode = settings.preview_mode
+
+    # Feedrate and acceleration are picked per move from its length; Z acceleration is capped for the run
+    profile = mprof.get_profile(settings.motion_profile)
+    log.info(f"Motion profile: {profile.name}")
+    printer.stream_gcode(profile.axis_limits_gcode())
+
+    # Next move starts when the exposure is over; the fixed sleep is only kept as an opt-in margin
+    capture_margin = (camera.shutter_speed / 1_000_000 * float(cfg.sleep_multiplier)) + float(cfg.sleep_addition)
+    capture_scheduler = CaptureScheduler(margin=capture_margin if cfg.sleep_after_capture else 0.0)
+
+    # Everything opened below is closed in the finally, so an error mid-run (printer gone, unknown focal surface...)
+    # leaks no threads, worker processes or open shard files
+    source = image_writer = container = journal = image_index = stacker = focus_frames = None
+    try:
+        # Still port for full quality, or frames straight from the running video port for speed
+        capture_port = settings.capture_port
+        frames_per_shot = settings.frames_per_shot
+        source = bc.capture_source(camera, capture_port, cfg.video_quality, cfg.settle_frames)
+        capture_kwargs = {"format": "jpeg", "burst": True} if frames_per_shot > 1 and capture_port == "still" else {"format": "jpeg"}
+        log.info(f"Capturing from the {capture_port} port, {frames_per_shot} image(s) per shot")
+
+        # Images are written in the background; output folder is created once up front
+        # With tar output they are appended to a few large shards, which FAT USB sticks handle far better than many small files
+        if preview_mode is False:
+            os.makedirs(settings.output_dir, exist_ok=True)
+            if settings.output_format == "tar":
+                container = ic.ShardWriter(settings.output_dir, cfg.shard_size_mb * 2**20, cfg.journal_sync_every,
+                                           cfg.journal_sync_interval)
+                log.info(f"Saving to tar shards of up to {cfg.shard_size_mb} MB in {settings.output_dir}")
+        # A burst takes all its buffers before submitting any, so the pool has to hold at least one whole shot
+        image_writer = ImageWriter(buffer_count=max(int(cfg.write_buffers), frames_per_shot), log=log, container=container,
+                                   checksum=cfg.checksum if cfg.image_index else None)
+
+        # Visit the wells in the order with the least travel from where the gantry will be after clearing
+        # Shot list: (cycle, waypoint, z level); each waypoint carries its own well number
+        current = printer.get_pos()
+        start = (current['X'], current['Y'], current['Z'])
+        cleared = (current['X'], current['Y'], current['Z'] + cfg.clear_height)
+        zstack_plus_minus = settings.zstack_plus_minus
+        csv_waypoints = ioh.load_waypoints_from_csv(settings.input_csv, int(cfg.num_cols))
+        well_count = len(csv_waypoints)
+        waypoints, shots, profile = plan_run(settings, start, log)
+        if settings.focal_surface:
+            surface = wlc.run_focal_surfaces(settings.focal_surface, cfg.focal_surfaces)[None]
+            log.info(f"Focal surface '{settings.focal_surface}': prediction RMS {wlc.microns_text(surface.prediction_rms)}, "
+                     f"z-stack needed {surface.stack_advice(cfg.zstack_step_distance)} (running +/- {zstack_plus_minus})")
+        if cfg.optimize_path:
+            csv_time = pp.estimate_path_time(csv_waypoints, cleared, profile.hop_feedrate / 60, cfg.max_feedrate)
+            planned_time = pp.estimate_path_time(waypoints, cleared, profile.hop_feedrate / 60, cfg.max_feedrate)
+            log.info(f"Planned path: {planned_time:.1f} s of travel (CSV order: {csv_time:.1f} s)")
+
+        # Skip shots whose images the interrupted run already got onto disk
+        if resume is not None:
+            levels = settings.image_levels() if settings.autofocus != "off" else None
+            remaining = remaining_shots(shots, resume, frames_per_shot, levels, container.index if container is not None else None)
+            result.skipped = len(shots) - len(remaining)
+            shots = remaining
+            log.say(f"[INFO] Resuming: {result.skipped} shots already done, {len(shots)} left")
+        shot_count = len(shots)
+        if shot_count == 0:
+            log.say("Nothing left to capture")
+            return result
+
+        # Every image that reaches the disk is journaled, so a stopped or crashed run can be resumed
+        # A resume keeps the run id it was started with
+        run_id = (resume.run_id if resume is not None else None) or uuid.uuid4().hex
+        if preview_mode is False:
+            journal = rj.RunJournal(settings.output_dir, cfg.journal_sync_every, cfg.journal_sync_interval)
+            journal.start(settings.to_dict(), resumed=resume is not None, run_id=run_id)
+            # Searchable record of every image, filled from the writer thread and committed in batches by its own thread
+            if cfg.image_index:
+                image_index = ii.ImageIndex(settings.output_dir, cfg.journal_sync_every, cfg.journal_sync_interval)
+                image_index.start_run(run_id, settings.to_dict())
+
+        # Intiializes to clear the plate
+        log.say("Initializing...")
+        # Clear the plate
+        # Moves are streamed; the printer only syncs (M400) right before a capture
+        log.info("Clearing...")
+        printer.rel_pos()
+        printer.stream_gcode(f"G0 Z+{cfg.clear_height:.2f} F{cfg.clear_feedrate}")
+        log.debug(f"Sending 'G0 Z+{cfg.clear_height:.2f} F{cfg.clear_feedrate}'")
+
+        # Move to start
+        printer.abs_pos()
+        position = cp.shot_position(cp.Shot(shots[0].cycle, shots[0].waypoint, 0), cfg.zstack_step_distance)
+        feedrate, acceleration = profile.for_move(cleared, position)
+        printer.set_travel_acceleration(acceleration)
+        printer.stream_gcode(f"{ioh.waypoint_gcode(shots[0].waypoint)} F{feedrate}")
+        log.debug(f"Sending '{ioh.waypoint_gcode(shots[0].waypoint)} F{feedrate}'")
+
+        # Start Message
+        log.say("===== Process Starting! =====")
+
+        # Predicted time per shot drives the live ETA
+        estimate = estimate_shots(shots, start, settings, profile, camera.shutter_speed)
+        result.estimate = estimate
+        eta = me.EtaTracker(estimate)
+        log.say(f"[INFO] Estimated run time: {me.format_duration(estimate.total)}")
+        progress("run_started", output_dir=settings.output_dir, shots=shot_count, skipped=result.skipped,
+                 estimate=round(estimate.total, 1))
+
+        # Wells whose levels are all on disk are fused in worker processes while the gantry moves on
+        if settings.focus_stack and preview_mode is False and len(settings.image_levels()) > 1:
+            stacker = fs.FocusStacker(settings.output_dir, settings.output_prefix, settings.output_suffix, settings.image_levels(),
+                                      cfg.stack_workers, cfg.stack_align, log,
+                                      on_stacked=lambda plate, well, path: progress("stacked", plate=plate, well=well, path=path),
+                                      locate=container.locate if container is not None else None)
+            if resume is not None:
+                # Slices written before the interruption complete their wells' stacks along with the new ones
+                for (plate, well, level), files in resume.files.items():
+                    for frame, name in files.items():
+                        stacker.add(plate, well, level, frame, os.path.join(settings.output_dir, name))
+            log.info(f"Focus stacking {len(settings.image_levels())} levels per well in {stacker.workers} processes")
+
+        camera_json = json.dumps(settings.camera)
+        width, height = settings.camera["resolution"]
+
+        def on_written(waypoint, level, frame, z, commanded, captured_at, exposure):
+            # Runs on the writer thread once the image is on disk
+            def written(path, size, checksum):
+                journal.record(waypoint.plate, waypoint.well, level, frame, path, z)
+                if stacker is not None:
+                    stacker.add(waypoint.plate, waypoint.well, level, frame, path)
+                if image_index is not None:
+                    name = os.path.basename(path)
+                    member = container.index[name] if container is not None else None
+                    image_index.add(run_id=run_id, plate=waypoint.plate, well=waypoint.well, level=level, frame=frame,
+                                    x=commanded[0], y=commanded[1], z=commanded[2], z_offset=round(commanded[2] - waypoint.z, 3),
+                                    shutter_speed=settings.camera["shutter_speed"], iso=settings.camera["iso"], width=width,
+                                    height=height, camera=camera_json, captured_at=captured_at, exposure=exposure,
+                                    written_at=time.time(), file=name, shard=member.shard if member else None,
+                                    offset=member.offset if member else None, size=size, checksum=checksum)
+            return written
+
+        # Autofocus scores small frames from their own splitter port, then takes the full images at the sharpest Z
+        if settings.autofocus != "off" and preview_mode is False:
+            focus_frames = af.FocusFrames(camera, cfg.autofocus_size, cfg.settle_frames)
+            log.info(f"Autofocus: {settings.autofocus} within +/- {cfg.autofocus_range} steps, keeping +/- {settings.autofocus_keep} levels")
+
+        def capture_images(waypoint, level, z_lvl, z=None):
+            # Every frame of one shot, queued for writing and journaled once on disk
+            frames = [None] if frames_per_shot == 1 else list(range(frames_per_shot))
+            photo_file_paths = [ioh.get_photo_path(settings.output_dir, settings.output_prefix, settings.output_suffix, "%02d" % waypoint.well, z_lvl, waypoint.plate, frame) for frame in frames]
+            # Waits here only if the disk has fallen behind by write_buffers images
+            buffers = [image_writer.acquire() for _ in frames]
+            captured_at = time.time()
+            exposure_time = capture_scheduler.capture(source, buffers if frames_per_shot > 1 else buffers[0], **capture_kwargs)
+            for frame, buffer, photo_file_path in zip(frames, buffers, photo_file_paths):
+                image_writer.submit(buffer, photo_file_path, on_written(waypoint, level, frame, z, position, captured_at, exposure_time))
+                log.info(f"Queued image for {photo_file_path}")
+            result.images += len(frames)
+            return exposure_time
+
+        def move_z(z):
+            # Z-only move at this well, waited out so the next frame is not blurred
+            nonlocal position
+            target = (position[0], position[1], z)
+            feedrate, acceleration = profile.for_move(position, target)
+            printer.set_travel_acceleration(acceleration)
+            printer.stream_gcode(f"G0 Z{z:.3f} F{feedrate}")
+            printer.wait()
+            position = target
+
+        previous_shot = None
+        for shot_num, shot in enumerate(shots, start=1):
+            cycle, waypoint, offset_num = shot
+            if stop_event.is_set():
+                result.stopped = True
+                break
+            well_number = waypoint.well
+            z_lvl = offset_num if zstack_plus_minus else None
+
+            # Move to location
+            waited = capture_scheduler.wait_for_move()
+            if waited:
+                log.debug(f"Waited {waited:.3f} seconds of capture margin")
+            target = cp.shot_position(shot, cfg.zstack_step_distance)
+            feedrate, acceleration = profile.for_move(position, target)
+            printer.set_travel_acceleration(acceleration)
+            position = target
+            if cp.is_z_step(previous_shot, shot):
+                # Same well, next focal plane: short Z-only relative move
+                z_step = cfg.zstack_step_distance * (offset_num - previous_shot.level)
+                printer.rel_pos()
+                printer.stream_gcode(f"G0 Z{z_step:+.3f} F{feedrate}")
+                printer.abs_pos()
+                log.debug(f"Stepping Z by {z_step:+.3f}")
+            else:
+                offset = cfg.zstack_step_distance * offset_num
+                offset_location = ioh.waypoint_gcode(waypoint, offset)
+                log.debug(f"Location is {offset_location}")
+                printer.stream_gcode(f"{offset_location} F{feedrate}")
+                log.info(f'Cycle {cycle}/{well_count}: Going to Well Number {"%02d" % well_number} (ETA {me.format_duration(eta.eta(shot_num - 1))})')
+            previous_shot = shot
+
+            # Take Picture
+            if preview_mode is False:
+                # Gantry has to be stopped before the shutter opens
+                printer.wait()
+                time.sleep(float(cfg.move_sleep_time))
+                log.info(f"Starting capture cycle")
+                if focus_frames is None:
+                    exposure_time = capture_images(waypoint, offset_num, z_lvl)
+                else:
+                    def measure(z):
+                        move_z(z)
+                        return af.focus_score(focus_frames.grab())
+                    focus = af.search(settings.autofocus, measure, waypoint.z, cfg.zstack_step_distance, cfg.autofocus_range)
+                    log.info(f"Focused at Z {focus.z:.3f} ({focus.z - waypoint.z:+.3f} from plan) after {len(focus.samples)} frames"
+                             + ("" if focus.bracketed else ", best at the edge of the search range"))
+                    progress("focus", well=well_number, plate=waypoint.plate, z=focus.z, planned_z=waypoint.z,
+                             frames=len(focus.samples), bracketed=focus.bracketed)
+                    for level in settings.image_levels():
+                        z = round(focus.z + level * cfg.zstack_step_distance, 3)
+                        move_z(z)
+                        time.sleep(float(cfg.move_sleep_time))
+                        exposure_time = capture_images(waypoint, level, level if settings.autofocus_keep else None, z)
+                log.debug(f"Exposure finished ({exposure_time * 1000:.1f} ms)")
+                log.say(f"[INFO] Captured image {shot_num}/{shot_count}")
+                progress("shot", shot=shot_num, shots=shot_count, well=well_number, plate=waypoint.plate, level=offset_num,
+                         images=result.images, eta=round(eta.eta(shot_num), 1))
+            else:
+                # Nothing is exposed, so only sync at the end of each well's stack to show where it is
+                if cp.ends_stack(shots, shot_num - 1):
+                    printer.wait()
+                log.info(f"Starting capture cycle")
+                photo_file_path = ioh.get_photo_path(settings.output_dir, settings.output_prefix, settings.output_suffix, "%02d" % well_number, z_lvl, waypoint.plate)
+                log.say(f"[INFO] No image captured (preview mode is ON)")
+                log.info(f"Did not save image as {photo_file_path}")
+
+        if image_writer.pending():
+            log.info(f"Waiting for {image_writer.pending()} images to finish writing...")
+        image_writer.close()
+        result.errors = image_writer.errors
+        if stacker is not None:
+            if stacker.pending():
+                log.info(f"Waiting for {stacker.pending()} wells to finish focus stacking...")
+            result.stacked = stacker.close()
+        if container is not None:
+            container.close()
+        if image_index is not None:
+            image_index.close()
+            for error in image_index.errors:
+                log.error(f"Image index: {error}")
+        result.elapsed = eta.elapsed()
+        if journal is not None:
+            if not result.errors and not result.stopped:
+                journal.finish()
+            journal.close()
+        if source is not camera:
+            source.close()
+        if focus_frames is not None:
+            focus_frames.close()
+        progress("run_finished", output_dir=settings.output_dir, images=result.images, errors=len(result.errors),
+                 stacked=len(result.stacked), stopped=result.stopped, elapsed=round(result.elapsed, 1))
+        if result.stopped:
+            return result
+
+        log.say("Process Complete!")
+        log.say(f"Run took {me.format_duration(result.elapsed)} (estimated {me.format_duration(estimate.total)})")
+        log.say("")
+        log.say("==================================================")
+        if preview_mode is False:
+            log.say(f"{result.images} Images Captured")
+            if result.errors:
+                log.say(f"{len(result.errors)} Images Failed to Save")
+            if result.stacked:
+                log.say(f"{len(result.stacked)} Wells Focus Stacked")
+            log.say(f"Output path: {settings.output_dir}")
+        else:
+            log.say("No Images Captured, Preview mode is ON")
+        log.say("==================================================")
+        return result
+    finally:
+        # Already closed on a normal or stopped run, where these do nothing
+        if image_writer is not None:
+            image_writer.close()
+        if stacker is not None:
+            stacker.close(cancel=True)
+        if container is not None:
+            container.close()
+        if image_index is not None:
+            image_index.close()
+        if journal is not None:
+            journal.close()
+        if source is not None and source is not camera:
+            source.close()
+        if focus_frames is not None:
+            focus_frames.close()
@@ -0,0 +1,43 @@
+from collections import namedtuple
+
+import path_planner as pp
+
+# One image: cycle is the well's place in the visiting order, level its z-stack offset in steps
+Shot = namedtuple("Shot", ["cycle", "waypoint", "level"])
+
+def zstack_levels(plus_minus):
+    return list(range(0 - plus_minus, 1 + plus_minus))
+
+def build_shots(waypoints, levels, per_well, alternate_levels=True):
+    wells = list(enumerate(waypoints, start=1))
+    shots = []
+    if per_well:
+        # All focal planes of a well before moving on; alternate direction so each stack starts where the last one ended
+        for cycle, waypoint in wells:
+            well_levels = levels if cycle % 2 == 1 else levels[::-1]
+            shots.extend(Shot(cycle, waypoint, level) for level in well_levels)
+    else:
+        # Whole plate once per focal plane; a planned path is walked back and forth instead of returning to the start
+        for i, level in enumerate(levels):
+            level_wells = wells[::-1] if alternate_levels and i % 2 == 1 else wells
+            shots.extend(Shot(cycle, waypoint, level) for cycle, waypoint in level_wells)
+    return shots
+
+def is_z_step(previous_shot, shot):
+    # Same well as the shot before, so only Z has to move
+    return previous_shot is not None and previous_shot.cycle == shot.cycle
+
+def ends_stack(shots, index):
+    # True for the last shot taken at a well before the gantry moves on
+    return index == len(shots) - 1 or shots[index + 1].cycle != shots[index].cycle
+
+def shot_position(shot, step_distance):
+    waypoint = shot.waypoint
+    return (waypoint.x, waypoint.y, round(waypoint.z + step_distance * shot.level, 3))
+
+def plan_capture(waypoints, start, zstack_plus_minus, per_well, optimize_path, clear_height, feedrate, max_feedrate):
+    # Shared by run_capture and the dry-run estimate so both see the same shots; feedrate in mm/min
+    if optimize_path:
+        cleared = (start[0], start[1], start[2] + clear_height)
+        waypoints = pp.plan_path(waypoints, cleared, feedrate / 60, max_feedrate)
+    return waypoints, build_shots(waypoints, zstack_levels(zstack_plus_minus), per_well, optimize_path)
@@ -0,0 +1,29 @@
+import time
+
+class CaptureScheduler:
+    # Lets the next move start as soon as the exposure is over, instead of after a fixed sleep
+    def __init__(self, margin=0.0):
+        self.margin = float(margin)     # Optional safety wait after the exposure (s)
+        self.exposure_end = None
+        self.exposure_time = None       # Exposure the sensor actually used (s)
+
+    def capture(self, camera, output, **kwargs):
+        # A list of outputs is taken as one burst at the current position
+        if isinstance(output, list):
+            camera.capture_sequence(output, **kwargs)
+        else:
+            camera.capture(output, **kwargs)
+        # capture() only returns once the whole frame has been read out, so the exposure is over
+        self.exposure_end = time.monotonic()
+        self.exposure_time = camera.exposure_speed / 1_000_000
+        return self.exposure_time
+
+    def wait_for_move(self):
+        # Sleeps whatever is left of the margin; time spent queueing the write and logging already counts
+        if self.exposure_end is None or self.margin <= 0:
+            return 0.0
+        remaining = self.exposure_end + self.margin - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.exposure_end = None
+        return max(remaining, 0.0)
@@ -8,19 +8,36 @@ class Resolution:
 
 class DefaultsConfig:
     def __init__(self, file_path="config.yaml"):
+        self.load(file_path)
+
+    def load(self, file_path):
+        # Also used to switch to another config file after import; every module shares this one object
         try: 
             with open(file_path, 'r') as file:
-                config = yaml.safe_load(file)
+                # The C loader, when PyYAML was built with it, reads the file several times faster
+                config = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
             # Plate Defaults
             self.num_rows = config['plate']['rows']
             self.num_cols = config['plate']['columns']
+            self.plate_model = config['plate'].get('model', 'bilinear')
+            self.focal_surfaces = config['plate'].get('focal_surfaces', 'focal_surfaces.json')
 
             # Capture I/O Defaults
             self.input_csv = config['capture']['input_csv']
             self.output_dir = config['capture']['output_dir']
             self.output_prefix = config['capture']['output_prefix']
             self.output_suffix = config['capture']['output_suffix']
+            self.output_format = config['capture'].get('output_format', 'files')
+            self.shard_size_mb = config['capture'].get('shard_size_mb', 1024)
+            self.image_index = config['capture'].get('image_index', True)
+            self.checksum = config['capture'].get('checksum', 'sha256')
+            self.write_buffers = config['capture'].get('write_buffers', 4)
+            self.journal_sync_every = config['capture'].get('journal_sync_every', 16)
+            self.journal_sync_interval = config['capture'].get('journal_sync_interval', 2.0)
+            self.focus_stack = config['capture'].get('focus_stack', False)
+            self.stack_workers = config['capture'].get('stack_workers', 1)
+            self.stack_align = config['capture'].get('stack_align', True)
 
             # Camera Defaults
             self.preview = Resolution(**config['camera']['resolution']['preview'])
@@ -32,6 +49,14 @@ class DefaultsConfig:
             self.shutter = config['camera']['core']['shutter']
             self.sleep_multiplier = config['camera']['core']['sleep_multiplier']
             self.sleep_addition = config['camera']['core']['sleep_addition']
+            self.sleep_after_capture = config['camera']['core'].get('sleep_after_capture', False)
+            self.capture_overhead = config['camera']['core'].get('capture_overhead', 0.4)
+            self.capture_port = config['camera']['core'].get('capture_port', 'still')
+            self.video_quality = config['camera']['core'].get('video_quality', 85)
+            self.settle_frames = config['camera']['core'].get('settle_frames', 1)
+            self.frames_per_shot = config['camera']['core'].get('frames_per_shot', 1)
+            self.preview_framerate = config['camera']['core'].get('preview_framerate', 15)
+            self.preview_encoding = config['camera']['core'].get('preview_encoding', 'ppm')
             self.exposure_mode = config['camera']['core']['exposure_mode']
             self.awb_mode = config['camera']['core']['awb_mode']
             # Tuning Settings
@@ -48,17 +73,43 @@ class DefaultsConfig:
             self.verbose_mode = config['misc']['verbose']
             self.zstack_plus_minus_count = config['misc']['zstack_plus_minus_count']
             self.zstack_step_distance = config['misc']['zstack_step_distance']
+            self.zstack_per_well = config['misc'].get('zstack_per_well', True)
+            self.optimize_path = config['misc'].get('optimize_path', True)
+
+            # Autofocus
+            autofocus = config.get('autofocus', {})
+            self.autofocus_mode = autofocus.get('mode', 'off')
+            self.autofocus_range = autofocus.get('range', 5)
+            self.autofocus_keep = autofocus.get('keep', 0)
+            self.autofocus_size = (autofocus.get('frame_width', 320), autofocus.get('frame_height', 240))
+
+            # Motion Profiles
+            motion = config.get('motion', {})
+            self.motion_profile = motion.get('profile', 'legacy')
+            self.motion_profiles = motion.get('profiles', {'legacy': {}})
 
             # Printer Connection
             self.printer_name = config['printer']['name']
             self.device_path = config['printer']['device_path']
             self.baudrate = config['printer']['baudrate']
             self.timeout_time = config['printer']['timeout_time']
+            self.connect_timeout = config['printer'].get('connect_timeout', 10)
+            self.handshake_interval = config['printer'].get('handshake_interval', 0.5)
             self.move_sleep_time = config['printer']['move_sleep_time']
+            self.stream_window = config['printer'].get('stream_window', 4)
+            self.position_max_age = config['printer'].get('position_max_age', 30)
+            self.position_auto_report = config['printer'].get('position_auto_report', 0)
             self.max_x = config['printer']['max']['x']
             self.max_y = config['printer']['max']['y']
             self.max_z = config['printer']['max']['z']
             self.max_speed = config['printer']['max']['speed']
+            max_feedrate = config['printer'].get('max_feedrate', {})
+            self.max_feedrate = (max_feedrate.get('x', 500), max_feedrate.get('y', 500), max_feedrate.get('z', 5))
+            max_acceleration = config['printer'].get('max_acceleration', {})
+            self.max_acceleration = (max_acceleration.get('x', 500), max_acceleration.get('y', 500), max_acceleration.get('z', 100))
+            self.acceleration = config['printer'].get('acceleration', 500)
+            self.clear_feedrate = config['printer'].get('clear_feedrate', 20000)
+            self.clear_height = config['printer'].get('clear_height', 40)
 
         except FileNotFoundError:
             print(f"[ERROR] Config file '{file_path}' not found")
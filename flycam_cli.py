@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Headless capture entry point: same capture engine as the GUI, no display needed
+Usage:
+    python flycam_cli.py run --csv plate.csv --output /media/usb/run1 --zstack 2 --json
+    python flycam_cli.py schedule schedule.yaml
+    python flycam_cli.py serve --queue-dir ~/flycam_queue
+"""
+import argparse
+import contextlib
+import glob
+import os
+import shutil
+import signal
+import sys
+import threading
+
+from config import config as cfg
+from logger import Logger, JsonLogger
+import autofocus as af
+import burst_capture as bc
+import capture_engine as ce
+import image_container as ic
+import motion_profiles as mprof
+
+def settings_from_args(args):
+    # Flags that were not given fall back to config.yaml, through RunSettings
+    camera = {}
+    if args.shutter is not None:
+        camera["shutter_speed"] = args.shutter
+    if args.iso is not None:
+        camera["iso"] = args.iso
+    if args.resolution is not None:
+        camera["resolution"] = tuple(args.resolution)
+    return ce.RunSettings(input_csv=args.csv, output_dir=args.output, output_prefix=args.prefix, output_suffix=args.suffix,
+                          zstack_plus_minus=args.zstack, zstack_per_well=args.per_well, motion_profile=args.profile,
+                          preview_mode=args.preview, capture_port=args.port, frames_per_shot=args.frames, camera=camera,
+                          focal_surface=args.focal_surface, autofocus=args.autofocus, autofocus_keep=args.keep,
+                          focus_stack=args.focus_stack, output_format=args.output_format)
+
+def run_single(args, session, log, stop_event, progress):
+    settings = settings_from_args(args)
+    result = ce.run_capture(settings, session, log, stop_event, resume=args.resume, progress=progress)
+    return 0 if not result.errors and not result.stopped else 1
+
+def run_schedule(path, session, log, stop_event, progress):
+    import scheduler as sc
+
+    mode, runs = sc.load_schedule(path)
+    schedule = sc.RunScheduler(runs, mode, log)
+    occurrences = schedule.plan()
+    for a, b in schedule.overlaps(occurrences):
+        log.warn(f"Overlap: {a.name} is estimated to run into {b.name}")
+    results = schedule.run(session, stop_event, occurrences, progress=progress)
+    failed = any(result.errors or result.stopped for _, result in results)
+    return 1 if failed or len(results) < len(occurrences) else 0
+
+def serve(queue_dir, poll_interval, session, log, stop_event, progress):
+    # Long-lived service: schedule files dropped into queue_dir run one at a time, oldest name first
+    # Each is moved to running/ while it runs, then to done/ or failed/
+    for folder in ("running", "done", "failed"):
+        os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+    log.info(f"Watching {queue_dir} for schedules")
+    progress("service_started", queue_dir=queue_dir)
+    while not stop_event.is_set():
+        pending = sorted(glob.glob(os.path.join(queue_dir, "*.yaml")) + glob.glob(os.path.join(queue_dir, "*.yml")))
+        if not pending:
+            stop_event.wait(poll_interval)
+            continue
+        name = os.path.basename(pending[0])
+        running = os.path.join(queue_dir, "running", name)
+        shutil.move(pending[0], running)
+        progress("schedule_started", schedule=name)
+        try:
+            status = run_schedule(running, session, log, stop_event, progress)
+        except Exception as e:
+            log.error(f"Schedule {name} failed: {e}")
+            status = 1
+        shutil.move(running, os.path.join(queue_dir, "done" if status == 0 else "failed", name))
+        progress("schedule_finished", schedule=name, ok=status == 0)
+    progress("service_stopped")
+    return 0
+
+def add_run_arguments(parser):
+    parser.add_argument("--csv", help="Waypoint CSV (default: capture.input_csv)")
+    parser.add_argument("--output", help="Output folder (default: capture.output_dir)")
+    parser.add_argument("--prefix", default=None)
+    parser.add_argument("--suffix", default=None)
+    parser.add_argument("--zstack", type=int, default=0, help="Z-stack levels above and below the path (0 for none)")
+    parser.add_argument("--per-well", dest="per_well", action="store_true", default=None)
+    parser.add_argument("--plate-major", dest="per_well", action="store_false", help="Whole plate once per z level")
+    parser.add_argument("--profile", choices=mprof.profile_names(), help="Motion profile")
+    parser.add_argument("--port", choices=bc.CAPTURE_PORTS, help="Camera port used for captures")
+    parser.add_argument("--frames", type=int, help="Images per well and z level")
+    parser.add_argument("--shutter", type=int, help="Shutter speed (us)")
+    parser.add_argument("--iso", type=int)
+    parser.add_argument("--resolution", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--focal-surface", dest="focal_surface", help="Saved focal surface to predict each well's Z from")
+    parser.add_argument("--autofocus", choices=af.AUTOFOCUS_MODES, help="Focus every well before capturing; replaces the z-stack")
+    parser.add_argument("--keep", type=int, help="Autofocus levels kept either side of the best focus")
+    parser.add_argument("--focus-stack", dest="focus_stack", action="store_true", default=None,
+                        help="Fuse each well's levels into one all-in-focus image during the run")
+    parser.add_argument("--no-focus-stack", dest="focus_stack", action="store_false")
+    parser.add_argument("--output-format", dest="output_format", choices=ic.OUTPUT_FORMATS,
+                        help="One file per image, or tar shards with an offset index")
+    parser.add_argument("--preview", action="store_true", help="Moves only, no captures")
+    parser.add_argument("--resume", action="store_true", help="Continue the run journaled in the output folder")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Flycam captures without the GUI")
+    parser.add_argument("--config", default="config.yaml", help="Config file")
+    parser.add_argument("--json", action="store_true", help="One JSON object per line on stdout instead of text")
+    # Opening the port resets most boards, so the position is unknown until homed; only skip it if the machine was just homed
+    parser.add_argument("--home", action="store_true", default=True, help="Home the printer before starting (default)")
+    parser.add_argument("--no-home", dest="home", action="store_false", help="Trust the current position instead of homing")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add_run_arguments(commands.add_parser("run", help="Capture one plate"))
+    schedule_parser = commands.add_parser("schedule", help="Run a schedule file")
+    schedule_parser.add_argument("schedule")
+    serve_parser = commands.add_parser("serve", help="Run schedule files dropped into a queue folder, until stopped")
+    serve_parser.add_argument("--queue-dir", required=True)
+    serve_parser.add_argument("--poll", type=float, default=5.0, help="Seconds between looks at the queue folder")
+    args = parser.parse_args()
+
+    cfg.load(args.config)
+    # In JSON mode stdout carries only JSON; plain prints from the printer and camera go to stderr
+    if args.json:
+        json_log = JsonLogger(verbose=cfg.verbose_mode, stream=sys.stdout)
+        log, progress = json_log, json_log.emit
+        quiet = contextlib.redirect_stdout(sys.stderr)
+    else:
+        log, progress = Logger(verbose=cfg.verbose_mode), ce.no_progress
+        quiet = contextlib.nullcontext()
+
+    # SIGTERM (systemd stop) and Ctrl+C finish the current shot, then stop
+    stop_event = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+
+    import printer
+    from camera_session import CameraSession
+    from startup import StartupTimer, HardwareStartup
+
+    with quiet:
+        # The camera warms up while the printer connects and homes
+        session = CameraSession(log=log)
+        timer = StartupTimer()
+        startup = HardwareStartup(session, log, timer, home=args.home,
+                                  status=lambda step, state: progress("startup", step=step, state=state)).start()
+        startup.wait()
+        for line in timer.report():
+            log.debug(f"Startup {line}")
+        if not startup.printer_ready.is_set():
+            session.close()
+            printer.close_printer()
+            return 2
+        try:
+            if args.command == "run":
+                return run_single(args, session, log, stop_event, progress)
+            if args.command == "schedule":
+                return run_schedule(args.schedule, session, log, stop_event, progress)
+            return serve(args.queue_dir, args.poll, session, log, stop_event, progress)
+        finally:
+            session.close()
+            printer.close_printer()
+
+if __name__ == "__main__":
+    sys.exit(main())
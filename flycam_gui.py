@@ -5,32 +5,36 @@ Author: Darren Lee
 TODO:
 
 """
-from datetime import datetime
-from picamera.array import PiRGBArray, PiBayerArray
-from picamera import PiCamera
-from io import BytesIO
-from PIL import Image
-from Xlib.display import Display
-import csv
+import time
+LAUNCHED = time.monotonic()     # Before the other imports, so their time counts toward startup
+
 import FreeSimpleGUI as sg
-import cv2
-import numpy as np
 import os
-import time
 import threading
-import random
 import queue
-import serial
 
 # Import modules
+# numpy-based ones (capture_engine, well_location_calculator, preview_render) and picamera load on first use,
+# and in the background during startup, so the window does not wait for them
 from config import config as cfg
 import printer as printer
-import io_helper as ioh
-import well_location_calculator as wlc
+import motion_profiles as mprof
+import burst_capture as bc
+import autofocus as af
+import image_container as ic
+from preview_stream import LatestFrame, PreviewStream
+from gui_state import WidgetState, WindowSignal
+from camera_session import CameraSession, preview_settings
+from startup import StartupTimer, HardwareStartup
+from logger import Logger
+
+PRELOAD = ("capture_engine", "well_location_calculator", "preview_render")
 
 # ===== Globals =====
-frame_bytes = None
-crosshair_radius = None
+preview_frames = LatestFrame()     # Newest encoded preview frame; older ones are dropped, not queued
+preview_renderer = None            # PreviewRenderer, made when the preview first starts
+camera_session = CameraSession()    # The one camera, kept open and handed to whichever worker runs
+crosshair_radius = 180
 crosshair_on = True
 
 # ===== GUI KEYS =====
@@ -48,6 +52,13 @@ class Keys:
     OUTPUT_PREVIEW = "-OUTPUT_PREVIEW-"
     ZSTACK_ON = "-ZSTACK_ON-"
     ZSTACK_COUNT = "-ZSTACK_COUNT-"
+    ZSTACK_PER_WELL = "-ZSTACK_PER_WELL-"
+    MOTION_PROFILE = "-MOTION_PROFILE-"
+    FOCAL_SURFACE = "-FOCAL_SURFACE-"
+    AUTOFOCUS = "-AUTOFOCUS-"
+    AUTOFOCUS_KEEP = "-AUTOFOCUS_KEEP-"
+    FOCUS_STACK = "-FOCUS_STACK-"
+    OUTPUT_FORMAT = "-OUTPUT_FORMAT-"
     # ----- Camera Settings -----
     OPEN_SECTION = "-OPEN_SECTION-"
     CAMERA_SECTION = "-CAMERA_SECTION-"
@@ -61,6 +72,8 @@ class Keys:
     SLEEP_MULT = "-SLEEP_MULT-"
     EXPOSURE_MODE = "-EXPOSURE_MODE-"
     AWB_MODE = "-AWB_MODE-"
+    CAPTURE_PORT = "-CAPTURE_PORT-"
+    FRAMES_PER_SHOT = "-FRAMES_PER_SHOT-"
     # Tuning
     BRIGHTNESS = "-BRIGHTNESS-"
     BRIGHTNESS_VAL = "-BRIGHTNESS_VAL-"
@@ -76,12 +89,15 @@ class Keys:
     # ----- Mode Selector -----
     PICTURE_MODE = "-PIC_MODE-"
     PREVIEW_MODE = "-PREV_MODE-"
+    RESUME = "-RESUME-"
     # ----- Output Manager -----
     VERBOSE_MODE = "-VERBOSE-"
+    STATUS = "-STATUS-"
     # ----- Capture Controller -----
     START_CAPTURE = "-START_CAPTURE-"
     STOP_CAPTURE = "-STOP_CAPTURE-"
     GO_HOME = "-HOME-"
+    ESTIMATE = "-ESTIMATE-"
     # ----- Output Element -----
     OUTPUT_WINDOW = "-OUTPUT-"
 
@@ -119,6 +135,9 @@ class Keys:
     CURRENT_POSITION_TEXT = "-CURRENT_POSITION_TEXT-"
     SAVE_CSV = "-SAVE_CSV-"
     SAVE_CSV_NAME = "-SAVE_CSV_NAME-"
+    FOCUS_ADD = "-FOCUS_ADD-"
+    FOCUS_FIT = "-FOCUS_FIT-"
+    FOCUS_COUNT = "-FOCUS_COUNT-"
     # ----- Corner Location Storage
     # Top Left Store 
     TL_X = "-TOP_LEFT_X-"
@@ -141,266 +160,156 @@ class Keys:
     BR_Z = "-BOTTOM_RIGHT_Z-"
     BR_SAVE = "-BOTTOM_RIGHT_SAVE-"
 
-class Logger:
-    def __init__(self, verbose=True, output_queue=None):
-        self.verbose = verbose
-        self.q = output_queue
+    # ===== WORKER EVENTS =====
+    # Posted by worker threads with window.write_event_value, so the GUI loop only wakes when something happened
+    LOG_MESSAGE = "-LOG_MESSAGE-"
+    STARTUP_STATUS = "-STARTUP_STATUS-"
+    THREAD_DONE = "-THREAD_DONE-"
+    THREAD_UPDATE = "-THREAD_UPDATE-"
+    PREVIEW_FRAME = "-PREVIEW_FRAME-"
+    ESTIMATE_DONE = "-ESTIMATE_DONE-"
 
-    # Verbose mode logger
-    def log(self, msg, level="INFO"):
-        if self.verbose:
-            self.q.put(f"[{level}] {msg}")
-    
-    def info(self, msg): self.log(msg, "INFO")
-    def debug(self, msg): self.log(msg, "DEBUG")
-    def warn(self, msg): self.log(msg, "WARNING")
-    def error(self, msg): self.log(msg, "ERROR")
-
-    # Regular print message
-    def say(self, msg): self.q.put(msg)
-
-def draw_crosshair(frame, circle_radius=50, color=(0, 255, 0), thickness=2):
-    h, w = frame.shape[:2]
-    center_x, center_y = w // 2, h // 2
-
-    # Croshair Length
-    length = 20
-
-    cv2.line(frame, (center_x - length, center_y), (center_x + length, center_y), color, thickness)
-    cv2.line(frame, (center_x, center_y - length), (center_x, center_y + length), color, thickness)
-    cv2.circle(frame, (center_x, center_y), circle_radius, color, thickness)
-    return frame
-
-def convert_to_bytes(frame):
-    img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    im_pil = Image.fromarray(img)
-    with BytesIO() as output:
-        im_pil.save(output, format="PNG")
-        data = output.getvalue()
-    return data
+def format_position(position):
+    return f"X: {position['X']} Y: {position['Y']} Z: {position['Z']}"
+
+def format_status(status):
+    return "   ".join(f"{step.capitalize()}: {state}" for step, state in status.items())
+
+def preview_frame(frame):
+    # Runs on the preview thread for every frame; frame is the reused RGB capture buffer
+    return preview_renderer.render(frame, crosshair_on, crosshair_radius)
 
 def run_manual(event, values, log, manual_queue, thread_done, thread_stop, thread_update, thread_ready):
     log.say("New Thread Opened")
-    global frame_bytes
-    global crosshair_radius
-    global crosshair_on
-
-    # Open Camera
+    # The camera stays open between tabs; only the preview settings are switched in
     try:
-        camera.close()
-    except:
-        pass
-    camera = PiCamera()     # Define camera
-    log.info("Camera Opened")
-
-    # Load Camera Settings
-    camera.resolution = (cfg.preview.width, cfg.preview.height)
-    camera.rotation = cfg.rotation
+        with camera_session.use("preview", preview_settings()) as camera:
+            manual_control(camera, log, manual_queue, thread_stop, thread_update, thread_ready)
+    finally:
+        thread_done.set()
+
+def manual_control(camera, log, manual_queue, thread_stop, thread_update, thread_ready):
+    from picamera.array import PiRGBArray
+    from preview_render import PreviewRenderer
+
+    global preview_renderer
+    if preview_renderer is None:
+        preview_renderer = PreviewRenderer(height=360, encoding=cfg.preview_encoding)
     raw = PiRGBArray(camera)
-    time.sleep(2)
+
+    # Frames stream continuously on their own thread; jogs below never wait for one
+    stream = PreviewStream(camera, raw, preview_frame, preview_frames, log, format="rgb").start()
     thread_ready.set()
 
     # Change printer positioning mode
     printer.rel_pos()
     while not thread_stop.is_set():
         try:
-            command = manual_queue.get(timeout=0.1)
-            log.info(f"Running G-code: {command}")
-            printer.run_gcode(command)
-            manual_queue.task_done()
-            printer.wait()
-
-            raw.truncate(0)
-            camera.capture(raw, format="bgr", use_video_port=True)
-            frame = raw.array
-
-            if frame.shape[0] >= 360:
-                frame = frame[:360, :, :].copy()
-            else:
-                print("Warning: Frame too short", frame.shape)
-                continue
-
-            # Draw crosshair
-            if crosshair_on:
-                frame = draw_crosshair(frame, circle_radius=crosshair_radius)
-
-            # Convert to JPEG for faster GUI rendering
-            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_img = Image.fromarray(img)
-            with BytesIO() as output:
-                pil_img.save(output, format="PNG")
-                frame_bytes = output.getvalue()
-            thread_update.set()
+            # (G-code, travel acceleration or None); M204 is sent from here too, so the GUI loop never waits on the port
+            command, acceleration = manual_queue.get(timeout=0.1)
         except queue.Empty:
             continue
-
-    camera.close()
-    thread_done.set()
-
-def run_home(event, values, log, thread_done):
+        if acceleration is not None:
+            printer.set_travel_acceleration(acceleration)
+        log.info(f"Running G-code: {command}")
+        printer.stream_gcode(command)
+        manual_queue.task_done()
+        printer.wait()
+        thread_update.set()
+
+    stream.stop()
+    log.info(f"Preview stopped after {stream.frame_count} frames ({preview_frames.dropped} dropped)")
+
+def run_home(event, values, log, thread_done, printer_ready):
     """
     """
-    log.say("Homing...")
-    printer.home()
-    thread_done.set()
+    # Also retries the connection when it failed at startup
+    try:
+        if printer.get_printer() is None:
+            log.error(f"Could not connect to the printer on {cfg.device_path}")
+            return
+        log.say("Homing...")
+        printer.home()
+        printer_ready.set()
+    finally:
+        thread_done.set()
+
+def settings_from_values(values):
+    import capture_engine as ce
+
+    # Run settings as entered in the Auto Capture tab
+    return ce.RunSettings(
+        input_csv=values[Keys.INPUT_CSV],
+        output_dir=values[Keys.OUTPUT_DIR],
+        output_prefix=values[Keys.OUTPUT_PREFIX],
+        output_suffix=values[Keys.OUTPUT_SUFFIX],
+        zstack_plus_minus=int(values[Keys.ZSTACK_COUNT]) if values[Keys.ZSTACK_ON] else 0,
+        zstack_per_well=values[Keys.ZSTACK_PER_WELL],
+        motion_profile=values[Keys.MOTION_PROFILE],
+        preview_mode=bool(values[Keys.PREVIEW_MODE]),
+        capture_port=values[Keys.CAPTURE_PORT],
+        frames_per_shot=int(values[Keys.FRAMES_PER_SHOT]),
+        # Blank keeps the CSV's Z; a saved name predicts Z per well from that plate's focus points
+        focal_surface=values[Keys.FOCAL_SURFACE].strip() or None,
+        autofocus=values[Keys.AUTOFOCUS],
+        autofocus_keep=int(values[Keys.AUTOFOCUS_KEEP]),
+        focus_stack=values[Keys.FOCUS_STACK],
+        output_format=values[Keys.OUTPUT_FORMAT],
+        camera={
+            # Core
+            "resolution": (int(values[Keys.PIC_WIDTH]), int(values[Keys.PIC_HEIGHT])),
+            "framerate": float(values[Keys.FRAMERATE]),
+            "iso": int(values[Keys.ISO]),
+            "shutter_speed": int(values[Keys.SHUTTER]),
+            "exposure_mode": str(values[Keys.EXPOSURE_MODE]),
+            "awb_mode": str(values[Keys.AWB_MODE]),
+            # Tuning
+            "brightness": int(values[Keys.BRIGHTNESS]),
+            "contrast": int(values[Keys.CONTRAST]),
+            "sharpness": int(values[Keys.SHARPNESS]),
+            "saturation": int(values[Keys.SATURATION]),
+            "awb_gains": (float(values[Keys.RED_GAIN]), float(values[Keys.BLUE_GAIN])),
+        })
+
+def run_estimate(values, window):
+    # Dry run: plans the same shots as run_capture and predicts the time without moving
+    # Runs on its own thread, since planning a large plate takes a while; the report comes back as ESTIMATE_DONE
+    import capture_engine as ce
+
+    report = None
+    try:
+        current = printer.get_pos()
+        start = (current['X'], current['Y'], current['Z'])
+        settings = settings_from_values(values)
+        estimate = ce.estimate_run(settings, start)
+        report = [f"Motion profile: {settings.motion_profile}"] + estimate.report()
+    except Exception as e:
+        # Any failure is reported; the button only comes back with ESTIMATE_DONE
+        report = e
+    finally:
+        window.write_event_value(Keys.ESTIMATE_DONE, report)
 
 def run_capture(event, values, log, thread_done, thread_stop, preview_win_id):
     """
     """
+    import capture_engine as ce
+
     log.say("Loading auto-capture...")
-    # Safely load camera
-    log.info("Opening camera...")
     try:
-        camera.close()
-    except:
-        pass
-    camera = PiCamera()     # Define camera
-    log.info("Camera opened successfully!")
-
-    # Load Camera Settings
-    log.info("Loading settings...")
-    # Core
-    camera.resolution = (int(values[Keys.PIC_WIDTH]), int(values[Keys.PIC_HEIGHT]))
-    camera.rotation = int(cfg.rotation)
-    camera.framerate = float(values[Keys.FRAMERATE])
-    camera.iso = int(values[Keys.ISO])
-    camera.shutter_speed = int(values[Keys.SHUTTER])
-    camera.exposure_mode = str(values[Keys.EXPOSURE_MODE])
-    camera.awb_mode = str(values[Keys.AWB_MODE])
-    # Tuning
-    camera.brightness = int(values[Keys.BRIGHTNESS])
-    camera.contrast = int(values[Keys.CONTRAST])
-    camera.sharpness = int(values[Keys.SHARPNESS])
-    camera.saturation = int(values[Keys.SATURATION])
-    camera.awb_gains = (float(values[Keys.RED_GAIN]), float(values[Keys.BLUE_GAIN]))
-    log.info("Settings loaded successfully!")
-
-    # Safely grab printer connection
-    ser = printer.get_printer()
-
-    # Load Option Booleans
-    preview_mode = bool(values[Keys.PREVIEW_MODE])
-    verbose_mode = bool(values[Keys.VERBOSE_MODE])
-
-    # Grab CSV Filename
-    csv_file_path = values[Keys.INPUT_CSV]
-    location_list = ioh.load_gcode_from_csv(csv_file=csv_file_path)
-
-    # Intiializes to clear the plate
-    log.say("Initializing...")
-    # printer.show_stats()
-    # Clear the plate
-    log.info("Clearing...")
-    printer.rel_pos()
-    printer.run_gcode("G0 Z+40.00 F20000")
-    log.debug("Sending 'G0 Z+40.00 F20000'")
-    printer.wait()
-    
-    # Move to start
-    printer.abs_pos()
-    printer.run_gcode(f"{location_list[0]} F800")
-    log.debug("Sending '{location_list[0]} F800'")
-    printer.wait()
-
-    # Start Message
-    log.say("===== Process Starting! =====")
-
-    # Cycles through each well in a snakelike pattern
-    # Checks for even rows (pos) to determine well number
-    even_row_flag = False
-    rows = int(cfg.num_rows)
-    cols = int(cfg.num_cols)
-    well_count = rows * cols
-
-    X = 0
-    Y = 1
-    Z = 2
-
-    zstack_plus_minus = int(values[Keys.ZSTACK_COUNT]) if values[Keys.ZSTACK_ON] else 0
-    for offset_num in range(0 - zstack_plus_minus , 1 + zstack_plus_minus):
-        offset = cfg.zstack_step_distance * offset_num
-        for cycle, location in zip(range(1,rows*cols+1), location_list):
-            if thread_stop.is_set():
-                camera.close()
-                thread_done.set()
-                return
-            # Determine well number
-            if even_row_flag is True:
-                well_number = ((cycle-1)//cols)*cols + (cols-((cycle-1)%cols))
-            else:
-                well_number = cycle
-            
-            # Move to location
-            split_location = location.split("Z")
-            offset_location = f"{split_location[0]}Z{float(split_location[1]) + offset}"
-            log.debug(f"Location is {offset_location}")
-            printer.run_gcode(f"{offset_location} F800")
-            log.info(f'Cycle {cycle}/{well_count}: Going to Well Number {"%02d" % well_number}')
-            printer.wait()
-            time.sleep(float(cfg.move_sleep_time))
-
-            # Take Picture
-            if preview_mode is False:
-                log.info(f"Starting capture cycle")           
-                photo_file_path = ioh.get_photo_path(values[Keys.OUTPUT_DIR], values[Keys.OUTPUT_PREFIX], values[Keys.OUTPUT_SUFFIX], "%02d" % cycle)
-                os.makedirs(os.path.dirname(photo_file_path), exist_ok=True)
-                camera.capture(photo_file_path)
-                capture_sleep_time = (camera.shutter_speed / 1_000_000 * float(cfg.sleep_multiplier)) + float(cfg.sleep_addition)
-                log.debug(f"Sleeping for {capture_sleep_time} seconds")
-                time.sleep(capture_sleep_time)
-                log.say(f"[INFO] Captured image {cycle}/{well_count}")
-                log.info(f"Saved image as {photo_file_path}")
-            else:
-                log.info(f"Starting capture cycle")           
-                photo_file_path = ioh.get_photo_path(values[Keys.OUTPUT_DIR], values[Keys.OUTPUT_PREFIX], values[Keys.OUTPUT_SUFFIX], "%02d" % well_number)
-                capture_sleep_time = (camera.shutter_speed / 1_000_000 * float(cfg.sleep_multiplier)) + float(cfg.sleep_addition)
-                log.debug(f"Sleeping for {capture_sleep_time} seconds")
-                time.sleep(capture_sleep_time)
-                log.say(f"[INFO] No image captured (preview mode is ON)")
-                log.info(f"Did not save image as {photo_file_path}")
-            
-            # Flips row flag every 8 columns
-            if cycle % cols == 0:
-                even_row_flag = not even_row_flag
-
-    log.say("Process Complete!")
-    log.say("")
-    log.say("==================================================")
-    if preview_mode is False:
-        log.say(f"{well_count} Images Captured")
-        log.say(f"Output path: {values[Keys.OUTPUT_DIR]}")
-    else:
-        log.say("No Images Captured, Preview mode is ON")
-    log.say("==================================================")
-
-    # Close camera
-    camera.close()
-    print("Camera Closed")
-    # Send Flag to close thread
-    thread_done.set()
-
-    return
+        ce.run_capture(settings_from_values(values), camera_session, log, thread_stop, resume=bool(values[Keys.RESUME]))
+    except (FileNotFoundError, KeyError, ValueError) as e:
+        log.error(e)
+    finally:
+        thread_done.set()
 
 def main():
 
     # Startup message
     print("Opening Flycam GUI...")
-    
-    # Try to close any unended processes from previous crashes/errors
-    # Safely initializes a single camera instance
-    try:
-        camera.close()
-    except:
-        pass
+    timer = StartupTimer(LAUNCHED)
+    timer.mark("imports")
 
-    # ===== Printer Startup =====
-    # Setup 3D Printer
-    ser = printer.get_printer()
-
-    print("Homing")
-    printer.home()
-    print("Done!")
-    print("Opening Window")
+    # The printer and camera start in the background once the window is up, see HardwareStartup below
 
     # ===== GUI Window Layout =====
     sg.theme("LightBrown2")
@@ -440,6 +349,8 @@ def main():
             'flash',
             'horizon',
             ], default_value=cfg.awb_mode, key=Keys.AWB_MODE, enable_events=True)],
+        [sg.Text("Capture Port"), sg.Push(), sg.Combo(list(bc.CAPTURE_PORTS), default_value=cfg.capture_port, readonly=True, key=Keys.CAPTURE_PORT)],
+        [sg.Text("Images per Shot"), sg.Push(), sg.Input(cfg.frames_per_shot, size=(6,1), key=Keys.FRAMES_PER_SHOT)],
     ]
     # Right column, tuning settings sebsection
     tuning_settings_col = [
@@ -460,10 +371,11 @@ def main():
     ]], key=Keys.CAMERA_SECTION, visible=False))
     # Auto-capture subsection
     tab_1_column_1_layout = [
-        [sg.Text("Input CSV"), sg.Push(), sg.Input(size=(40, 1), default_text=f"{os.getcwd() if not cfg.input_csv else cfg.input_csv}{'/location_file_snake_path.csv' if not cfg.input_csv else ''}", key=Keys.INPUT_CSV), sg.FileBrowse()],
+        [sg.Text("Input CSV"), sg.Push(), sg.Input(size=(40, 1), default_text=f"{os.getcwd() if not cfg.input_csv else cfg.input_csv}{'/location_file_snake_path.csv' if not cfg.input_csv else ''}", enable_events=True, key=Keys.INPUT_CSV), sg.FileBrowse()],
         [sg.Text("Output Folder"), sg.Push(), sg.Input(size=(40, 1), default_text=f"{os.getcwd() if not cfg.output_dir else cfg.output_dir}{'/well_photos' if not cfg.output_dir else ''}", enable_events=True, key=Keys.OUTPUT_DIR), sg.FolderBrowse()],
         [sg.Text("Output Prefix"), sg.Push(), sg.Input(size=(40, 1), default_text=cfg.output_prefix, enable_events=True, key=Keys.OUTPUT_PREFIX)],
         [sg.Text("Output Suffix"), sg.Push(), sg.Input(size=(40, 1), default_text=cfg.output_suffix, enable_events=True, key=Keys.OUTPUT_SUFFIX)],
+        [sg.Text("Save As"), sg.Push(), sg.Combo(list(ic.OUTPUT_FORMATS), default_value=cfg.output_format, readonly=True, key=Keys.OUTPUT_FORMAT)],
         [sg.Push(), sg.Text(f"{os.getcwd() if not cfg.output_dir else cfg.output_dir}{'/well_photos' if not cfg.output_dir else ''}/{cfg.output_prefix}wellXX_YYYY-MM-DD_hhmmss{cfg.output_suffix}.jpg", text_color='darkolivegreen', key=Keys.OUTPUT_PREVIEW)],
         # [sg.Text("Well Plate Size "), sg.Input(default_text=cfg.num_cols, size=(3, 1), key=Keys.NUM_COLS), sg.Text("columns x "),
         # sg.Input(default_text=cfg.num_rows, size=(3, 1), key=Keys.NUM_ROWS), sg.Text("rows")],
@@ -471,13 +383,22 @@ def main():
         [sg.Text("▶ Camera Settings", enable_events=True, key=Keys.OPEN_SECTION)],
         [tab_1_column_1_collapse_layout],
         #[sg.VPush(background_color='orange')],
-        [sg.Checkbox("Z-Stack", key=Keys.ZSTACK_ON), sg.Input(cfg.zstack_plus_minus_count, size=(4,1), key=Keys.ZSTACK_COUNT)],
+        [sg.Checkbox("Z-Stack", key=Keys.ZSTACK_ON), sg.Input(cfg.zstack_plus_minus_count, size=(4,1), key=Keys.ZSTACK_COUNT),
+        sg.Checkbox("Per Well", default=cfg.zstack_per_well, key=Keys.ZSTACK_PER_WELL),
+        sg.Checkbox("Focus Stack", default=cfg.focus_stack, key=Keys.FOCUS_STACK)],
+        # Autofocus replaces the z-stack: the sharpest Z per well, plus Keep levels either side of it
+        [sg.Text("Autofocus"), sg.Combo(list(af.AUTOFOCUS_MODES), default_value=cfg.autofocus_mode, readonly=True, key=Keys.AUTOFOCUS),
+        sg.Text("Keep ±"), sg.Input(cfg.autofocus_keep, size=(3,1), key=Keys.AUTOFOCUS_KEEP)],
+        [sg.Text("Motion Profile"), sg.Combo(mprof.profile_names(), default_value=cfg.motion_profile, readonly=True, key=Keys.MOTION_PROFILE),
+        sg.Text("Focal Surface"), sg.Input("", size=(12,1), key=Keys.FOCAL_SURFACE)],
         [sg.Text("Select Capture Mode")],
         [sg.Radio("Preview", group_id="MODE_GROUP", default=cfg.preview_by_default, key=Keys.PREVIEW_MODE),
-        sg.Radio("Picture", group_id="MODE_GROUP", default=cfg.picture_by_default, key=Keys.PICTURE_MODE)],
+        sg.Radio("Picture", group_id="MODE_GROUP", default=cfg.picture_by_default, key=Keys.PICTURE_MODE),
+        sg.Checkbox("Resume", default=False, key=Keys.RESUME)],
         [sg.Button("▶ Start Capture", button_color=(None, 'darkolivegreen'), key=Keys.START_CAPTURE, disabled=True),
         sg.Button("■ Stop Capture", button_color=(None, 'darkred'), key=Keys.STOP_CAPTURE, disabled=True),
-        sg.Button("⌂ Home", button_color=(None, 'darkgoldenrod'), key=Keys.GO_HOME)]
+        sg.Button("⌂ Home", button_color=(None, 'darkgoldenrod'), key=Keys.GO_HOME, disabled=True),
+        sg.Button("⏱ Estimate", key=Keys.ESTIMATE, disabled=True)]
     ]
     # Auto-capture joiner
     tab_1_layout = [
@@ -487,7 +408,7 @@ def main():
     # ----- Tab 2 (Manual Mode) -----
     # Labels current printer position
     current_position_layout = [
-        [sg.Push(), sg.Text(f"X: {printer.get_pos()['X']} Y: {printer.get_pos()['Y']} Z: {printer.get_pos()['Z']}", key=Keys.CURRENT_POSITION_TEXT), sg.Push()]
+        [sg.Push(), sg.Text("Position unknown", key=Keys.CURRENT_POSITION_TEXT), sg.Push()]
     ]
     # Step size for manual mode selection {0.1, 0.5, 1.0, 5.0, 10.0}
     step_selector_layout = [
@@ -534,6 +455,8 @@ def main():
         [sg.VPush()],
         [sg.Text("CSV Name"), sg.Input("", size=(25,1), key=Keys.SAVE_CSV_NAME)],
         [sg.Button("Generate CSV", key=Keys.SAVE_CSV)],
+        # Focus by hand at a few wells spread over the plate, add each; the fit is saved under the CSV Name
+        [sg.Button("Add Focus Point", key=Keys.FOCUS_ADD), sg.Button("Fit Focal Surface", key=Keys.FOCUS_FIT), sg.Text("0 points", key=Keys.FOCUS_COUNT)],
         [sg.HorizontalSeparator()],
         [sg.Column(current_position_layout)],
         [sg.Column(step_selector_layout)],
@@ -585,10 +508,16 @@ def main():
         [sg.Tab("Auto Capture", tab_1_layout)],
         [sg.Tab("Manual Controller", tab_2_layout)]
         ], enable_events=True, key=Keys.TAB_GROUP)],
-        [sg.Checkbox("Verbose", default=cfg.verbose_mode, key=Keys.VERBOSE_MODE)],
+        [sg.Checkbox("Verbose", default=cfg.verbose_mode, key=Keys.VERBOSE_MODE), sg.Push(),
+        sg.Text("Printer: starting   Camera: starting", key=Keys.STATUS)],
     ]
     # Create window
-    window = sg.Window("Flycam GUI Rebuilt", layout)
+    window = sg.Window("Flycam GUI Rebuilt", layout, finalize=True)
+    # Widget updates go through here; ones that would not change anything are skipped
+    ui = WidgetState(window)
+    timer.mark("window shown")
+    # Moves need the printer, so the Manual Controller tab opens once it is homed
+    window[Keys.TAB_GROUP].Widget.tab(1, state="disabled")
 
     # ===== Preview Window =====
     # TODO: Preview Window Setup, 0 for dummy value
@@ -600,9 +529,10 @@ def main():
 
     thread = threading.Thread()
     # Initialize threading event. Used to stop the thread
+    # Done and update also post a window event, which is what wakes the GUI loop
     thread_stop = threading.Event()
-    thread_done = threading.Event()
-    thread_update = threading.Event()
+    thread_done = WindowSignal(window, Keys.THREAD_DONE)
+    thread_update = WindowSignal(window, Keys.THREAD_UPDATE)
     thread_ready = threading.Event()
     
     # ----- Flags and variables ----- 
@@ -610,44 +540,91 @@ def main():
     is_running_capture = False
     is_running_home = False
     is_running_manual = False
+    is_running_estimate = False
 
     opened = False
     # ----- Logger setup -----
-    output_queue = queue.Queue()
-    log = Logger(verbose=True, output_queue=output_queue)
+    # Messages are handed to the GUI loop as events and printed there, in order
+    log = Logger(verbose=True, output=lambda msg: window.write_event_value(Keys.LOG_MESSAGE, msg))
+    # Route unsolicited printer output (busy, echo, errors) to the log
+    printer.set_log_sink(lambda line: log.debug(f"Printer: {line}"))
+    camera_session.log = log
+
+    # ----- Hardware startup -----
+    # Printer connect and home, camera warm-up and the slow imports run side by side; progress shows in the status line
+    startup_status = {"printer": "starting", "camera": "starting"}
+    hardware = HardwareStartup(camera_session, log, timer, preload=PRELOAD,
+                               status=lambda step, state: window.write_event_value(Keys.STARTUP_STATUS, (step, state))).start()
 
     # ----- Manual Controller setup -----
     manual_queue = queue.Queue()
+    shown_frame = 0
+    focus_points = []
+    preview_frames.notify = lambda: window.write_event_value(Keys.PREVIEW_FRAME, None)
+
+    # Start Capture needs a CSV; later events keep this up to date
+    ui.update(Keys.START_CAPTURE, disabled=len(window[Keys.INPUT_CSV].get()) == 0)
 
     # ===== GUI loop =====
     try:
         while True:
-            event, values = window.read(timeout=10)
+            # Blocks until the user or a worker thread does something
+            event, values = window.read()
+
+            # Close Window
+            if event == sg.WIN_CLOSED:
+                print("Closing Flycam GUI...")
+                break
 
             # ----- Capture Controller Defaults -----
             # Enable/disable Capture Controller Buttons dependent on CSV field input
-            if len(values[Keys.INPUT_CSV]) > 0 and not is_running_capture and not is_running_home:
+            if len(values[Keys.INPUT_CSV]) > 0 and not is_running_capture and not is_running_home and hardware.printer_ready.is_set():
                 # Enable "Start Capture" button
-                window[Keys.START_CAPTURE].update(disabled=False)
+                ui.update(Keys.START_CAPTURE, disabled=False)
 
                 # Disable "End Capture" button
-                window[Keys.STOP_CAPTURE].update(disabled=True)
+                ui.update(Keys.STOP_CAPTURE, disabled=True)
             else:
                 # Disable "Start Capture" button
-                window[Keys.START_CAPTURE].update(disabled=True)
+                ui.update(Keys.START_CAPTURE, disabled=True)
 
             # ----- If/elif event chain -----
-            # Close Window
-            if event == sg.WIN_CLOSED:
-                print("Closing Flycam GUI...")
-                break
+            # Worker events; thread done/update and new frames are handled after the chain
+            if event == Keys.LOG_MESSAGE:
+                print(values[event])
+            elif event == Keys.STARTUP_STATUS:
+                step, state = values[event]
+                if step == "startup":
+                    for line in timer.report():
+                        log.info(f"Startup {line}")
+                else:
+                    startup_status[step] = state
+                    ui.update(Keys.STATUS, value=format_status(startup_status))
+                if step == "printer" and state in ("ready", "failed") and not is_running_home:
+                    # Home also retries a connection that failed
+                    ui.update(Keys.GO_HOME, disabled=False)
+                    if state == "ready":
+                        ui.update(Keys.ESTIMATE, disabled=is_running_estimate)
+                        ui.update(Keys.CURRENT_POSITION_TEXT, value=format_position(printer.get_pos()))
+                        window[Keys.TAB_GROUP].Widget.tab(1, state="normal")
+            elif event in (Keys.THREAD_DONE, Keys.THREAD_UPDATE, Keys.PREVIEW_FRAME):
+                pass
+            elif event == Keys.ESTIMATE_DONE:
+                report = values[event]
+                if isinstance(report, Exception):
+                    log.error(f"Could not estimate run: {report}")
+                else:
+                    for line in report or ():
+                        log.say(line)
+                is_running_estimate = False
+                ui.update(Keys.ESTIMATE, disabled=not hardware.printer_ready.is_set())
             elif event == Keys.OUTPUT_DIR or event == Keys.OUTPUT_PREFIX or event == Keys.OUTPUT_SUFFIX:
-                window[Keys.OUTPUT_PREVIEW].update(f"{values[Keys.OUTPUT_DIR]}/{values[Keys.OUTPUT_PREFIX]}wellXX_YYYY-MM-DD_hhmmss{values[Keys.OUTPUT_SUFFIX]}.jpg")
+                ui.update(Keys.OUTPUT_PREVIEW, value=f"{values[Keys.OUTPUT_DIR]}/{values[Keys.OUTPUT_PREFIX]}wellXX_YYYY-MM-DD_hhmmss{values[Keys.OUTPUT_SUFFIX]}.jpg")
             # Camera Settings Section
             elif event.startswith(Keys.OPEN_SECTION):
                 opened = not opened
-                window[Keys.OPEN_SECTION].update("▼ Camera Settings" if opened else "▶ Camera Settings")
-                window[Keys.CAMERA_SECTION].update(visible=opened)
+                ui.update(Keys.OPEN_SECTION, value="▼ Camera Settings" if opened else "▶ Camera Settings")
+                ui.update(Keys.CAMERA_SECTION, visible=opened)
             # Update Slider and Text
             # Brightness
             elif event == Keys.BRIGHTNESS:
@@ -735,11 +712,11 @@ def main():
 
                 # Enable/disable Capture Controller Buttons
                 # Disable "Start Capture" button
-                window[Keys.START_CAPTURE].update(disabled=True)
+                ui.update(Keys.START_CAPTURE, disabled=True)
                 # Enable "End Capture" button
-                window[Keys.STOP_CAPTURE].update(disabled=False)
+                ui.update(Keys.STOP_CAPTURE, disabled=False)
                 # Disable "Home" Button
-                window[Keys.GO_HOME].update(disabled=True)
+                ui.update(Keys.GO_HOME, disabled=True)
 
                 # Disable Other Tab Groups
                 window[Keys.TAB_GROUP].Widget.tab(1, state="disabled")
@@ -749,6 +726,14 @@ def main():
                 thread = threading.Thread(target=run_capture, args=(event, values, log, thread_done, thread_stop, preview_win_id), name="Capture", daemon=True)
                 thread.start()
 
+            # Estimate Button
+            elif event == Keys.ESTIMATE:
+                print("Pressed ESTIMATE")
+                # Off until the report is back, so one estimate runs at a time
+                is_running_estimate = True
+                ui.update(Keys.ESTIMATE, disabled=True)
+                threading.Thread(target=run_estimate, args=(values, window), name="Estimate", daemon=True).start()
+
             # Stop Capture Button
             elif event == Keys.STOP_CAPTURE:
                 # Signal 
@@ -765,15 +750,15 @@ def main():
                 is_running_home = True
 
                 # Disable All Capture Controller Keys
-                window[Keys.START_CAPTURE].update(disabled=True)
-                window[Keys.STOP_CAPTURE].update(disabled=True)
-                window[Keys.GO_HOME].update(disabled=True)
+                ui.update(Keys.START_CAPTURE, disabled=True)
+                ui.update(Keys.STOP_CAPTURE, disabled=True)
+                ui.update(Keys.GO_HOME, disabled=True)
 
                 # Disable Other Tab Groups
                 window[Keys.TAB_GROUP].Widget.tab(1, state="disabled")
                 window[Keys.TAB_GROUP].Widget.tab(1, text="✕ Locked")
                 
-                thread = threading.Thread(target=run_home, args=(event, values, log, thread_done), name="GoHome", daemon=True)
+                thread = threading.Thread(target=run_home, args=(event, values, log, thread_done, hardware.printer_ready), name="GoHome", daemon=True)
                 thread.start()
             
             # Manual Controller
@@ -783,7 +768,7 @@ def main():
                 print(selected_tab_group)
                 if selected_tab_group == "Auto Capture" and is_running_manual:
                     # Hide Image Preview
-                    window[Keys.SHOW_IMAGE].update(visible=False)
+                    ui.update(Keys.SHOW_IMAGE, visible=False)
 
                     print("Sending thread_stop")
                     thread_stop.set()
@@ -793,21 +778,21 @@ def main():
                     # Close Camera Settings Dropdown if opened when switching tabs
                     if opened:
                         opened = not opened
-                        window[Keys.OPEN_SECTION].update("▼ Camera Settings" if opened else "▶ Camera Settings")
-                        window[Keys.CAMERA_SECTION].update(visible=opened)
+                        ui.update(Keys.OPEN_SECTION, value="▼ Camera Settings" if opened else "▶ Camera Settings")
+                        ui.update(Keys.CAMERA_SECTION, visible=opened)
 
                     # Show Image Preview
-                    window[Keys.SHOW_IMAGE].update(visible=True)
-                    manual_queue.put("M400")
+                    ui.update(Keys.SHOW_IMAGE, visible=True)
+                    manual_queue.put(("M400", None))
 
                     # Change is_running_manual flag
                     is_running_manual = True
 
                     # Update current position text
-                    window[Keys.CURRENT_POSITION_TEXT].update(value=f"X: {printer.get_pos()['X']} Y: {printer.get_pos()['Y']} Z: {printer.get_pos()['Z']}")
+                    ui.update(Keys.CURRENT_POSITION_TEXT, value=format_position(printer.get_pos()))
                     
                     # Show Image element
-                    window[Keys.IMAGE].update(visible=True)
+                    ui.update(Keys.IMAGE, visible=True)
                     
                     # Start thread
                     thread = threading.Thread(target=run_manual, args=(event, values, log, manual_queue, thread_done, thread_stop, thread_update, thread_ready), name="ManualController", daemon=True)
@@ -816,7 +801,6 @@ def main():
             elif event == Keys.CROSSHAIR_ON:
                 global crosshair_on
                 crosshair_on = values[Keys.CROSSHAIR_ON]
-                manual_queue.put("M400")
 
             elif event == Keys.RADIUS:
                 global crosshair_radius
@@ -826,12 +810,12 @@ def main():
 
             elif event in Keys.MANUAL_MOVE_GROUP:
                 print("Clicked movement key!")
-                window[Keys.X_POS].update(disabled=True)
-                window[Keys.X_NEG].update(disabled=True)
-                window[Keys.Y_POS].update(disabled=True)
-                window[Keys.Y_NEG].update(disabled=True)
-                window[Keys.Z_POS].update(disabled=True)
-                window[Keys.Z_NEG].update(disabled=True)
+                ui.update(Keys.X_POS, disabled=True)
+                ui.update(Keys.X_NEG, disabled=True)
+                ui.update(Keys.Y_POS, disabled=True)
+                ui.update(Keys.Y_NEG, disabled=True)
+                ui.update(Keys.Z_POS, disabled=True)
+                ui.update(Keys.Z_NEG, disabled=True)
 
                 if values[Keys.STEP_01]:
                     step_size = 0.1
@@ -843,32 +827,34 @@ def main():
                     step_size = 5.0
                 elif values[Keys.STEP_10]:
                     step_size = 10.0
-                # feedrate = min(max(step_size * 500, 100), 3000)
-                feedrate = 800
+                # Short jogs move gently, long ones travel; Z stays within its own limits
+                profile = mprof.get_profile(values[Keys.MOTION_PROFILE])
+                axis = event[1] if event != Keys.MOVE_DUMMY else "X"
+                feedrate, acceleration = profile.for_jog(axis, step_size)
                 if event == Keys.MOVE_DUMMY:
                     log.debug("Pressed MOVE_DUMMY")
-                    manual_queue.put("M400")
+                    manual_queue.put(("M400", None))
 
                 elif event == Keys.X_POS:
                     log.debug("Pressed X_POS")
-                    manual_queue.put(f"G1 X+{step_size:.3f} F{feedrate:.0f}")
+                    manual_queue.put((f"G1 X+{step_size:.3f} F{feedrate:.0f}", acceleration))
                 elif event == Keys.X_NEG:
                     log.debug("Pressed X_NEG")
-                    manual_queue.put(f"G1 X-{step_size:.3f} F{feedrate:.0f}")
+                    manual_queue.put((f"G1 X-{step_size:.3f} F{feedrate:.0f}", acceleration))
                 
                 elif event == Keys.Y_POS:
                     log.debug("Pressed Y_POS")
-                    manual_queue.put(f"G1 Y+{step_size:.3f} F{feedrate:.0f}")
+                    manual_queue.put((f"G1 Y+{step_size:.3f} F{feedrate:.0f}", acceleration))
                 elif event == Keys.Y_NEG:
                     log.debug("Pressed Y_NEG")
-                    manual_queue.put(f"G1 Y-{step_size:.3f} F{feedrate:.0f}")
+                    manual_queue.put((f"G1 Y-{step_size:.3f} F{feedrate:.0f}", acceleration))
                 
                 elif event == Keys.Z_POS:
                     log.debug("Pressed Z_POS")
-                    manual_queue.put(f"G1 Z+{step_size:.3f} F{feedrate:.0f}")
+                    manual_queue.put((f"G1 Z+{step_size:.3f} F{feedrate:.0f}", acceleration))
                 elif event == Keys.Z_NEG:
                     log.debug("Pressed Z_NEG")
-                    manual_queue.put(f"G1 Z-{step_size:.3f} F{feedrate:.0f}")
+                    manual_queue.put((f"G1 Z-{step_size:.3f} F{feedrate:.0f}", acceleration))
 
             elif event == Keys.TL_SAVE:
                 positions = printer.get_pos()
@@ -896,24 +882,54 @@ def main():
             
             elif event == Keys.SAVE_CSV:
                 print("Pressed SAVE_CSV")
-                tl = [
-                    float(values[Keys.TL_X]),
-                    float(values[Keys.TL_Y]),
-                    float(values[Keys.TL_Z])]
-                tr = [
-                    float(values[Keys.TR_X]),
-                    float(values[Keys.TR_Y]),
-                    float(values[Keys.TR_Z])]
-                bl = [
-                    float(values[Keys.BL_X]),
-                    float(values[Keys.BL_Y]),
-                    float(values[Keys.BL_Z])]
-                br = [
-                    float(values[Keys.BR_X]),
-                    float(values[Keys.BR_Y]),
-                    float(values[Keys.BR_Z])]
-                filename = f"{os.getcwd() if not cfg.output_dir else cfg.output_dir}/{values[Keys.SAVE_CSV_NAME]}.csv"
-                wlc.generate_csv(cfg.num_rows, cfg.num_cols, tl, tr, bl, br, filename)
+                # Blank fields, corners the model cannot fit, or a folder that cannot be written are reported, not raised
+                try:
+                    tl = [
+                        float(values[Keys.TL_X]),
+                        float(values[Keys.TL_Y]),
+                        float(values[Keys.TL_Z])]
+                    tr = [
+                        float(values[Keys.TR_X]),
+                        float(values[Keys.TR_Y]),
+                        float(values[Keys.TR_Z])]
+                    bl = [
+                        float(values[Keys.BL_X]),
+                        float(values[Keys.BL_Y]),
+                        float(values[Keys.BL_Z])]
+                    br = [
+                        float(values[Keys.BR_X]),
+                        float(values[Keys.BR_Y]),
+                        float(values[Keys.BR_Z])]
+                    filename = f"{os.getcwd() if not cfg.output_dir else cfg.output_dir}/{values[Keys.SAVE_CSV_NAME]}.csv"
+                    import well_location_calculator as wlc
+                    problems = wlc.generate_csv(cfg.num_rows, cfg.num_cols, tl, tr, bl, br, filename, cfg.plate_model,
+                                                (cfg.max_x, cfg.max_y, cfg.max_z))
+                    log.say(f"Wrote {filename}")
+                    for problem in problems:
+                        log.warn(problem)
+                except (ValueError, OSError) as e:
+                    log.error(f"Could not save the CSV: {e}")
+
+            elif event == Keys.FOCUS_ADD:
+                position = printer.get_pos()
+                focus_points.append((position['X'], position['Y'], position['Z']))
+                ui.update(Keys.FOCUS_COUNT, value=f"{len(focus_points)} points")
+
+            elif event == Keys.FOCUS_FIT:
+                import well_location_calculator as wlc
+                name = values[Keys.SAVE_CSV_NAME].strip() or "default"
+                try:
+                    surface = wlc.choose_focal_surface(focus_points)
+                except ValueError as e:
+                    log.error(e)
+                else:
+                    for line in surface.report():
+                        log.say(line)
+                    log.say(f"Suggested z-stack: {surface.stack_advice(cfg.zstack_step_distance)}")
+                    wlc.save_focal_surface(name, surface, cfg.focal_surfaces)
+                    log.say(f"Saved focal surface '{name}'")
+                    focus_points.clear()
+                    ui.update(Keys.FOCUS_COUNT, value="0 points")
 
             # ----- Thread done manager -----
             # Check if thread is completed
@@ -938,15 +954,21 @@ def main():
 
 
                 # Enable/disable Capture Controller Buttons
+                # Home retries a failed connection, so until it works only Home comes back
+                connected = hardware.printer_ready.is_set()
                 # Enable "Start Capture" button
-                window[Keys.START_CAPTURE].update(disabled=False)
+                ui.update(Keys.START_CAPTURE, disabled=not connected)
                 # Disable "End Capture" button
-                window[Keys.STOP_CAPTURE].update(disabled=True)
+                ui.update(Keys.STOP_CAPTURE, disabled=True)
                 # Enable "Home" button
-                window[Keys.GO_HOME].update(disabled=False)
+                ui.update(Keys.GO_HOME, disabled=False)
+                ui.update(Keys.ESTIMATE, disabled=not connected or is_running_estimate)
                 # Enable Other Tab Groups
-                window[Keys.TAB_GROUP].Widget.tab(1, state="normal")
+                window[Keys.TAB_GROUP].Widget.tab(1, state="normal" if connected else "disabled")
                 window[Keys.TAB_GROUP].Widget.tab(1, text="Manual Controller")
+                if connected and startup_status["printer"] != "ready":
+                    startup_status["printer"] = "ready"
+                    ui.update(Keys.STATUS, value=format_status(startup_status))
                 thread_done.clear()
                 thread_stop.clear()
                 thread_update.clear()
@@ -956,37 +978,28 @@ def main():
             # ----- Thread update manager -----
             if is_running_manual:
                 if thread_update.is_set():
-                    window[Keys.CURRENT_POSITION_TEXT].update(value=f"X: {printer.get_pos()['X']} Y: {printer.get_pos()['Y']} Z: {printer.get_pos()['Z']}")
+                    ui.update(Keys.CURRENT_POSITION_TEXT, value=format_position(printer.get_pos()))
                     thread_update.clear()
 
-                    window[Keys.X_POS].update(disabled=False)
-                    window[Keys.X_NEG].update(disabled=False)
-                    window[Keys.Y_POS].update(disabled=False)
-                    window[Keys.Y_NEG].update(disabled=False)
-                    window[Keys.Z_POS].update(disabled=False)
-                    window[Keys.Z_NEG].update(disabled=False)
-
-                    global frame_bytes
-                    if frame_bytes:
-                        print("Bytes length:", len(frame_bytes) if frame_bytes else None)
-                        try:
-                            window[Keys.IMAGE].update(data=frame_bytes)
-                        except Exception as e:
-                            print("Update failed", e)
-
-            # ----- Queue manager -----
-            # Sends message to output window
-            try:
-                while True:
-                    msg = output_queue.get_nowait()
-                    print(msg)
-            except queue.Empty:
-                pass
-            
+                    ui.update(Keys.X_POS, disabled=False)
+                    ui.update(Keys.X_NEG, disabled=False)
+                    ui.update(Keys.Y_POS, disabled=False)
+                    ui.update(Keys.Y_NEG, disabled=False)
+                    ui.update(Keys.Z_POS, disabled=False)
+                    ui.update(Keys.Z_NEG, disabled=False)
+
+                # Show the newest preview frame, if one came in since the last event
+                shown_frame, frame_bytes = preview_frames.take(shown_frame)
+                if frame_bytes:
+                    try:
+                        window[Keys.IMAGE].update(data=frame_bytes)
+                    except Exception as e:
+                        print("Update failed", e)
+
     # Safe Teardown
     finally:
-        if camera:
-            camera.close()
+        if camera_session.camera:
+            camera_session.close()
             print("Camera Closed")
         printer.close_printer()
         if window:
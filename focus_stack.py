@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Focus stacking: each well's z-stack slices fused into one all-in-focus image
+Runs in worker processes during a capture, or afterwards on a finished run
+Usage: python focus_stack.py OUTPUT_DIR [--workers 2]
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+STACK_DIR = "stacked"
+
+def stacked_path(output_dir, output_prefix, output_suffix, well, plate=None):
+    # No timestamp, so a resumed run or a second pass finds the image it already made
+    plate_part = f"plate{plate}_" if plate is not None else ""
+    return os.path.join(output_dir, STACK_DIR, f"{output_prefix}{plate_part}well{int(well):02d}_stacked{output_suffix}.jpg")
+
+# ===== Fusion (runs in the worker processes) =====
+def _grey(image):
+    # float32 throughout: uint8 times a Python float would make a float64 copy twice the size
+    import numpy as np
+
+    return (image[..., 0] * np.float32(0.299) + image[..., 1] * np.float32(0.587)
+            + image[..., 2] * np.float32(0.114))
+
+def _box_sums(values, radius, axis):
+    # Sum over 2r + 1 neighbours along one axis, from a running sum; the input already carries r of padding each side
+    import numpy as np
+
+    size = 2 * radius + 1
+    sums = np.cumsum(values, axis=axis, dtype=np.float64)
+    sums = np.insert(sums, 0, 0, axis=axis)
+    upper = [slice(None), slice(None)]
+    lower = [slice(None), slice(None)]
+    upper[axis], lower[axis] = slice(size, None), slice(None, -size)
+    return sums[tuple(upper)] - sums[tuple(lower)]
+
+def sharpness(grey, radius=4, tile=256):
+    # Local contrast of the Laplacian: large where the slice is in focus, averaged so noise does not pick slices
+    # Worked out tile by tile, so the float64 running sums cover a few hundred pixels, not a whole 12 MP image
+    import numpy as np
+
+    size = 2 * radius + 1
+    height, width = grey.shape
+    border = radius + 1
+    padded = np.pad(grey, border, mode="edge")
+    result = np.empty((height, width), np.float32)
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            block = padded[top:top + tile + 2 * border, left:left + tile + 2 * border]
+            laplacian = np.abs(block[1:-1, :-2] + block[1:-1, 2:] + block[:-2, 1:-1] + block[2:, 1:-1] - 4 * block[1:-1, 1:-1])
+            blurred = _box_sums(_box_sums(laplacian, radius, 0), radius, 1) / (size * size)
+            result[top:top + blurred.shape[0], left:left + blurred.shape[1]] = blurred
+    return result
+
+def _downscale(values, scale):
+    # Block means, so fine detail averages out instead of aliasing
+    height, width = values.shape[0] // scale * scale, values.shape[1] // scale * scale
+    return values[:height, :width].reshape(height // scale, scale, width // scale, scale).mean(axis=(1, 3))
+
+def _phase_peak(a, b):
+    # Whole-pixel translation that moves b onto a, from the peak of their phase correlation
+    # Only half whitened: a defocused slice has next to no fine detail, and fully whitening it would amplify noise
+    import numpy as np
+
+    # Tapered to zero at the border, or the two crops' edges line up best at no shift at all
+    taper = np.outer(np.hanning(a.shape[0]), np.hanning(a.shape[1]))
+    spectrum = np.fft.fft2((a - a.mean()) * taper) * np.conj(np.fft.fft2((b - b.mean()) * taper))
+    correlation = np.fft.ifft2(spectrum / np.maximum(np.sqrt(np.abs(spectrum)), 1e-9)).real
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    return tuple(int(p - size if p > size // 2 else p) for p, size in zip(peak, correlation.shape))
+
+def offset(reference, image, scale=4, window=512):
+    # Translation (rows, cols) that lines image up with reference, both greyscale: found on a downscaled copy,
+    # then refined to the pixel on a full resolution window at the centre
+    rows, cols = (p * scale for p in _phase_peak(_downscale(reference, scale), _downscale(image, scale)))
+    height, width = reference.shape
+    crop_height, crop_width = min(window, height - 2 * abs(rows)), min(window, width - 2 * abs(cols))
+    if crop_height < 16 or crop_width < 16:
+        return rows, cols
+    top, left = (height - crop_height) // 2, (width - crop_width) // 2
+    fine_rows, fine_cols = _phase_peak(reference[top:top + crop_height, left:left + crop_width],
+                                       image[top - rows:top - rows + crop_height, left - cols:left - cols + crop_width])
+    return rows + fine_rows, cols + fine_cols
+
+def _shift(image, rows, cols):
+    # Moves the image by whole pixels, repeating the edge into the gap
+    import numpy as np
+
+    if rows == 0 and cols == 0:
+        return image
+    height, width = image.shape[:2]
+    row_index = np.clip(np.arange(height) - rows, 0, height - 1)
+    col_index = np.clip(np.arange(width) - cols, 0, width - 1)
+    return image[row_index][:, col_index]
+
+def fuse(paths, output_path, align=True, power=2.0, radius=4, quality=95, max_shift=64):
+    # Sharpness-weighted mean of the slices, read one at a time: the float32 colour total is the only full size
+    # colour array kept, about 0.5 GB at 12 MP all told
+    # A slice is a file path, or a (shard, offset, size) location when the run was saved as tar shards
+    import numpy as np
+    from PIL import Image
+    from image_container import read_source
+
+    started = time.monotonic()
+    previous = None
+    rows = cols = 0
+    total = weights = None
+    shifts = []
+    for path in paths:
+        with Image.open(BytesIO(read_source(path))) as file:
+            image = np.asarray(file.convert("RGB"))
+        grey = _grey(image)
+        if align:
+            # Each slice is matched to the one before, whose focus is closest to its own, and the steps add up
+            if previous is not None:
+                step_rows, step_cols = offset(previous, grey)
+                # A larger jump is a bad match on a featureless well, not real drift
+                if abs(step_rows) <= max_shift and abs(step_cols) <= max_shift:
+                    rows, cols = rows + step_rows, cols + step_cols
+                shifts.append((rows, cols))
+            previous = grey
+            image, grey = _shift(image, rows, cols), _shift(grey, rows, cols)
+        weight = sharpness(grey, radius) ** power + np.float32(1e-6)
+        del grey
+        if total is None:
+            total = np.zeros(image.shape, np.float32)
+            weights = np.zeros(weight.shape, np.float32)
+        # A channel at a time, so the weighted copy is one channel, not three
+        for channel in range(3):
+            total[..., channel] += image[..., channel] * weight
+        weights += weight
+        del image, weight
+    total /= weights[..., None]
+    fused = np.clip(total + 0.5, 0, 255).astype(np.uint8)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temporary = output_path + ".part"
+    Image.fromarray(fused).save(temporary, format="JPEG", quality=quality)
+    os.replace(temporary, output_path)
+    return output_path, len(paths), shifts, time.monotonic() - started
+
+# ===== Scheduling (runs in the capture process) =====
+class FocusStacker:
+    # Collects slices as they reach the disk and hands each well to a worker process once its stack is complete
+    # Wells are fused while the gantry is still imaging the rest of the plate
+    def __init__(self, output_dir, output_prefix, output_suffix, levels, workers=None, align=True, log=None,
+                 on_stacked=None, locate=None):
+        self.output_dir = output_dir
+        self.output_prefix = output_prefix
+        self.output_suffix = output_suffix
+        self.levels = set(levels)
+        self.align = align
+        self.log = log
+        self.on_stacked = on_stacked        # on_stacked(plate, well, path) from the collecting thread
+        self.locate = locate                # Maps an image path to its (shard, offset, size) when images are in tar shards
+        self.slices = {}                    # (plate, well) -> {level: path}
+        self.futures = []
+        self.stacked = []
+        self.errors = []
+        # Spawned, not forked: the capture process has camera and serial threads that a fork would copy mid-flight
+        self.workers = max(1, int(workers or 1))
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def add(self, plate, well, level, frame, path):
+        # Called from the image writer thread; of a burst, only the first frame of each level is stacked
+        if level not in self.levels or frame not in (None, 0):
+            return
+        key = (plate, int(well))
+        stack = self.slices.setdefault(key, {})
+        stack[level] = path
+        if len(stack) == len(self.levels):
+            self._submit(key, [stack[level] for level in sorted(stack)])
+            del self.slices[key]
+
+    def _submit(self, key, paths):
+        plate, well = key
+        output_path = stacked_path(self.output_dir, self.output_prefix, self.output_suffix, well, plate)
+        if os.path.exists(output_path):
+            return
+        if self.locate is not None:
+            paths = [self.locate(path) for path in paths]
+        future = self.pool.submit(fuse, paths, output_path, self.align)
+        future.add_done_callback(lambda future, key=key: self._done(key, future))
+        self.futures.append(future)
+
+    def _done(self, key, future):
+        plate, well = key
+        try:
+            path, count, shifts, seconds = future.result()
+        except Exception as e:
+            # A corrupt slice or a full disk loses that well's stacked image, not the run
+            self.errors.append((key, e))
+            if self.log:
+                self.log.error(f"Focus stack for well {well} failed: {e}")
+            return
+        self.stacked.append(path)
+        if self.log:
+            self.log.info(f"Stacked {count} slices of well {well} in {seconds:.1f} s -> {path}")
+        if self.on_stacked is not None:
+            self.on_stacked(plate, well, path)
+
+    def pending(self):
+        return sum(not future.done() for future in self.futures)
+
+    def close(self, cancel=False):
+        # Waits for every submitted well, or with cancel only for those already being fused; wells missing a slice are never stacked
+        self.pool.shutdown(wait=True, cancel_futures=cancel)
+        return self.stacked
+
+def stack_run(output_dir, workers=None, align=True, log=None):
+    # Stacks a finished (or interrupted) run from its journal, e.g. one captured with stacking off
+    import run_journal as rj
+    import image_container as ic
+
+    state = rj.load_journal(output_dir)
+    if state is None or state.settings is None:
+        raise FileNotFoundError(f"No run journal in {output_dir}")
+    settings = state.settings
+    levels = sorted({key[2] for key in state.files})
+    locate = ic.ContainerReader(output_dir).locate if settings.get("output_format") == "tar" else None
+    stacker = FocusStacker(output_dir, settings.get("output_prefix", ""), settings.get("output_suffix", ""), levels,
+                           workers, align, log, locate=locate)
+    for (plate, well, level), frames in state.files.items():
+        for frame, name in frames.items():
+            stacker.add(plate, well, level, frame, os.path.join(output_dir, name))
+    return stacker.close()
+
+def main():
+    from logger import Logger
+
+    parser = argparse.ArgumentParser(description="Fuse each well's z-stack of a finished run into one all-in-focus image")
+    parser.add_argument("output_dir", help="Run output folder, with its run_journal.jsonl")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, about 0.5 GB of RAM each at 12 MP (default: 1)")
+    parser.add_argument("--no-align", dest="align", action="store_false", help="Skip lining the slices up first")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    stacked = stack_run(args.output_dir, args.workers, args.align, Logger())
+    print(f"{len(stacked)} wells stacked in {time.monotonic() - started:.1f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import threading
+
+class WindowSignal:
+    # Looks like a threading.Event to worker threads, but setting it also wakes the GUI loop with an event
+    def __init__(self, window, key):
+        self.window = window
+        self.key = key
+        self.flag = threading.Event()
+
+    def set(self):
+        self.flag.set()
+        self.window.write_event_value(self.key, None)
+
+    def is_set(self):
+        return self.flag.is_set()
+
+    def clear(self):
+        self.flag.clear()
+
+class WidgetState:
+    # Remembers what each widget was last updated with, so repeated updates with the same values never reach Tk
+    def __init__(self, window):
+        self.window = window
+        self.applied = {}
+
+    def update(self, key, **kwargs):
+        applied = self.applied.setdefault(key, {})
+        changed = {name: value for name, value in kwargs.items() if applied.get(name, object()) != value}
+        if changed:
+            self.window[key].update(**changed)
+            applied.update(changed)
+        return bool(changed)
+
+    def forget(self, key):
+        # For widgets also changed outside this store, e.g. by the user typing
+        self.applied.pop(key, None)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Image container: a run's images appended to a few large tar shards instead of one file each
+Shards are plain uncompressed tar, so `tar -xf images-000.tar` works too; images.index.jsonl has each image's offset
+Usage: python image_container.py OUTPUT_DIR [--list] [--extract DEST] [--match 'well12_*'] [--reindex]
+"""
+import argparse
+import fnmatch
+import json
+import os
+import tarfile
+import threading
+import time
+from collections import namedtuple
+
+# files: one JPEG per image, as before; tar: appended to images-NNN.tar in the output folder
+OUTPUT_FORMATS = ("files", "tar")
+SHARD_PREFIX = "images-"
+SHARD_SUFFIX = ".tar"
+INDEX_NAME = "images.index.jsonl"
+
+Member = namedtuple("Member", ["name", "shard", "offset", "size"])     # offset: first byte of the image in the shard
+
+def shard_name(number):
+    return f"{SHARD_PREFIX}{number:03d}{SHARD_SUFFIX}"
+
+def shard_numbers(directory):
+    numbers = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        if name.startswith(SHARD_PREFIX) and name.endswith(SHARD_SUFFIX):
+            number = name[len(SHARD_PREFIX):-len(SHARD_SUFFIX)]
+            if number.isdigit():
+                numbers.append(int(number))
+    return sorted(numbers)
+
+def index_path(directory):
+    return os.path.join(directory, INDEX_NAME)
+
+def load_index(directory):
+    # name -> Member; entries past the end of their shard (data lost in a crash) and lines cut short are dropped
+    index = {}
+    path = index_path(directory)
+    if not os.path.exists(path):
+        return index
+    sizes = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                member = Member(**json.loads(line))
+            except (json.JSONDecodeError, TypeError):
+                continue
+            if member.shard not in sizes:
+                shard = os.path.join(directory, member.shard)
+                sizes[member.shard] = os.path.getsize(shard) if os.path.exists(shard) else 0
+            if member.offset + member.size <= sizes[member.shard]:
+                index[member.name] = member
+    return index
+
+def reindex(directory):
+    # Rebuilds the index from the shards themselves, e.g. after a crash left the index behind the data
+    index = {}
+    for number in shard_numbers(directory):
+        name = shard_name(number)
+        path = os.path.join(directory, name)
+        size = os.path.getsize(path)
+        try:
+            with tarfile.open(path, "r") as tar:
+                for info in tar:
+                    # The header of an image cut short is still read; only its data is missing
+                    if info.isfile() and info.offset_data + info.size <= size:
+                        index[info.name] = Member(info.name, name, info.offset_data, info.size)
+        except tarfile.ReadError:
+            # Shard cut short mid-image; everything before the cut has been read
+            pass
+    temporary = index_path(directory) + ".part"
+    with open(temporary, "w", encoding="utf-8") as f:
+        for member in index.values():
+            f.write(json.dumps(member._asdict()) + "\n")
+    os.replace(temporary, index_path(directory))
+    return index
+
+class ShardWriter:
+    # Appends images to the current shard and a line per image to the index, from the image writer thread
+    # Each run (or resume) starts a new shard, so a shard a crash cut short is never appended to
+    def __init__(self, directory, shard_size=1 << 30, sync_every=16, sync_interval=2.0):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.shard_size = int(shard_size)
+        self.sync_every = max(1, int(sync_every))
+        self.sync_interval = float(sync_interval)
+        self.index = load_index(directory)
+        numbers = shard_numbers(directory)
+        self.next_number = numbers[-1] + 1 if numbers else 0
+        self.lock = threading.Lock()
+        self.tar = None
+        self.shard = None
+        self.index_file = open(index_path(directory), "a", encoding="utf-8")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.timer = None
+
+    def _unique(self, name):
+        # Two images in the same second would share a timestamped name; the later one gets a counter
+        if name not in self.index:
+            return name
+        base, extension = os.path.splitext(name)
+        count = 1
+        while f"{base}_{count}{extension}" in self.index:
+            count += 1
+        return f"{base}_{count}{extension}"
+
+    def _next_shard(self):
+        if self.tar is not None:
+            self._sync()
+            self.tar.close()
+        self.shard = shard_name(self.next_number)
+        self.next_number += 1
+        self.tar = tarfile.open(os.path.join(self.directory, self.shard), "w", format=tarfile.PAX_FORMAT)
+
+    def append(self, name, file, size):
+        # Reads size bytes from file; returns where they went, under the name actually used
+        with self.lock:
+            name = self._unique(name)
+            if self.tar is None or (self.tar.offset > 0 and self.tar.offset + size > self.shard_size):
+                self._next_shard()
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(time.time())
+            self.tar.addfile(info, file)
+            # Data ends at the tar offset, padded to whole 512-byte blocks
+            padded = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            member = Member(name, self.shard, self.tar.offset - padded, size)
+            # Flushed, not synced: focus stacking reads the image back from another process straight away
+            self.tar.fileobj.flush()
+            self.index[name] = member
+            self.index_file.write(json.dumps(member._asdict()) + "\n")
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+            elif self.timer is None:
+                # The last images of a batch are synced within sync_interval too, even when no other image follows
+                self.timer = threading.Timer(self.sync_interval, self._sync_late)
+                self.timer.daemon = True
+                self.timer.start()
+            return member
+
+    def _sync_late(self):
+        with self.lock:
+            self.timer = None
+            if self.unsynced and not self.index_file.closed:
+                self._sync()
+
+    def _sync(self):
+        # Shard before index, so a synced index line never points past the synced data
+        if self.tar is not None:
+            self.tar.fileobj.flush()
+            os.fsync(self.tar.fileobj.fileno())
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def locate(self, path):
+        # (shard path, offset, size) of an image by the path the image writer reported
+        member = self.index[os.path.basename(path)]
+        return os.path.join(self.directory, member.shard), member.offset, member.size
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.index_file.closed:
+                return
+            self._sync()
+            if self.tar is not None:
+                self.tar.close()
+                self.tar = None
+            self.index_file.close()
+
+class ContainerReader:
+    # Random access to the images in an output folder's shards, by name
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = load_index(directory)
+
+    def names(self, pattern=None):
+        names = sorted(self.index)
+        return names if pattern is None else fnmatch.filter(names, pattern)
+
+    def locate(self, name):
+        member = self.index[os.path.basename(name)]
+        return os.path.join(self.directory, member.shard), member.offset, member.size
+
+    def read(self, name):
+        shard, offset, size = self.locate(name)
+        with open(shard, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def extract(self, destination, names=None):
+        # Writes the images out as ordinary files; shards are read in order, so each is one sequential pass
+        os.makedirs(destination, exist_ok=True)
+        names = self.names() if names is None else names
+        members = sorted((self.index[name] for name in names), key=lambda member: (member.shard, member.offset))
+        shard = None
+        file = None
+        try:
+            for member in members:
+                if member.shard != shard:
+                    if file is not None:
+                        file.close()
+                    shard = member.shard
+                    file = open(os.path.join(self.directory, shard), "rb")
+                file.seek(member.offset)
+                with open(os.path.join(destination, member.name), "wb") as out:
+                    out.write(file.read(member.size))
+        finally:
+            if file is not None:
+                file.close()
+        return len(members)
+
+def read_source(source):
+    # Bytes of an image given as a file path or a (shard path, offset, size) location
+    if isinstance(source, (tuple, list)):
+        shard, offset, size = source
+        with open(shard, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+    with open(source, "rb") as f:
+        return f.read()
+
+def main():
+    parser = argparse.ArgumentParser(description="List or extract the images of a run saved as tar shards")
+    parser.add_argument("output_dir", help="Run output folder, with images-NNN.tar and images.index.jsonl")
+    parser.add_argument("--list", action="store_true", help="Print each image with its shard, offset and size")
+    parser.add_argument("--extract", metavar="DEST", help="Write the images to DEST as ordinary files")
+    parser.add_argument("--match", default=None, help="Only images whose name matches this pattern, e.g. 'well12_*'")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the index by reading the shards")
+    args = parser.parse_args()
+
+    if args.reindex:
+        print(f"Indexed {len(reindex(args.output_dir))} images")
+    reader = ContainerReader(args.output_dir)
+    names = reader.names(args.match)
+    if args.list:
+        for name in names:
+            member = reader.index[name]
+            print(f"{member.shard}  {member.offset:>12}  {member.size:>9}  {name}")
+    if args.extract:
+        started = time.monotonic()
+        count = reader.extract(args.extract, names)
+        print(f"Extracted {count} images to {args.extract} in {time.monotonic() - started:.1f} s")
+    if not (args.list or args.extract or args.reindex):
+        print(f"{len(names)} images in {len(shard_numbers(args.output_dir))} shards")
+
+if __name__ == "__main__":
+    main()
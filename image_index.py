@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Image index: every capture in an output folder recorded in images.sqlite, with where, how and when it was taken
+Usage: python image_index.py OUTPUT_DIR [OUTPUT_DIR ...] [--well 12] [--level 0] [--since 2024-05-01] [--json]
+"""
+import argparse
+import json
+import os
+import pathlib
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+INDEX_NAME = "images.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started REAL,           -- Unix time
+    input_csv TEXT,
+    settings TEXT           -- RunSettings as JSON
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT,
+    plate TEXT,             -- Plate label from the CSV; NULL for a single-plate CSV
+    well INTEGER,
+    level INTEGER,          -- Z level, in zstack_step_distance steps from the planned (or focused) Z
+    frame INTEGER,          -- Index within a burst; NULL for single images
+    x REAL,                 -- Commanded position (mm)
+    y REAL,
+    z REAL,
+    z_offset REAL,          -- z minus the well's planned Z (mm)
+    shutter_speed INTEGER,  -- us
+    iso INTEGER,
+    width INTEGER,
+    height INTEGER,
+    camera TEXT,            -- Every camera setting as JSON
+    captured_at REAL,       -- Unix time the capture started
+    exposure REAL,          -- Exposure the camera reported (s)
+    written_at REAL,        -- Unix time the image was on disk
+    file TEXT,              -- File name, or the image's name in its shard
+    shard TEXT,             -- Tar shard holding the image; NULL for a loose file
+    offset INTEGER,         -- First byte of the image in the shard
+    size INTEGER,
+    checksum TEXT
+);
+CREATE INDEX IF NOT EXISTS images_well ON images (well, captured_at);
+CREATE INDEX IF NOT EXISTS images_run ON images (run_id, plate, well, level);
+"""
+
+COLUMNS = ("run_id", "plate", "well", "level", "frame", "x", "y", "z", "z_offset", "shutter_speed", "iso", "width",
+           "height", "camera", "captured_at", "exposure", "written_at", "file", "shard", "offset", "size", "checksum")
+
+def index_path(directory):
+    return os.path.join(directory, INDEX_NAME)
+
+def connect(directory):
+    connection = sqlite3.connect(index_path(directory), timeout=10)
+    # WAL lets a query run while a capture is adding rows
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+class ImageIndex:
+    # Rows are queued by the image writer thread and inserted by a thread of its own, many per transaction,
+    # so neither the capture loop nor the disk writes wait on SQLite
+    def __init__(self, directory, batch_size=64, interval=2.0):
+        self.directory = directory
+        self.batch_size = max(1, int(batch_size))
+        self.interval = float(interval)
+        self.rows = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self._work, name="ImageIndex", daemon=True)
+        self.thread.start()
+
+    def start_run(self, run_id, settings):
+        self.rows.put(("run", (run_id, time.time(), settings.get("input_csv"), json.dumps(settings))))
+
+    def add(self, **fields):
+        # Fields named as COLUMNS; missing ones are stored as NULL
+        self.rows.put(("image", tuple(fields.get(column) for column in COLUMNS)))
+
+    def _work(self):
+        try:
+            connection = connect(self.directory)
+        except sqlite3.Error as e:
+            self.errors.append(e)
+            connection = None
+        done = False
+        while not done:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self.rows.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    done = True
+                    break
+                batch.append(row)
+            if batch and connection is not None:
+                self._insert(connection, batch)
+        if connection is not None:
+            connection.close()
+
+    def _insert(self, connection, batch):
+        try:
+            with connection:
+                runs = [row for kind, row in batch if kind == "run"]
+                images = [row for kind, row in batch if kind == "image"]
+                if runs:
+                    connection.executemany("INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?)", runs)
+                if images:
+                    connection.executemany(f"INSERT INTO images ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                                           images)
+        except sqlite3.Error as e:
+            # A locked or full database loses these rows from the index, not the images themselves
+            self.errors.append(e)
+
+    def close(self):
+        # Waits for every queued row to be committed
+        self.rows.put(None)
+        self.thread.join()
+
+def query(directory, well=None, plate=None, level=None, run_id=None, since=None, until=None):
+    # Matching images as dicts, oldest first; since and until are Unix times
+    path = index_path(directory)
+    if not os.path.exists(path):
+        return []
+    conditions = []
+    values = []
+    for column, value in (("well", well), ("plate", plate), ("level", level), ("run_id", run_id)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            values.append(value)
+    if since is not None:
+        conditions.append("captured_at >= ?")
+        values.append(since)
+    if until is not None:
+        conditions.append("captured_at < ?")
+        values.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # Read-only needs a URI; as_uri() escapes ?, # and % in the folder name
+    connection = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(f"SELECT * FROM images {where} ORDER BY captured_at, id", values).fetchall()
+    finally:
+        connection.close()
+    return [dict(row, directory=directory) for row in rows]
+
+def location(row):
+    # A file path, or (shard path, offset, size) for an image in a tar shard; image_container.read_source reads either
+    if row["shard"]:
+        return os.path.join(row["directory"], row["shard"]), row["offset"], row["size"]
+    return os.path.join(row["directory"], row["file"])
+
+def _timestamp(text):
+    return datetime.fromisoformat(text).timestamp()
+
+def main():
+    parser = argparse.ArgumentParser(description="Find captures in the image index of one or more output folders")
+    parser.add_argument("output_dirs", nargs="+", help="Output folders with an images.sqlite")
+    parser.add_argument("--well", type=int)
+    parser.add_argument("--plate", help="Plate label, as in the CSV")
+    parser.add_argument("--level", type=int, help="Z level")
+    parser.add_argument("--run", dest="run_id", help="Run id")
+    parser.add_argument("--since", type=_timestamp, help="Captured at or after, e.g. 2024-05-01 or 2024-05-01T12:00")
+    parser.add_argument("--until", type=_timestamp, help="Captured before")
+    parser.add_argument("--json", action="store_true", help="One JSON object per image instead of its location")
+    parser.add_argument("--count", action="store_true", help="Only print how many images match")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    rows = []
+    for directory in args.output_dirs:
+        rows += query(directory, args.well, args.plate, args.level, args.run_id, args.since, args.until)
+    if args.count:
+        print(len(rows))
+        return
+    for row in rows:
+        if args.json:
+            print(json.dumps(row))
+        else:
+            place = location(row)
+            print(place if isinstance(place, str) else f"{place[0]}@{place[1]}+{place[2]}")
+    print(f"{len(rows)} images in {(time.monotonic() - started) * 1000:.0f} ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import queue
+import threading
+from io import BytesIO
+
+class ImageWriter:
+    # Captures go into pooled in-memory buffers; background threads write them out while the gantry moves on
+    def __init__(self, buffer_count=4, worker_count=1, log=None, container=None, checksum=None):
+        self.log = log
+        self.container = container      # A ShardWriter appends images to tar shards instead of one file each
+        self.checksum = checksum        # hashlib name, e.g. "sha256"; each image's digest is passed on to on_written
+        if checksum:
+            hashlib.new(checksum)       # An unknown name fails here, not on the writer thread
+        self.free_buffers = queue.Queue()
+        for _ in range(max(1, int(buffer_count))):
+            self.free_buffers.put(BytesIO())
+        self.jobs = queue.Queue()
+        self.created_dirs = set()
+        self.written = 0
+        self.errors = []
+        self.workers = []
+        for i in range(max(1, int(worker_count))):
+            worker = threading.Thread(target=self._work, name=f"ImageWriter{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def acquire(self):
+        # Blocks while every buffer is still waiting to be written, which holds the capture loop back
+        buffer = self.free_buffers.get()
+        buffer.seek(0)
+        buffer.truncate()
+        return buffer
+
+    def release(self, buffer):
+        # Return a buffer that was acquired but never submitted
+        self.free_buffers.put(buffer)
+
+    def submit(self, buffer, path, on_written=None):
+        self.jobs.put((buffer, path, on_written))
+
+    def pending(self):
+        return self.jobs.qsize()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            buffer, path, on_written = job
+            written = False
+            try:
+                # on_written(path, size, checksum) once the image is on disk; checksum is None unless asked for
+                with buffer.getbuffer() as data:
+                    size = data.nbytes
+                    checksum = hashlib.new(self.checksum, data).hexdigest() if self.checksum else None
+                if self.container is not None:
+                    buffer.seek(0)
+                    member = self.container.append(os.path.basename(path), buffer, size)
+                    path = os.path.join(os.path.dirname(path), member.name)
+                else:
+                    directory = os.path.dirname(path)
+                    if directory not in self.created_dirs:
+                        os.makedirs(directory, exist_ok=True)
+                        self.created_dirs.add(directory)
+                    with open(path, 'wb') as file, buffer.getbuffer() as data:
+                        file.write(data)
+                self.written += 1
+                written = True
+            except Exception as e:
+                self.errors.append((path, e))
+                if self.log:
+                    self.log.error(f"Failed to write {path}: {e}")
+            finally:
+                # Back in the pool whatever happened, or the next acquire() would wait forever
+                self.free_buffers.put(buffer)
+            if written and on_written is not None:
+                try:
+                    on_written(path, size, checksum)
+                except Exception as e:
+                    # The image is on disk; a failing journal, stacker or index must not stop the writer thread
+                    self.errors.append((path, e))
+                    if self.log:
+                        self.log.error(f"Failed to record {path}: {e}")
+
+    def close(self):
+        # Waits for every submitted image to be written
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,15 +1,42 @@
 import csv
+from collections import namedtuple
 
 from datetime import datetime
 
+# One imaging location; well (and plate, when the CSV has one) travels with it whatever order it is visited in
+Waypoint = namedtuple("Waypoint", ["well", "x", "y", "z", "plate"], defaults=[None])
+
 def load_gcode_from_csv(csv_file):
     with open(csv_file, newline="") as f:
         reader = csv.DictReader(f)
         return [f"G0X{row['X']}Y{row['Y']}Z{row['Z']}" for row in reader]
 
-def get_photo_path(output_directory, output_prefix, output_suffix, well_number, z_lvl=0):
+def load_waypoints_from_csv(csv_file, num_cols):
+    waypoints = []
+    with open(csv_file, newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            if row.get('well'):
+                well = int(row['well'])
+            else:
+                # Older CSVs only number the serpentine visiting order, so undo the snake on odd rows
+                cycle = int(row['cycle'])
+                r = (cycle - 1) // num_cols
+                well = cycle if r % 2 == 0 else r * num_cols + (num_cols - (cycle - 1) % num_cols)
+            waypoints.append(Waypoint(well, float(row['X']), float(row['Y']), float(row['Z']), row.get('plate') or None))
+    return waypoints
+
+def waypoint_gcode(waypoint, z_offset=0.0):
+    return f"G0X{waypoint.x}Y{waypoint.y}Z{round(waypoint.z + z_offset, 3)}"
+
+def get_photo_path(output_directory, output_prefix, output_suffix, well_number, z_lvl=None, plate=None, frame=None):
     current_time = datetime.now()
     timestamp = current_time.strftime("%Y-%m-%d_%H%M%S")
-    filename = f"{output_prefix}well{well_number}_{timestamp}{output_suffix}.jpg"
+    # Z-stack level sits right after the well so a well's slices sort together
+    z_part = f"_z{z_lvl:+d}" if z_lvl is not None else ""
+    # Burst frames share a timestamp, so their index keeps the names apart
+    z_part += f"_f{frame}" if frame is not None else ""
+    plate_part = f"plate{plate}_" if plate is not None else ""
+    filename = f"{output_prefix}{plate_part}well{well_number}{z_part}_{timestamp}{output_suffix}.jpg"
     full_path = f"{output_directory}/{filename}"
-    return full_path
\ No newline at end of file
+    return full_path
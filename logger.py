@@ -0,0 +1,46 @@
+import json
+import sys
+import threading
+import time
+
+class Logger:
+    def __init__(self, verbose=True, output=print):
+        self.verbose = verbose
+        self.output = output    # Called with each message, from whichever thread logged it
+
+    # Verbose mode logger
+    def log(self, msg, level="INFO"):
+        if self.verbose:
+            self.output(f"[{level}] {msg}")
+    
+    def info(self, msg): self.log(msg, "INFO")
+    def debug(self, msg): self.log(msg, "DEBUG")
+    def warn(self, msg): self.log(msg, "WARNING")
+    def error(self, msg): self.log(msg, "ERROR")
+
+    # Regular print message
+    def say(self, msg): self.output(msg)
+
+class JsonLogger:
+    # Same calls as Logger, but every message and progress event is one JSON object per line, for scripts to parse
+    def __init__(self, verbose=True, stream=None):
+        self.verbose = verbose
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps({"time": round(time.time(), 3), "event": event, **fields}, default=str)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def log(self, msg, level="INFO"):
+        if self.verbose:
+            self.emit("log", level=level, message=str(msg))
+
+    def info(self, msg): self.log(msg, "INFO")
+    def debug(self, msg): self.log(msg, "DEBUG")
+    def warn(self, msg): self.log(msg, "WARNING")
+    def error(self, msg): self.log(msg, "ERROR")
+
+    def say(self, msg): self.emit("message", message=str(msg))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Motion-time estimator and dry-run planner for capture runs
+Usage: python motion_estimator.py snakepath_file.csv --zstack 2 --per-well
+"""
+import argparse
+import math
+import time
+
+from config import config as cfg
+import capture_plan as cp
+import burst_capture as bc
+import motion_profiles as mprof
+
+def trapezoid_time(distance, feedrate, acceleration):
+    # Time for a move that starts and ends at rest, accelerating up to feedrate if the distance allows it (mm, mm/s, mm/s^2)
+    if distance <= 0:
+        return 0.0
+    if distance >= feedrate * feedrate / acceleration:
+        return distance / feedrate + feedrate / acceleration
+    return 2 * math.sqrt(distance / acceleration)
+
+def move_time(start, end, feedrate, max_feedrate=None, acceleration=None, max_acceleration=None):
+    # Marlin scales a move's feedrate and acceleration down until no single axis exceeds its limit (mm/s, mm/s^2)
+    max_feedrate = max_feedrate or cfg.max_feedrate
+    max_acceleration = max_acceleration or cfg.max_acceleration
+    acceleration = acceleration or cfg.acceleration
+    deltas = [b - a for a, b in zip(start, end)]
+    distance = math.sqrt(sum(d * d for d in deltas))
+    if distance == 0:
+        return 0.0
+    feedrate = min(feedrate, cfg.max_speed)
+    for delta, axis_feedrate, axis_acceleration in zip(deltas, max_feedrate, max_acceleration):
+        if delta:
+            share = abs(delta) / distance
+            feedrate = min(feedrate, axis_feedrate / share)
+            acceleration = min(acceleration, axis_acceleration / share)
+    return trapezoid_time(distance, feedrate, acceleration)
+
+class RunEstimate:
+    PHASES = ("clearing", "travel", "z_steps", "autofocus", "settle", "exposure", "capture_overhead", "margin")
+
+    def __init__(self):
+        self.phases = {phase: 0.0 for phase in self.PHASES}
+        self.shot_times = []        # Predicted seconds per shot, move included
+        self.setup_time = 0.0       # Clearing and the move to the first well
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def remaining(self, shots_done):
+        return sum(self.shot_times[shots_done:])
+
+    def report(self):
+        lines = [f"Estimated run time: {format_duration(self.total)} for {len(self.shot_times)} shots"]
+        for phase, seconds in self.phases.items():
+            if seconds:
+                lines.append(f"  {phase.replace('_', ' ').capitalize():<18}{format_duration(seconds):>10}  ({seconds / self.total * 100:4.1f}%)")
+        return lines
+
+def estimate_run(shots, start, preview_mode, shutter_speed, step_distance=None, move_sleep_time=None,
+                 sleep_after_capture=None, profile=None, capture_port=None, frames_per_shot=None, autofocus_time=0.0):
+    # Mirrors run_capture's sequence: clear, move to the first well, then a move (XY or Z step) and capture per shot
+    step_distance = cfg.zstack_step_distance if step_distance is None else step_distance
+    move_sleep_time = float(cfg.move_sleep_time) if move_sleep_time is None else move_sleep_time
+    sleep_after_capture = cfg.sleep_after_capture if sleep_after_capture is None else sleep_after_capture
+    profile = profile or mprof.get_profile()
+    capture_port = capture_port or cfg.capture_port
+    frames_per_shot = frames_per_shot or cfg.frames_per_shot
+    exposure = shutter_speed / 1_000_000
+    overhead = bc.capture_overhead(capture_port, cfg.framerate, cfg.settle_frames, cfg.capture_overhead)
+    margin = exposure * float(cfg.sleep_multiplier) + float(cfg.sleep_addition) if sleep_after_capture else 0.0
+
+    estimate = RunEstimate()
+    cleared = (start[0], start[1], start[2] + cfg.clear_height)
+    estimate.phases["clearing"] = move_time(start, cleared, cfg.clear_feedrate / 60)
+    if not shots:
+        return estimate
+    first = cp.shot_position(cp.Shot(shots[0].cycle, shots[0].waypoint, 0), step_distance)
+    feedrate, acceleration = profile.for_move(cleared, first)
+    estimate.phases["travel"] = move_time(cleared, first, feedrate / 60, acceleration=acceleration)
+    estimate.setup_time = estimate.total
+
+    position = first
+    previous_shot = None
+    for shot in shots:
+        target = cp.shot_position(shot, step_distance)
+        feedrate, acceleration = profile.for_move(position, target)
+        seconds = move_time(position, target, feedrate / 60, acceleration=acceleration)
+        estimate.phases["z_steps" if cp.is_z_step(previous_shot, shot) else "travel"] += seconds
+        if not preview_mode:
+            for phase, phase_seconds in (("autofocus", autofocus_time), ("settle", move_sleep_time), ("exposure", exposure * frames_per_shot),
+                                         ("capture_overhead", overhead * frames_per_shot), ("margin", margin)):
+                estimate.phases[phase] += phase_seconds
+                seconds += phase_seconds
+        estimate.shot_times.append(seconds)
+        position = target
+        previous_shot = shot
+    return estimate
+
+class EtaTracker:
+    # Remaining time from the estimate, rescaled by how the run has kept up with its prediction so far
+    def __init__(self, estimate):
+        self.estimate = estimate
+        self.started = time.monotonic()
+
+    def eta(self, shots_done):
+        elapsed = time.monotonic() - self.started
+        predicted = self.estimate.setup_time + sum(self.estimate.shot_times[:shots_done])
+        pace = elapsed / predicted if predicted > 0 and shots_done else 1.0
+        return self.estimate.remaining(shots_done) * pace
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+def main():
+    import io_helper as ioh
+
+    parser = argparse.ArgumentParser(description="Estimate how long a capture run will take")
+    parser.add_argument("csv", nargs="?", default=cfg.input_csv)
+    parser.add_argument("--zstack", type=int, default=0, help="Z-stack levels above and below the path (0 for none)")
+    parser.add_argument("--per-well", action="store_true", default=cfg.zstack_per_well)
+    parser.add_argument("--plate-major", dest="per_well", action="store_false", help="Whole plate once per z level")
+    parser.add_argument("--preview", action="store_true", help="Moves only, no captures")
+    parser.add_argument("--shutter", type=int, default=cfg.shutter, help="Shutter speed (us)")
+    parser.add_argument("--port", default=cfg.capture_port, choices=bc.CAPTURE_PORTS, help="Camera port used for captures")
+    parser.add_argument("--frames", type=int, default=cfg.frames_per_shot, help="Images per well and z level")
+    parser.add_argument("--profile", default=cfg.motion_profile, choices=mprof.profile_names(), help="Motion profile")
+    parser.add_argument("--start", type=float, nargs=3, default=(0.0, 0.0, 0.0), metavar=("X", "Y", "Z"))
+    args = parser.parse_args()
+
+    waypoints = ioh.load_waypoints_from_csv(args.csv, int(cfg.num_cols))
+    start = tuple(args.start)
+    profile = mprof.get_profile(args.profile)
+    waypoints, shots = cp.plan_capture(waypoints, start, args.zstack, args.per_well, cfg.optimize_path,
+                                       cfg.clear_height, profile.hop_feedrate, cfg.max_feedrate)
+    estimate = estimate_run(shots, start, args.preview, args.shutter, profile=profile,
+                            capture_port=args.port, frames_per_shot=args.frames)
+    for line in estimate.report():
+        print(line)
+
+if __name__ == "__main__":
+    main()
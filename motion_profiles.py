@@ -0,0 +1,58 @@
+import math
+
+from config import config as cfg
+
+class MotionProfile:
+    # Picks feedrate (mm/min) and travel acceleration (mm/s^2) for each move from its length and axes
+    def __init__(self, name, hop_feedrate=800, hop_acceleration=500, travel_feedrate=800, travel_acceleration=500,
+                 z_feedrate=800, z_acceleration=100, long_move=30):
+        self.name = name
+        self.hop_feedrate = hop_feedrate                # Short well-to-well moves
+        self.hop_acceleration = hop_acceleration
+        self.travel_feedrate = travel_feedrate          # Moves of at least long_move mm, like row changes
+        self.travel_acceleration = travel_acceleration
+        self.z_feedrate = z_feedrate                    # Z-only moves, like z-stack steps
+        self.z_acceleration = z_acceleration
+        self.long_move = long_move
+
+    def for_move(self, start, end):
+        dx, dy, dz = (b - a for a, b in zip(start, end))
+        xy_distance = math.hypot(dx, dy)
+        if xy_distance == 0:
+            feedrate, acceleration = self.z_feedrate, self.z_acceleration
+        elif xy_distance >= self.long_move:
+            feedrate, acceleration = self.travel_feedrate, self.travel_acceleration
+        else:
+            feedrate, acceleration = self.hop_feedrate, self.hop_acceleration
+        return self.limit(feedrate, acceleration, (dx, dy, dz))
+
+    def for_jog(self, axis, step_size):
+        # Manual jogs are single-axis relative moves
+        end = [step_size if a == axis else 0.0 for a in ("X", "Y", "Z")]
+        return self.for_move((0.0, 0.0, 0.0), end)
+
+    def limit(self, feedrate, acceleration, deltas):
+        # Keep within config.yaml's max speed and the firmware's per-axis limits
+        feedrate = min(feedrate, float(cfg.max_speed) * 60)
+        distance = math.sqrt(sum(d * d for d in deltas))
+        for delta, axis_feedrate, axis_acceleration in zip(deltas, cfg.max_feedrate, cfg.max_acceleration):
+            if delta and distance:
+                share = abs(delta) / distance
+                feedrate = min(feedrate, axis_feedrate * 60 / share)
+                acceleration = min(acceleration, axis_acceleration / share)
+        return round(feedrate), round(acceleration)
+
+    def axis_limits_gcode(self):
+        # M201 caps Z acceleration for the run; X/Y keep the configured limits
+        max_x, max_y, max_z = cfg.max_acceleration
+        return f"M201 X{max_x:.0f} Y{max_y:.0f} Z{min(self.z_acceleration, max_z):.0f}"
+
+def profile_names():
+    return list(cfg.motion_profiles.keys())
+
+def get_profile(name=None):
+    # legacy is always there, as the MotionProfile defaults; any other name has to be in config.yaml
+    name = name or cfg.motion_profile
+    if name not in cfg.motion_profiles and name != "legacy":
+        raise ValueError(f"Unknown motion profile '{name}', expected one of {', '.join(profile_names())}")
+    return MotionProfile(name, **cfg.motion_profiles.get(name, {}))
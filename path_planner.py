@@ -0,0 +1,66 @@
+import numpy as np
+
+def travel_time_matrix(points, feedrate, max_feedrate):
+    # Estimated seconds between every pair of points (N x 3, mm)
+    # A G0 runs at feedrate along its path unless one axis would exceed its own limit (mm/s)
+    deltas = np.abs(points[:, None, :] - points[None, :, :])
+    distance = np.sqrt((deltas ** 2).sum(axis=2))
+    axis_times = deltas / np.asarray(max_feedrate, dtype=float)
+    return np.maximum(distance / feedrate, axis_times.max(axis=2))
+
+def path_time(order, costs):
+    # Travel time of an open path through costs, where index 0 is the fixed start
+    route = np.concatenate(([0], order))
+    return float(costs[route[:-1], route[1:]].sum())
+
+def _nearest_neighbour(costs):
+    n = len(costs)
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    order = []
+    current = 0
+    for _ in range(n - 1):
+        candidates = np.where(visited, np.inf, costs[current])
+        current = int(np.argmin(candidates))
+        visited[current] = True
+        order.append(current)
+    return np.array(order, dtype=int)
+
+def _two_opt(order, costs, max_passes):
+    # Reverse segments while that shortens the path; the end of the path is free, so reversing a tail costs one edge
+    route = np.concatenate(([0], order))
+    n = len(route)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a, b = route[i - 1], route[i]
+            j = np.arange(i + 1, n)
+            c = route[j]
+            d_next = np.append(route[j[:-1] + 1], -1)
+            removed = costs[a, b] + np.where(d_next >= 0, costs[c, d_next], 0.0)
+            added = costs[a, c] + np.where(d_next >= 0, costs[b, d_next], 0.0)
+            gains = removed - added
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                route[i:j[best] + 1] = route[i:j[best] + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return route[1:]
+
+def plan_path(waypoints, start, feedrate, max_feedrate, max_passes=20):
+    # Visiting order for waypoints (anything with x/y/z) that minimises estimated travel time from start
+    # Nearest neighbour and the given order are both improved with 2-opt; the faster one wins
+    if len(waypoints) < 3:
+        return list(waypoints)
+    points = np.array([start] + [(w.x, w.y, w.z) for w in waypoints], dtype=float)
+    costs = travel_time_matrix(points, feedrate, max_feedrate)
+
+    candidates = [np.arange(1, len(points)), _nearest_neighbour(costs)]
+    best = min((_two_opt(order, costs, max_passes) for order in candidates), key=lambda order: path_time(order, costs))
+    return [waypoints[i - 1] for i in best]
+
+def estimate_path_time(waypoints, start, feedrate, max_feedrate):
+    points = np.array([start] + [(w.x, w.y, w.z) for w in waypoints], dtype=float)
+    costs = travel_time_matrix(points, feedrate, max_feedrate)
+    return path_time(np.arange(1, len(points)), costs)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Well centers for any plate format from a few measured wells, in one vectorized pass
+Usage: python plate_geometry.py --format 384 --corners TLX TLY TLZ TRX TRY TRZ BLX BLY BLZ BRX BRY BRZ [--model projective] [--output plate.csv]
+"""
+import argparse
+import csv
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# Standard SBS formats: wells -> (rows, columns)
+PLATE_FORMATS = {6: (2, 3), 12: (3, 4), 24: (4, 6), 48: (6, 8), 96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+# bilinear: XYZ blended between the four corners, as the CSV generator always did
+# projective: XY through a homography, for a camera or plate that is not square to the gantry; Z bilinear
+# affine_plane: XY affine and Z a flat tilted plane, least squares over three or more measured wells
+MODELS = ("bilinear", "projective", "affine_plane")
+ORDERS = ("serpentine", "row_major")
+
+# Measured well centers, ((row, col, x, y, z), ...) with row and col from 0; hashable, so results are cached per calibration
+PlateCalibration = namedtuple("PlateCalibration", ["rows", "cols", "points", "model"], defaults=["bilinear"])
+
+WAYPOINT_DTYPE = np.dtype([("cycle", np.int32), ("plate", "U16"), ("well", np.int32),
+                           ("x", np.float64), ("y", np.float64), ("z", np.float64)])
+
+def plate_format(wells):
+    try:
+        return PLATE_FORMATS[int(wells)]
+    except KeyError:
+        raise ValueError(f"Unknown plate format {wells}, expected one of {', '.join(map(str, PLATE_FORMATS))}") from None
+
+def corner_calibration(rows, cols, tl, tr, bl, br, model="bilinear"):
+    corners = ((0, 0, *tl), (0, cols - 1, *tr), (rows - 1, 0, *bl), (rows - 1, cols - 1, *br))
+    return PlateCalibration(int(rows), int(cols), tuple(tuple(float(v) for v in point) for point in corners), model)
+
+def _grid_uv(rows, cols, row, col):
+    # Row and column scaled to 0..1 across the plate; a single row or column sits at 0
+    return (np.asarray(col, dtype=float) / max(cols - 1, 1), np.asarray(row, dtype=float) / max(rows - 1, 1))
+
+def _lstsq(basis, values, name, minimum):
+    if len(basis) < minimum or np.linalg.matrix_rank(basis) < basis.shape[1]:
+        raise ValueError(f"{name} needs at least {minimum} measured wells that are not all in one row or column")
+    return np.linalg.lstsq(basis, values, rcond=None)[0]
+
+def _bilinear_basis(u, v):
+    return np.stack([np.ones_like(u), u, v, u * v], axis=-1)
+
+def _homography(u, v, x, y):
+    # Direct linear transform; with exactly four wells it passes through them, with more it is a least-squares fit
+    # XY is centred and scaled to about 1 first, otherwise mm and 0..1 grid units make the system badly conditioned
+    center = np.array([x.mean(), y.mean()])
+    scale = max(float(np.hypot(x - center[0], y - center[1]).mean()), 1e-9)
+    xn, yn = (x - center[0]) / scale, (y - center[1]) / scale
+    zeros, ones = np.zeros_like(u), np.ones_like(u)
+    rows = np.concatenate([np.stack([u, v, ones, zeros, zeros, zeros, -xn * u, -xn * v, -xn], axis=1),
+                           np.stack([zeros, zeros, zeros, u, v, ones, -yn * u, -yn * v, -yn], axis=1)])
+    if len(u) < 4 or np.linalg.matrix_rank(rows) < 8:
+        raise ValueError("projective needs at least 4 measured wells, no three of them in a line")
+    h = np.linalg.svd(rows)[2][-1].reshape(3, 3)
+    denormalize = np.array([[scale, 0, center[0]], [0, scale, center[1]], [0, 0, 1]])
+    return denormalize @ h
+
+def _fit(calibration):
+    # Returns predict(u, v) -> (N, 3) for the calibration's model
+    points = np.asarray(calibration.points, dtype=float).reshape(-1, 5)
+    u, v = _grid_uv(calibration.rows, calibration.cols, points[:, 0], points[:, 1])
+    xyz = points[:, 2:]
+    if calibration.model not in MODELS:
+        raise ValueError(f"Unknown plate model '{calibration.model}', expected one of {', '.join(MODELS)}")
+    if calibration.rows == 1 or calibration.cols == 1:
+        # A single row or column is a line between its measured wells whatever the model; a single well is itself
+        # The other axis sits at 0, so u + v is the position along the line
+        terms = 1 if calibration.rows * calibration.cols == 1 else 2
+        line_basis = lambda u, v: np.stack([np.ones_like(u), u + v], axis=-1)[:, :terms]
+        coefficients = _lstsq(line_basis(u, v), xyz, "A single row or column", terms)
+        return lambda u, v: line_basis(u, v) @ coefficients
+    if calibration.model == "bilinear":
+        coefficients = _lstsq(_bilinear_basis(u, v), xyz, "bilinear", 4)
+        return lambda u, v: _bilinear_basis(u, v) @ coefficients
+    if calibration.model == "projective":
+        h = _homography(u, v, xyz[:, 0], xyz[:, 1])
+        z_coefficients = _lstsq(_bilinear_basis(u, v), xyz[:, 2], "projective Z", 4)
+        def predict(u, v):
+            mapped = np.stack([u, v, np.ones_like(u)], axis=-1) @ h.T
+            return np.column_stack([mapped[:, :2] / mapped[:, 2:], _bilinear_basis(u, v) @ z_coefficients])
+        return predict
+    if calibration.model == "affine_plane":
+        xy_coefficients = _lstsq(np.column_stack([u, v, np.ones_like(u)]), xyz[:, :2], "affine_plane", 3)
+        plane = _lstsq(np.column_stack([xyz[:, :2], np.ones_like(u)]), xyz[:, 2], "affine_plane Z", 3)
+        def predict(u, v):
+            xy = np.stack([u, v, np.ones_like(u)], axis=-1) @ xy_coefficients
+            return np.column_stack([xy, np.column_stack([xy, np.ones_like(u)]) @ plane])
+        return predict
+
+@lru_cache(maxsize=32)
+def well_centers(calibration):
+    # (rows * cols, 3) XYZ in well order, well n at index n - 1; read-only, since the same array is handed out again
+    rows, cols = calibration.rows, calibration.cols
+    row, col = np.divmod(np.arange(rows * cols), cols)
+    centers = _fit(calibration)(*_grid_uv(rows, cols, row, col))
+    centers.flags.writeable = False
+    return centers
+
+def residuals(calibration):
+    # Distance (mm) from each measured well to where the model puts it; zero when the model passes through them
+    points = np.asarray(calibration.points, dtype=float).reshape(-1, 5)
+    wells = (points[:, 0] * calibration.cols + points[:, 1]).astype(int)
+    return np.linalg.norm(well_centers(calibration)[wells] - points[:, 2:], axis=1)
+
+def visiting_order(rows, cols, order="serpentine"):
+    # Well indices (from 0) in the order they are imaged; serpentine reverses every other row
+    grid = np.arange(rows * cols).reshape(rows, cols)
+    if order == "serpentine":
+        grid[1::2] = grid[1::2, ::-1]
+    elif order != "row_major":
+        raise ValueError(f"Unknown well order '{order}', expected one of {', '.join(ORDERS)}")
+    return grid.ravel()
+
+def plate_waypoints(calibration, plate=None, order="serpentine", decimals=3):
+    # In-memory waypoint array for one plate, in visiting order
+    indices = visiting_order(calibration.rows, calibration.cols, order)
+    centers = np.round(well_centers(calibration)[indices], decimals)
+    waypoints = np.zeros(len(indices), dtype=WAYPOINT_DTYPE)
+    waypoints["cycle"] = np.arange(1, len(indices) + 1)
+    waypoints["plate"] = "" if plate is None else str(plate)
+    waypoints["well"] = indices + 1
+    waypoints["x"], waypoints["y"], waypoints["z"] = centers.T
+    return waypoints
+
+def layout_waypoints(plates, order="serpentine", decimals=3):
+    # Several plates on the bed, [(label, calibration), ...], imaged one after another
+    waypoints = np.concatenate([plate_waypoints(calibration, label, order, decimals) for label, calibration in plates])
+    waypoints["cycle"] = np.arange(1, len(waypoints) + 1)
+    return waypoints
+
+def to_waypoints(waypoints):
+    # The capture engine's own Waypoint tuples, so a computed plate can be run without writing a CSV first
+    from io_helper import Waypoint
+
+    return [Waypoint(int(w["well"]), float(w["x"]), float(w["y"]), float(w["z"]), str(w["plate"]) or None)
+            for w in waypoints]
+
+def write_csv(waypoints, filename):
+    # Same columns the capture CSV reader expects; plate only when there is more than the one unnamed plate
+    with_plate = bool(np.any(waypoints["plate"] != ""))
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['cycle', 'well', 'X', 'Y', 'Z'] + (['plate'] if with_plate else []))
+        for w in waypoints:
+            writer.writerow([int(w["cycle"]), int(w["well"]), float(w["x"]), float(w["y"]), float(w["z"])]
+                            + ([str(w["plate"])] if with_plate else []))
+
+def validate(plates, limits=None):
+    # Problems that would crash the gantry or image the wrong wells; empty when the layout looks right
+    # limits: (max_x, max_y, max_z) travel in mm
+    problems = []
+    boxes = []
+    for label, calibration in plates:
+        name = f"Plate {label}" if label is not None else "Plate"
+        centers = well_centers(calibration)
+        if not np.all(np.isfinite(centers)):
+            problems.append(f"{name}: calibration does not map every well (measured wells in a line?)")
+            continue
+        if limits is not None:
+            outside = np.any((centers < 0) | (centers > np.asarray(limits, dtype=float)), axis=1)
+            if outside.any():
+                problems.append(f"{name}: {int(outside.sum())} wells outside travel limits, first is well {int(np.argmax(outside)) + 1}")
+        grid = centers.reshape(calibration.rows, calibration.cols, 3)[:, :, :2]
+        if calibration.rows > 1 and calibration.cols > 1:
+            # Cell orientation flips where the plate folds over, e.g. two corners saved the wrong way round
+            across = grid[:-1, 1:] - grid[:-1, :-1]
+            down = grid[1:, :-1] - grid[:-1, :-1]
+            turn = np.sign(across[..., 0] * down[..., 1] - across[..., 1] * down[..., 0])
+            if not (np.all(turn > 0) or np.all(turn < 0)):
+                problems.append(f"{name}: wells cross over, check the corner order")
+        error = residuals(calibration).max()
+        if error > 0.5:
+            problems.append(f"{name}: measured wells are up to {error:.2f} mm off the {calibration.model} fit")
+        flat = grid.reshape(-1, 2)
+        boxes.append((name, flat.min(axis=0), flat.max(axis=0)))
+    for i, (name_a, low_a, high_a) in enumerate(boxes):
+        for name_b, low_b, high_b in boxes[i + 1:]:
+            if np.all(low_a <= high_b) and np.all(low_b <= high_a):
+                problems.append(f"{name_a} and {name_b} overlap")
+    return problems
+
+def load_points(filename):
+    # CSV of measured wells with row, col (from 0) and X, Y, Z columns
+    with open(filename, newline='') as f:
+        return tuple((int(row['row']), int(row['col']), float(row['X']), float(row['Y']), float(row['Z']))
+                     for row in csv.DictReader(f))
+
+def main():
+    from config import config as cfg
+
+    parser = argparse.ArgumentParser(description="Compute and check well positions for a plate")
+    parser.add_argument("--format", type=int, default=None, help=f"Wells per plate ({', '.join(map(str, PLATE_FORMATS))}); default from config.yaml")
+    parser.add_argument("--corners", type=float, nargs=12, metavar="MM", help="XYZ of the top-left, top-right, bottom-left and bottom-right wells")
+    parser.add_argument("--points", help="CSV of measured wells (row, col, X, Y, Z) instead of --corners")
+    parser.add_argument("--model", choices=MODELS, default="bilinear")
+    parser.add_argument("--order", choices=ORDERS, default="serpentine")
+    parser.add_argument("--output", help="Write the waypoint CSV here")
+    args = parser.parse_args()
+
+    rows, cols = plate_format(args.format) if args.format else (cfg.num_rows, cfg.num_cols)
+    if args.points:
+        calibration = PlateCalibration(rows, cols, load_points(args.points), args.model)
+    elif args.corners:
+        c = args.corners
+        calibration = corner_calibration(rows, cols, c[0:3], c[3:6], c[6:9], c[9:12], args.model)
+    else:
+        parser.error("one of --corners or --points is required")
+
+    started = time.perf_counter()
+    waypoints = plate_waypoints(calibration, order=args.order)
+    problems = validate([(None, calibration)], (cfg.max_x, cfg.max_y, cfg.max_z))
+    print(f"{len(waypoints)} wells ({rows} x {cols}, {args.model}) computed and checked in {(time.perf_counter() - started) * 1000:.1f} ms")
+    print(f"Largest residual at the measured wells: {residuals(calibration).max():.3f} mm")
+    for problem in problems:
+        print(f"  {problem}")
+    if args.output:
+        write_csv(waypoints, args.output)
+        print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
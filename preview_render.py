@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Preview frame rendering: crop, crosshair overlay and a Tk-ready encoding, reusing as much as possible between frames
+Benchmark: python preview_render.py --frames 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+class CrosshairOverlay:
+    # Crosshair pixels are worked out once per frame size and radius; each frame only gets them painted over
+    def __init__(self, length=20, color=(0, 255, 0), thickness=2):
+        self.length = length
+        self.color = np.array(color, dtype=np.uint8)
+        self.thickness = thickness
+        self.key = None
+        self.pixels = None      # (rows, cols) of every crosshair pixel
+
+    def pixels_for(self, height, width, radius):
+        if self.key != (height, width, radius):
+            self.key = (height, width, radius)
+            self.pixels = np.nonzero(self._mask(height, width, radius))
+        return self.pixels
+
+    def _mask(self, height, width, radius):
+        rows, cols = np.ogrid[:height, :width]
+        center_y, center_x = height // 2, width // 2
+        half = self.thickness / 2
+        distance = np.sqrt((rows - center_y) ** 2 + (cols - center_x) ** 2)
+        ring = np.abs(distance - radius) <= half
+        horizontal = (np.abs(rows - center_y) <= half) & (np.abs(cols - center_x) <= self.length)
+        vertical = (np.abs(cols - center_x) <= half) & (np.abs(rows - center_y) <= self.length)
+        return ring | horizontal | vertical
+
+    def apply(self, frame, radius):
+        # Paints in place, so frame should be a buffer that is overwritten by the next capture anyway
+        rows, cols = self.pixels_for(frame.shape[0], frame.shape[1], radius)
+        frame[rows, cols] = self.color
+        return frame
+
+def encode_ppm(frame):
+    # Binary PPM is just a header and the RGB bytes; Tk reads it without any decompression
+    height, width = frame.shape[:2]
+    return b"P6\n%d %d\n255\n" % (width, height) + frame.tobytes()
+
+def encode_png(frame, compress_level=1):
+    from PIL import Image
+    from io import BytesIO
+
+    with BytesIO() as output:
+        Image.fromarray(frame).save(output, format="PNG", compress_level=compress_level)
+        return output.getvalue()
+
+ENCODINGS = {"ppm": encode_ppm, "png": encode_png}
+
+class PreviewRenderer:
+    # Turns an RGB video-port frame into bytes for sg.Image: crop as a view, cached overlay, cheap encoding
+    def __init__(self, height=360, encoding="ppm", overlay=None):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown preview encoding '{encoding}', expected one of {', '.join(ENCODINGS)}")
+        self.height = height
+        self.encode = ENCODINGS[encoding]
+        self.overlay = overlay or CrosshairOverlay()
+
+    def render(self, frame, crosshair_on=True, radius=180):
+        if frame.shape[0] < self.height:
+            raise ValueError(f"Frame too short {frame.shape}")
+        frame = frame[:self.height]
+        if crosshair_on:
+            self.overlay.apply(frame, radius)
+        return self.encode(frame)
+
+# ===== Benchmark =====
+def _legacy_render(frame, radius):
+    # The per-frame path this module replaced: BGR crop copy, OpenCV drawing, cvtColor and a default PNG encode
+    import cv2
+    from PIL import Image
+    from io import BytesIO
+
+    frame = frame[:360, :, :].copy()
+    h, w = frame.shape[:2]
+    center_x, center_y = w // 2, h // 2
+    cv2.line(frame, (center_x - 20, center_y), (center_x + 20, center_y), (0, 255, 0), 2)
+    cv2.line(frame, (center_x, center_y - 20), (center_x, center_y + 20), (0, 255, 0), 2)
+    cv2.circle(frame, (center_x, center_y), radius, (0, 255, 0), 2)
+    img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    with BytesIO() as output:
+        Image.fromarray(img).save(output, format="PNG")
+        return output.getvalue()
+
+def bench(frames, width, height, radius):
+    # Times each render path on the same noisy frames, which compress about as badly as camera frames do
+    rng = np.random.default_rng(0)
+    source = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buffer = np.empty_like(source)
+    paths = {
+        "legacy (cv2 + PNG)": lambda frame: _legacy_render(frame, radius),
+        "overlay + png level 1": PreviewRenderer(encoding="png").render,
+        "overlay + ppm": PreviewRenderer(encoding="ppm").render,
+    }
+    results = {}
+    for name, render in paths.items():
+        try:
+            started = time.perf_counter()
+            for _ in range(frames):
+                buffer[...] = source    # Stands in for the capture overwriting the reused buffer
+                size = len(render(buffer))
+            results[name] = (time.perf_counter() - started) / frames
+        except ImportError as e:
+            print(f"{name}: skipped ({e})")
+            continue
+        print(f"{name}: {results[name] * 1000:.2f} ms/frame, {size / 1024:.0f} KiB")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark preview frame rendering")
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=384)
+    parser.add_argument("--radius", type=int, default=180)
+    args = parser.parse_args()
+    bench(args.frames, args.width, args.height, args.radius)
+
+if __name__ == "__main__":
+    main()
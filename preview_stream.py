@@ -0,0 +1,72 @@
+import threading
+
+class LatestFrame:
+    # Single-slot buffer: a new frame replaces the one before it, so a slow reader only ever sees the newest
+    def __init__(self, notify=None):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.sequence = 0
+        self.dropped = 0        # Frames replaced before anyone read them
+        self.notify = notify    # Called when a frame lands in an empty slot, so a lagging reader gets one wakeup, not one per frame
+
+    def put(self, frame):
+        with self.lock:
+            was_empty = self.frame is None
+            if not was_empty:
+                self.dropped += 1
+            self.frame = frame
+            self.sequence += 1
+        if was_empty and self.notify is not None:
+            self.notify()
+
+    def take(self, since=0):
+        # Never blocks; returns (sequence, frame), with frame None when nothing newer than since has arrived
+        with self.lock:
+            if self.sequence == since or self.frame is None:
+                return since, None
+            frame, self.frame = self.frame, None
+            return self.sequence, frame
+
+class PreviewStream:
+    # Captures from the video port on its own thread, so jogs and the GUI never wait for a frame
+    # The camera's framerate paces the loop, so set it to the preview rate first
+    def __init__(self, camera, output, process, latest=None, log=None, format="bgr"):
+        self.camera = camera
+        self.output = output            # PiRGBArray (or similar) reused for every frame
+        self.process = process          # Turns output.array into whatever the GUI shows
+        self.format = format            # "rgb" skips a channel swap when the GUI wants RGB
+        self.latest = latest if latest is not None else LatestFrame()
+        self.log = log
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.frame_count = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="PreviewStream", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=2):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=timeout)
+            self.thread = None
+
+    def _run(self):
+        frames = self.camera.capture_continuous(self.output, format=self.format, use_video_port=True)
+        try:
+            for _ in frames:
+                if self.stop_event.is_set():
+                    break
+                try:
+                    self.latest.put(self.process(self.output.array))
+                    self.frame_count += 1
+                except Exception as e:
+                    if self.log:
+                        self.log.warn(f"Preview frame skipped: {e}")
+                finally:
+                    self.output.seek(0)
+                    self.output.truncate(0)
+        finally:
+            frames.close()
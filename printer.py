@@ -1,76 +1,310 @@
+import re
 import serial
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime
 
 from config import config as cfg
 
 printer = None
-serial_lock = threading.Lock()
+serial_lock = threading.Lock()      # Held only while writing, so commands and their futures stay in order
+connect_lock = threading.Lock()     # Held while opening the port
+pending = deque()                   # Commands awaiting 'ok', oldest first
+send_window = None                  # Limits commands in flight to printer.stream_window
+reader_thread = None
+reader_stop = threading.Event()
+position_subscribers = []
+log_sink = print                    # Receives busy/echo/unsolicited lines from the printer
+travel_acceleration = None          # Last M204 T sent, so an unchanged acceleration is not sent again
+CODE_PATTERN = re.compile(r"\s*([GM]\d+)")
+WORD_PATTERN = re.compile(r"([XYZ])([-+]?\d*\.?\d+)")
+
+class PendingCommand:
+    def __init__(self, gcode_string, holds_window=True):
+        self.gcode = gcode_string
+        self.lines = []             # Response lines routed to this command before its 'ok'
+        self.future = Future()
+        self.holds_window = holds_window    # False for keepalive tickles sent while the window was full
+        self.position_seq = None            # Tracker sequence when sent, so an M114 report can tell if it is current
+
+# ===== Position Tracking =====
+class PositionTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.absolute = True
+        self.position = None        # Commanded position; None until reported by the printer
+        self.sequence = 0           # Counts commands that change the commanded position
+        self.reconciled_at = 0.0    # When the printer last confirmed the commanded position
+
+    def on_command(self, gcode_string):
+        # Follow G90/G91 and the moves sent, mirroring what Marlin's planner will be told
+        match = CODE_PATTERN.match(gcode_string.upper())
+        if match is None:
+            return
+        code, words = match.group(1), WORD_PATTERN.findall(gcode_string.upper()[match.end():])
+        with self.lock:
+            if code == "G90":
+                self.absolute = True
+            elif code == "G91":
+                self.absolute = False
+            elif code == "G28":
+                # Home position depends on the firmware's offsets, so it has to be read back
+                self.position = None
+                self.sequence += 1
+            elif code == "G92":
+                self.sequence += 1
+                if self.position is not None:
+                    for axis, value in words:
+                        self.position[axis] = float(value)
+            elif code in ("G0", "G1"):
+                self.sequence += 1
+                if self.position is None:
+                    return
+                limits = {"X": cfg.max_x, "Y": cfg.max_y, "Z": cfg.max_z}
+                for axis, value in words:
+                    value = float(value) if self.absolute else self.position[axis] + float(value)
+                    # Software endstops (M211) clamp moves to the bed
+                    self.position[axis] = min(max(value, 0.0), float(limits[axis]))
+
+    def on_report(self, position, sequence=None):
+        with self.lock:
+            if sequence is not None and sequence == self.sequence:
+                # M114 answered after every tracked command, so it is the commanded position
+                self.position = dict(position)
+                self.reconciled_at = time.monotonic()
+            elif self.position is not None and all(abs(self.position[axis] - position[axis]) < 0.01 for axis in position):
+                # Auto-reports show the live position; one matching the commanded position confirms it
+                self.reconciled_at = time.monotonic()
+
+    def get(self, max_age):
+        with self.lock:
+            if self.position is None or time.monotonic() - self.reconciled_at > max_age:
+                return None
+            return dict(self.position)
+
+tracker = PositionTracker()
 
 # Get printer serial without recreating serial connection
 def get_printer():
     global printer
-    if printer is None:
-        try:
-            printer = serial.Serial(cfg.device_path, baudrate=cfg.baudrate, timeout=cfg.timeout_time)
-            print("Establishing Connection")
-            time.sleep(2)
-
-            printer.write(b'M115\n')
-            while True:
-                line = printer.readline().decode(errors='ignore').strip()
-                if line.lower() == 'ok':
-                    break
-            print("Printer Connected")
-            return printer
-        except serial.SerialException as e:
-            print(f"Failed to Connect: {e}")
-            return None
-    else:
-        return printer
+    connected = False
+    # Startup connects in the background; a Home click meanwhile waits here rather than opening the port twice
+    with connect_lock:
+        if printer is None:
+            try:
+                started = time.monotonic()
+                ser = serial.Serial(cfg.device_path, baudrate=cfg.baudrate, timeout=cfg.handshake_interval)
+                print("Establishing Connection")
+                if not _handshake(ser, cfg.connect_timeout):
+                    ser.close()
+                    print(f"Failed to Connect: no response within {cfg.connect_timeout} s")
+                    return None
+                ser.timeout = cfg.timeout_time
+                printer = ser
+                _start_reader(printer)
+                print(f"Printer Connected in {time.monotonic() - started:.1f} s")
+                connected = True
+            except serial.SerialException as e:
+                print(f"Failed to Connect: {e}")
+                printer = None
+        ser = printer
+    # stream_gcode calls get_printer() itself, so M154 waits until connect_lock is free
+    if connected and cfg.position_auto_report:
+        stream_gcode(f"M154 S{int(cfg.position_auto_report)}")
+    return ser
+
+def _handshake(ser, timeout):
+    # Opening the port resets most boards, and the bootloader drops what arrives while it runs
+    # So M115 is resent every handshake_interval until Marlin answers, instead of waiting a fixed 2 s first
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        ser.write(b'M115\n')
+        while True:
+            line = ser.readline().decode(errors='ignore').strip()
+            if not line:
+                break               # Timed out, the request or its 'ok' was lost
+            if _is_ack(line):
+                # An earlier M115 may still be answered; drop that before the reader starts matching replies
+                ser.timeout = 0.1
+                drain_until = time.monotonic() + 0.5
+                while ser.readline() and time.monotonic() < drain_until:
+                    pass
+                return True
+    return False
 
 def close_printer():
     global printer
     if printer and printer.is_open:
+        reader_stop.set()
         printer.close()
+        if reader_thread is not None:
+            reader_thread.join(timeout=2)
+        _fail_pending(ConnectionError("Printer connection closed"))
         printer = None
         print("Printer Closed")
 
-def run_gcode(gcode_string):
-    # Grab printer as ser
+# ===== Reader Thread =====
+def _start_reader(ser):
+    global reader_thread, send_window, travel_acceleration
+    travel_acceleration = None
+    send_window = threading.BoundedSemaphore(max(1, int(cfg.stream_window)))
+    reader_stop.clear()
+    reader_thread = threading.Thread(target=_reader_loop, args=(ser,), name="PrinterReader", daemon=True)
+    reader_thread.start()
+
+def _reader_loop(ser):
+    last_line_time = time.monotonic()
+    while not reader_stop.is_set():
+        try:
+            raw = ser.readline()
+        except (serial.SerialException, OSError, TypeError) as e:
+            # Port was closed or unplugged; nothing will acknowledge the commands in flight
+            if not reader_stop.is_set():
+                log_sink(f"Printer read failed: {e}")
+            _fail_pending(ConnectionError(f"Printer read failed: {e}"))
+            return
+        line = raw.decode(errors='ignore').strip()
+        if line:
+            last_line_time = time.monotonic()
+            _dispatch(line)
+        elif pending and time.monotonic() - last_line_time > cfg.timeout_time:
+            # Marlin sends 'busy' keepalives while blocked, so silence means an 'ok' was probably lost
+            _tickle(ser)
+            last_line_time = time.monotonic()
+
+def _tickle(ser):
+    # M105's 'ok T:..' reply is recognisable, see _dispatch
+    log_sink(f"No response for {cfg.timeout_time}s, sending M105")
+    command = PendingCommand("M105", holds_window=send_window.acquire(blocking=False))
+    with serial_lock:
+        pending.append(command)
+        ser.write(b'M105\n')
+        ser.flush()
+
+def _dispatch(line):
+    if _is_ack(line):
+        if not pending:
+            log_sink(f"Unexpected response: {line}")
+            return
+        # M105 answers 'ok T:..'; Marlin runs commands in order, so everything queued before it is done even if an 'ok' was lost
+        if " T:" in line and any(command.gcode.startswith("M105") for command in list(pending)):
+            while not pending[0].gcode.startswith("M105"):
+                log_sink(f"Lost 'ok' for {pending[0].gcode}")
+                _complete(pending.popleft(), line)
+        _complete(pending.popleft(), line)
+    elif _is_position(line):
+        position = position_parser([line])
+        if pending and pending[0].gcode.startswith("M114"):
+            tracker.on_report(position, pending[0].position_seq)
+        else:
+            tracker.on_report(position)
+        for callback in list(position_subscribers):
+            try:
+                callback(position)
+            except Exception as e:
+                log_sink(f"Position subscriber failed: {e}")
+        # Solicited reports (M114) are also returned to the waiting command
+        if pending and pending[0].gcode.startswith("M114"):
+            pending[0].lines.append(line)
+    elif line.startswith("echo:busy") or line.startswith("busy:") or line.startswith("T:"):
+        # Keepalive and temperature auto-reports are never part of a command's response
+        log_sink(line)
+    else:
+        # Everything else (M503 echo dump, M115 capabilities, errors) belongs to the oldest command in flight
+        if pending:
+            pending[0].lines.append(line)
+        log_sink(line)
+
+def _complete(command, line):
+    if command.holds_window:
+        send_window.release()
+    command.lines.append(line)
+    command.future.set_result(command.lines)
+
+def _fail_pending(error):
+    while pending:
+        command = pending.popleft()
+        if not command.future.done():
+            command.future.set_exception(error)
+
+def _is_ack(line):
+    # Marlin acknowledges with a bare 'ok', or 'ok ...' when ADVANCED_OK is enabled
+    line = line.lower()
+    return line == 'ok' or line.startswith('ok ')
+
+def _is_position(line):
+    # M114 and M154 auto-report: "X:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0"
+    return line.startswith("X:") and " Y:" in line and " Z:" in line
+
+def set_log_sink(sink):
+    global log_sink
+    log_sink = sink if sink is not None else print
+
+def subscribe_position(callback): position_subscribers.append(callback)
+def unsubscribe_position(callback):
+    if callback in position_subscribers:
+        position_subscribers.remove(callback)
+
+# ===== Sending =====
+def stream_gcode(gcode_string):
+    # Send without waiting for 'ok' and return a Future resolving to the response lines
+    # At most stream_window commands are in flight so Marlin's command queue never overflows
     ser = get_printer()
+    if reader_thread is None or not reader_thread.is_alive():
+        raise ConnectionError("Printer is not connected")
 
+    command = PendingCommand(gcode_string)
+    send_window.acquire()
     with serial_lock:
-        # Send string to printer
+        tracker.on_command(gcode_string)
+        command.position_seq = tracker.sequence
+        pending.append(command)
         ser.write((gcode_string + '\n').encode())
         ser.flush()
-        # Wait until printer accepts command
-        lines = []
-        while True:
-            line = ser.readline().decode(errors='ignore').strip()
-            lines.append(line)
-            print(line)
-            if line.lower() == 'ok':
-                break
-    return lines
+    return command.future
+
+def flush_gcode():
+    # Wait until every streamed command has been acknowledged (not until motion has finished, see wait())
+    try:
+        last = pending[-1]
+    except IndexError:
+        return
+    last.future.result()
+
+def run_gcode(gcode_string):
+    # Acknowledgements arrive in order, so this returns once every earlier command is acknowledged too
+    return stream_gcode(gcode_string).result()
 
 def home(): run_gcode("G28")        # G-code to home; automatically waits until completion
-def abs_pos(): run_gcode("G90")     # G-code to convert to absolute positioning mode
-def rel_pos(): run_gcode("G91")     # G-code to convert to relative positioning mode
-def get_pos(): return position_parser(run_gcode("M114"))      # G-code to return current position
-def wait(): run_gcode("M400")       # G-code to wait until previous movement command completes
+def abs_pos(): stream_gcode("G90")  # G-code to convert to absolute positioning mode
+def rel_pos(): stream_gcode("G91")  # G-code to convert to relative positioning mode
+def get_pos(max_age=None):
+    # Commanded position, read back with M114 only when not confirmed by the printer within max_age seconds
+    position = tracker.get(cfg.position_max_age if max_age is None else max_age)
+    if position is None:
+        position = position_parser(run_gcode("M114"))
+    return position
+def wait(): run_gcode("M400")       # G-code to wait until previous movement command completes; also drains streamed commands
+def set_travel_acceleration(acceleration):
+    # G-code to set travel acceleration (mm/s^2), only when it changes
+    global travel_acceleration
+    if acceleration != travel_acceleration:
+        stream_gcode(f"M204 T{acceleration:.0f}")
+        travel_acceleration = acceleration
+
 def show_stats(): print(run_gcode("M211"), run_gcode("M203"), run_gcode("M503"))
 
 def position_parser(lines):
     X = 0
     Y = 1
     Z = 2
-    position = lines[0].strip().split()
+    line = next((line for line in lines if _is_position(line.strip())), lines[0])
+    position = line.strip().split()
     position_dict = {
         "X": float(position[X].split(":")[1]),
         "Y": float(position[Y].split(":")[1]),
         "Z": float(position[Z].split(":")[1]),
     }
     return position_dict
-
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+
+JOURNAL_NAME = "run_journal.jsonl"
+
+def journal_path(directory):
+    return os.path.join(directory, JOURNAL_NAME)
+
+def shot_key(plate, well, level):
+    # What makes an image unique within a run, whatever order the wells were visited in
+    return (plate, int(well), int(level))
+
+class RunJournal:
+    # Append-only JSON lines next to the images: a header with the run's settings, then one line per image on disk
+    # Lines are fsynced in batches, so a crash loses at most sync_every images or sync_interval seconds of progress
+    def __init__(self, directory, sync_every=16, sync_interval=2.0):
+        self.path = journal_path(directory)
+        self.sync_every = max(1, int(sync_every))
+        self.sync_interval = float(sync_interval)
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a", encoding="utf-8")
+        if self._ends_mid_line():
+            # A crash cut the last line short; start on a fresh line so the next entry stays readable
+            self.file.write("\n")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.timer = None
+
+    def _ends_mid_line(self):
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def start(self, settings, resumed=False, run_id=None):
+        # A new run header starts over; a resume header keeps the images recorded before it
+        entry = {"type": "resume" if resumed else "run", "time": time.time(), "run_id": run_id}
+        if not resumed:
+            entry["settings"] = settings
+        self._append(entry, sync=True)
+
+    def record(self, plate, well, level, frame, path, z=None):
+        # Called from the image writer once the file is on disk; z is where autofocus put the image
+        entry = {"type": "image", "plate": plate, "well": int(well), "level": int(level),
+                 "frame": frame, "file": os.path.basename(path)}
+        if z is not None:
+            entry["z"] = z
+        self._append(entry)
+
+    def finish(self):
+        self._append({"type": "complete", "time": time.time()}, sync=True)
+
+    def _append(self, entry, sync=False):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.unsynced += 1
+            if sync or self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+            elif self.timer is None:
+                # The last lines of a batch are synced within sync_interval too, even when no other image follows
+                self.timer = threading.Timer(self.sync_interval, self._sync_late)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _sync_late(self):
+        with self.lock:
+            self.timer = None
+            if self.unsynced and not self.file.closed:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.file.closed:
+                self._sync()
+                self.file.close()
+
+class JournalState:
+    # What the last run in a journal was started with and which images it got onto disk
+    def __init__(self):
+        self.settings = None
+        self.run_id = None
+        self.images = {}            # shot_key -> set of frames written
+        self.files = {}             # shot_key -> {frame: file name}
+        self.complete = False
+
+    def completed_shots(self, frames_per_shot=1):
+        return {key for key, frames in self.images.items() if len(frames) >= frames_per_shot}
+
+def load_journal(directory):
+    # None when there is no journal; a line cut short by a crash is skipped
+    path = journal_path(directory)
+    if not os.path.exists(path):
+        return None
+    state = JournalState()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            kind = entry.get("type")
+            if kind == "run":
+                state = JournalState()
+                state.settings = entry.get("settings")
+                state.run_id = entry.get("run_id")
+            elif kind == "resume":
+                state.complete = False
+            elif kind == "image":
+                key = shot_key(entry["plate"], entry["well"], entry["level"])
+                state.images.setdefault(key, set()).add(entry["frame"])
+                state.files.setdefault(key, {})[entry["frame"]] = entry["file"]
+            elif kind == "complete":
+                state.complete = True
+    return state
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Time-lapse and multi-plate run scheduler
+Usage: python scheduler.py schedule.yaml [--check]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import yaml
+
+import capture_engine as ce
+import motion_estimator as me
+
+MODES = ("timetable", "back_to_back")
+
+class ScheduledRun:
+    # One run definition: what to capture, where to, and how often
+    def __init__(self, name, settings, interval=0.0, repeat=1, start=None):
+        self.name = name
+        self.settings = settings        # RunSettings
+        self.interval = float(interval) # Minutes between starts
+        self.repeat = max(1, int(repeat))
+        self.start = start              # Epoch seconds of the first start; None for as soon as possible
+
+class Occurrence:
+    # One actual capture of a ScheduledRun
+    def __init__(self, run, index, start, settings, duration):
+        self.run = run
+        self.index = index
+        self.start = start              # Planned start (epoch seconds)
+        self.settings = settings
+        self.duration = duration        # Estimated run time (s)
+
+    @property
+    def name(self):
+        return f"{self.run.name} #{self.index + 1}" if self.run.repeat > 1 else self.run.name
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+def occurrence_settings(run, index):
+    # Repeats each get their own folder, so every one has its own journal and can be resumed on its own
+    if run.repeat == 1:
+        return run.settings
+    data = run.settings.to_dict()
+    data["output_dir"] = os.path.join(run.settings.output_dir, f"{run.name}_{index + 1:03d}")
+    return ce.RunSettings.from_dict(data)
+
+class RunScheduler:
+    def __init__(self, runs, mode, log):
+        if mode not in MODES:
+            raise ValueError(f"Unknown schedule mode '{mode}', expected one of {', '.join(MODES)}")
+        self.runs = runs
+        self.mode = mode
+        self.log = log
+
+    def plan(self, start_position=(0.0, 0.0, 0.0), now=None):
+        # Every occurrence with its planned start and estimated duration, in the order they will run
+        # back_to_back: the queue in order, each run's repeats one after another; timetable: by start time
+        now = time.time() if now is None else now
+        occurrences = []
+        clock = now
+        for run in self.runs:
+            duration = ce.estimate_run(run.settings, start_position).total
+            first = now if run.start is None else run.start
+            for index in range(run.repeat):
+                if self.mode == "back_to_back":
+                    start = clock
+                    clock += duration
+                else:
+                    start = first + index * run.interval * 60
+                occurrences.append(Occurrence(run, index, start, occurrence_settings(run, index), duration))
+        if self.mode == "timetable":
+            occurrences.sort(key=lambda occurrence: occurrence.start)
+        return occurrences
+
+    @staticmethod
+    def overlaps(occurrences):
+        # One gantry, so a run still going (by its estimate) when another is due is a clash
+        clashes = []
+        latest = None
+        for occurrence in occurrences:
+            if latest is not None and latest.end > occurrence.start:
+                clashes.append((latest, occurrence))
+            if latest is None or occurrence.end > latest.end:
+                latest = occurrence
+        return clashes
+
+    def run(self, session, stop_event, occurrences=None, on_result=None, progress=ce.no_progress):
+        # Camera session and printer connection stay open between runs, so each run starts warm
+        occurrences = self.plan() if occurrences is None else occurrences
+        results = []
+        for occurrence in occurrences:
+            if self.mode == "timetable":
+                wait = occurrence.start - time.time()
+                if wait > 0:
+                    self.log.say(f"Next run {occurrence.name} at {format_time(occurrence.start)}")
+                    if stop_event.wait(wait):
+                        break
+                elif wait < -1:
+                    self.log.warn(f"{occurrence.name} starting {me.format_duration(-wait)} late")
+            if stop_event.is_set():
+                break
+            self.log.say(f"===== Scheduled run {occurrence.name} =====")
+            progress("scheduled_run", name=occurrence.name, planned_start=round(occurrence.start, 1))
+            try:
+                result = ce.run_capture(occurrence.settings, session, self.log, stop_event, progress=progress)
+            except Exception as e:
+                # A missing CSV, a full or unplugged disk or a lost printer fails this run, not the rest of the schedule
+                self.log.error(f"Scheduled run {occurrence.name} failed: {e}")
+                progress("scheduled_run_failed", name=occurrence.name, error=str(e))
+                result = ce.RunResult()
+                result.errors.append((occurrence.settings.output_dir, e))
+            results.append((occurrence, result))
+            if on_result is not None:
+                on_result(occurrence, result)
+            if result.stopped:
+                break
+        return results
+
+def format_time(epoch):
+    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S")
+
+def parse_time(value):
+    # Accepts "YYYY-MM-DD HH:MM[:SS]" or "HH:MM" for today
+    if value is None:
+        return None
+    value = str(value)
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    clock = datetime.strptime(value, "%H:%M")
+    return datetime.now().replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0).timestamp()
+
+def load_schedule(path):
+    # YAML with a mode and a list of runs; each run's settings are RunSettings fields, unset ones from config.yaml
+    with open(path, 'r') as file:
+        schedule = yaml.safe_load(file)
+    runs = []
+    for i, entry in enumerate(schedule.get('runs', []), start=1):
+        settings = ce.RunSettings(input_csv=entry.get('input_csv'), output_dir=entry.get('output_dir'),
+                                  **entry.get('settings', {}))
+        runs.append(ScheduledRun(entry.get('name', f"run{i}"), settings, entry.get('interval', 0),
+                                 entry.get('repeat', 1), parse_time(entry.get('start'))))
+    return schedule.get('mode', "timetable"), runs
+
+def report(occurrences, overlaps):
+    lines = [f"{len(occurrences)} scheduled runs"]
+    for occurrence in occurrences:
+        lines.append(f"  {format_time(occurrence.start)}  {occurrence.name:<24}{me.format_duration(occurrence.duration):>10}  -> {occurrence.settings.output_dir}")
+    for a, b in overlaps:
+        lines.append(f"  Overlap: {a.name} is estimated to run {me.format_duration(a.end - b.start)} into {b.name}")
+    return lines
+
+def main():
+    from config import config as cfg
+    from logger import Logger
+    from camera_session import CameraSession
+    from startup import StartupTimer, HardwareStartup
+    import printer
+
+    parser = argparse.ArgumentParser(description="Run a queue of captures back to back or on a timetable")
+    parser.add_argument("schedule", help="Schedule YAML file")
+    parser.add_argument("--check", action="store_true", help="Only print the plan and any overlaps")
+    args = parser.parse_args()
+
+    log = Logger(verbose=cfg.verbose_mode)
+    mode, runs = load_schedule(args.schedule)
+    scheduler = RunScheduler(runs, mode, log)
+    occurrences = scheduler.plan()
+    overlaps = scheduler.overlaps(occurrences)
+    for line in report(occurrences, overlaps):
+        print(line)
+    if args.check:
+        return
+
+    session = CameraSession(log=log)
+    stop_event = threading.Event()
+    # Opening the port resets most boards, so the printer is homed before any run drives Z to CSV heights
+    startup = HardwareStartup(session, log, StartupTimer(), home=True).start()
+    startup.wait()
+    if not startup.printer_ready.is_set():
+        session.close()
+        printer.close_printer()
+        return 2
+    results = []
+    try:
+        results = scheduler.run(session, stop_event, occurrences)
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        session.close()
+        printer.close_printer()
+    return 1 if any(result.errors for _, result in results) or len(results) < len(occurrences) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
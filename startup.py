@@ -0,0 +1,116 @@
+import importlib
+import threading
+import time
+
+from config import config as cfg
+
+class StartupTimer:
+    # Seconds since launch at each startup step; the report is logged so a step that got slower shows up
+    def __init__(self, launched=None):
+        self.launched = time.monotonic() if launched is None else launched
+        self.marks = []
+        self.lock = threading.Lock()
+
+    def mark(self, step):
+        elapsed = time.monotonic() - self.launched
+        with self.lock:
+            self.marks.append((step, elapsed))
+        return elapsed
+
+    def report(self):
+        with self.lock:
+            marks = sorted(self.marks, key=lambda mark: mark[1])
+        return [f"{elapsed:6.2f} s  {step}" for step, elapsed in marks]
+
+def no_status(step, state):
+    pass
+
+class HardwareStartup:
+    # Printer connect and home, camera warm-up and slow imports each run on their own thread, side by side
+    # status(step, state) is called from those threads as they go, e.g. ("printer", "homing"), then ("startup", "done")
+    def __init__(self, session, log, timer, status=no_status, home=True, preload=()):
+        self.session = session
+        self.log = log
+        self.timer = timer
+        self.status = status
+        self.home = home
+        self.preload = preload          # Module names imported in the background, so the first click does not wait on them
+        self.printer_ready = threading.Event()
+        self.camera_ready = threading.Event()
+        self.errors = {}                # Step -> why it failed
+        self.threads = []
+        self.remaining = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        steps = [("printer", self._printer), ("camera", self._camera), ("imports", self._imports)]
+        self.remaining = len(steps)
+        for step, target in steps:
+            thread = threading.Thread(target=self._run, args=(target,), name=f"Startup-{step}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        # True once every step has finished, whether or not it worked
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def _run(self, target):
+        try:
+            target()
+        finally:
+            with self.lock:
+                self.remaining -= 1
+                last = self.remaining == 0
+            if last:
+                self.timer.mark("startup finished")
+                self.status("startup", "done")
+
+    def _failed(self, step, reason):
+        self.errors[step] = str(reason)
+        self.log.error(f"Startup: {step} failed: {reason}")
+        self.status(step, "failed")
+
+    def _printer(self):
+        import printer
+
+        self.status("printer", "connecting")
+        if printer.get_printer() is None:
+            self._failed("printer", f"no printer on {cfg.device_path}")
+            return
+        self.timer.mark("printer connected")
+        if self.home:
+            self.status("printer", "homing")
+            try:
+                printer.home()
+            except ConnectionError as e:
+                self._failed("printer", e)
+                return
+            self.timer.mark("printer homed")
+        self.printer_ready.set()
+        self.status("printer", "ready")
+
+    def _camera(self):
+        from camera_session import preview_settings
+
+        self.status("camera", "warming up")
+        try:
+            # Holds the camera like any worker, so a preview started meanwhile waits for the warm-up instead of racing it
+            with self.session.use("warmup", preview_settings()):
+                pass
+        except Exception as e:
+            # No picamera, camera disabled or not connected: the GUI still works for moves and previews of paths
+            self._failed("camera", e)
+            return
+        self.timer.mark("camera warm")
+        self.camera_ready.set()
+        self.status("camera", "ready")
+
+    def _imports(self):
+        for name in self.preload:
+            importlib.import_module(name)
+        if self.preload:
+            self.timer.mark("modules loaded")
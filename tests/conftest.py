@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import config as cfg
+
+# config.yaml is read from the working directory on import; the tests use the repo's own whatever pytest ran from
+cfg.load(os.path.join(ROOT, "config.yaml"))
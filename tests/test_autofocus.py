@@ -0,0 +1,50 @@
+import pytest
+
+import autofocus as af
+
+def peaked_at(best, width=0.2):
+    # A smooth focus curve, highest at best
+    samples = []
+    def measure(z):
+        samples.append(z)
+        return 1.0 / (1.0 + ((z - best) / width) ** 2)
+    measure.samples = samples
+    return measure
+
+@pytest.mark.parametrize("search", [af.hill_climb, af.golden_section])
+def test_peak_inside_the_range_is_found_and_bracketed(search):
+    result = search(peaked_at(10.12), 10.0, 0.05, 8)
+    assert result.bracketed
+    assert result.z == pytest.approx(10.12, abs=0.03)
+
+@pytest.mark.parametrize("search", [af.hill_climb, af.golden_section])
+@pytest.mark.parametrize("best", [10.0 + 2.0, 10.0 - 2.0])
+def test_peak_beyond_either_end_stops_at_the_edge_unbracketed(search, best):
+    measure = peaked_at(best)
+    result = search(measure, 10.0, 0.05, 8)
+    assert not result.bracketed
+    edge = 10.4 if best > 10.0 else 9.6
+    assert result.z == pytest.approx(edge, abs=0.05)
+    # Never moves outside z0 +/- max_steps * step
+    assert all(9.6 - 1e-9 <= z <= 10.4 + 1e-9 for z in measure.samples)
+
+@pytest.mark.parametrize("best", [10.4, 9.6])
+def test_hill_climb_peak_on_the_last_step_is_not_bracketed(best):
+    # No frame beyond the last step, so the peak might lie further out
+    result = af.hill_climb(peaked_at(best), 10.0, 0.05, 8)
+    assert not result.bracketed
+    assert result.z == pytest.approx(best)
+
+def test_hill_climb_peak_one_step_inside_the_edge_is_bracketed():
+    result = af.hill_climb(peaked_at(10.35), 10.0, 0.05, 8)
+    assert result.bracketed
+    assert result.z == pytest.approx(10.35, abs=0.01)
+
+def test_hill_climb_stops_once_past_the_peak():
+    measure = peaked_at(10.1)
+    af.hill_climb(measure, 10.0, 0.05, 20)
+    assert len(measure.samples) <= 5
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        af.search("sideways", peaked_at(0.0), 0.0, 0.05, 4)
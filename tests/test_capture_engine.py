@@ -0,0 +1,67 @@
+import csv
+import os
+import threading
+
+import pytest
+
+import capture_engine as ce
+import printer
+from config import config as cfg
+from virtual_printer import VirtualPrinter
+
+class FakeCamera:
+    # Just what capture_plate uses of a PiCamera; every image is a few bytes
+    shutter_speed = 10000
+    exposure_speed = 10000
+    framerate = 30
+
+    def capture(self, output, **kwargs):
+        output.write(b"jpeg")
+
+    def capture_sequence(self, outputs, **kwargs):
+        for output in outputs:
+            output.write(b"jpeg")
+
+class QuietLog:
+    verbose = False
+
+    def __getattr__(self, name):
+        return lambda message: None
+
+@pytest.fixture
+def virtual_printer(monkeypatch):
+    with VirtualPrinter(time_scale=0.01, busy_interval=0) as vp:
+        monkeypatch.setattr(cfg, "device_path", vp.device_path)
+        printer.set_log_sink(lambda line: None)
+        printer.get_printer()
+        yield vp
+        printer.close_printer()
+
+def write_csv(path, wells):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["well", "X", "Y", "Z"])
+        for well in range(1, wells + 1):
+            writer.writerow([well, 50 + 9 * well, 50, 40])
+
+def run_in_thread(settings, timeout=30):
+    # A deadlocked capture would hang the test run; a daemon thread lets it fail instead
+    outcome = {}
+    def run():
+        outcome["result"] = ce.capture_plate(FakeCamera(), settings, QuietLog(), threading.Event())
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "capture_plate did not finish"
+    return outcome["result"]
+
+def test_burst_larger_than_the_write_buffer_pool(tmp_path, monkeypatch, virtual_printer):
+    monkeypatch.setattr(cfg, "write_buffers", 2)
+    write_csv(str(tmp_path / "plate.csv"), 3)
+    settings = ce.RunSettings(input_csv=str(tmp_path / "plate.csv"), output_dir=str(tmp_path / "out"), frames_per_shot=5,
+                              zstack_plus_minus=0, focus_stack=False, output_format="files", autofocus="off",
+                              focal_surface=None)
+    result = run_in_thread(settings)
+    assert not result.errors
+    assert result.images == 15
+    assert len([name for name in os.listdir(str(tmp_path / "out")) if name.endswith(".jpg")]) == 15
@@ -0,0 +1,89 @@
+import os
+import tarfile
+import time
+from io import BytesIO
+
+import image_container as ic
+
+def image(number, size=3000):
+    return bytes([number % 256]) * size
+
+def write_shards(directory, count, shard_size=1 << 30, sync_every=16):
+    writer = ic.ShardWriter(str(directory), shard_size=shard_size, sync_every=sync_every)
+    members = [writer.append(f"well{n}.jpg", BytesIO(image(n)), len(image(n))) for n in range(count)]
+    writer.close()
+    return members
+
+def test_images_read_back_by_offset(tmp_path):
+    members = write_shards(tmp_path, 5)
+    reader = ic.ContainerReader(str(tmp_path))
+    assert reader.names() == sorted(member.name for member in members)
+    for n, member in enumerate(members):
+        assert reader.read(member.name) == image(n)
+        assert ic.read_source(reader.locate(member.name)) == image(n)
+
+def test_shards_are_plain_tar(tmp_path):
+    write_shards(tmp_path, 3)
+    with tarfile.open(os.path.join(str(tmp_path), ic.shard_name(0))) as tar:
+        assert [info.name for info in tar] == ["well0.jpg", "well1.jpg", "well2.jpg"]
+        assert tar.extractfile("well1.jpg").read() == image(1)
+
+def test_full_shard_rolls_over_to_the_next(tmp_path):
+    members = write_shards(tmp_path, 6, shard_size=8000)
+    assert len({member.shard for member in members}) > 1
+    assert ic.shard_numbers(str(tmp_path)) == list(range(len({member.shard for member in members})))
+
+def test_index_drops_images_past_the_end_of_a_truncated_shard(tmp_path):
+    members = write_shards(tmp_path, 4)
+    shard = os.path.join(str(tmp_path), members[-1].shard)
+    # A crash after the index line was written but before the last image's data reached the disk
+    with open(shard, "rb+") as f:
+        f.truncate(members[-1].offset + 100)
+    index = ic.load_index(str(tmp_path))
+    assert sorted(index) == ["well0.jpg", "well1.jpg", "well2.jpg"]
+    reader = ic.ContainerReader(str(tmp_path))
+    assert all(reader.read(f"well{n}.jpg") == image(n) for n in range(3))
+
+def test_index_skips_a_line_cut_short(tmp_path):
+    write_shards(tmp_path, 3)
+    path = ic.index_path(str(tmp_path))
+    with open(path, "rb+") as f:
+        f.truncate(os.path.getsize(path) - 5)
+    assert sorted(ic.load_index(str(tmp_path))) == ["well0.jpg", "well1.jpg"]
+
+def test_reindex_recovers_what_survived_in_the_shards(tmp_path):
+    members = write_shards(tmp_path, 4)
+    with open(os.path.join(str(tmp_path), members[-1].shard), "rb+") as f:
+        f.truncate(members[-1].offset + 100)
+    os.remove(ic.index_path(str(tmp_path)))
+    index = ic.reindex(str(tmp_path))
+    assert sorted(index) == ["well0.jpg", "well1.jpg", "well2.jpg"]
+    assert index["well1.jpg"] == members[1]
+
+def test_resumed_writer_starts_a_new_shard_and_keeps_names_unique(tmp_path):
+    first = write_shards(tmp_path, 2)
+    second = write_shards(tmp_path, 1)
+    assert second[0].shard != first[0].shard
+    assert second[0].name == "well0_1.jpg"
+    reader = ic.ContainerReader(str(tmp_path))
+    assert reader.read("well0.jpg") == reader.read("well0_1.jpg") == image(0)
+
+def test_extract_writes_ordinary_files(tmp_path):
+    write_shards(tmp_path / "run", 3)
+    count = ic.ContainerReader(str(tmp_path / "run")).extract(str(tmp_path / "out"))
+    assert count == 3
+    with open(str(tmp_path / "out" / "well2.jpg"), "rb") as f:
+        assert f.read() == image(2)
+
+def test_last_images_are_synced_without_another_image(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(ic.os, "fsync", lambda fd: (synced.append(fd), fsync(fd)))
+    writer = ic.ShardWriter(str(tmp_path), sync_every=100, sync_interval=0.05)
+    writer.append("well0.jpg", BytesIO(image(0)), len(image(0)))
+    deadline = time.monotonic() + 2
+    while len(synced) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Shard, then index
+    assert len(synced) == 2
+    writer.close()
@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+import image_index as ii
+
+@pytest.mark.parametrize("folder", ["run 1", "run?1", "run#1", "run%201"])
+def test_query_folders_with_uri_characters(tmp_path, folder):
+    directory = str(tmp_path / folder)
+    os.makedirs(directory)
+    index = ii.ImageIndex(directory)
+    index.add(run_id="run1", plate="03", well=1, level=0, file="well01.jpg")
+    index.add(run_id="run1", plate="A", well=2, level=0, file="well02.jpg")
+    index.close()
+    assert not index.errors
+    rows = ii.query(directory, plate="03")
+    assert [(row["plate"], row["well"]) for row in rows] == [("03", 1)]
+    assert ii.location(rows[0]) == os.path.join(directory, "well01.jpg")
+
+def test_query_without_an_index_is_empty(tmp_path):
+    assert ii.query(str(tmp_path)) == []
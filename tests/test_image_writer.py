@@ -0,0 +1,49 @@
+import hashlib
+import os
+
+from image_writer import ImageWriter
+
+def test_every_buffer_returns_to_the_pool(tmp_path):
+    writer = ImageWriter(buffer_count=2)
+    for n in range(10):
+        buffer = writer.acquire()
+        buffer.write(b"image %d" % n)
+        writer.submit(buffer, str(tmp_path / f"{n}.jpg"))
+    writer.close()
+    assert writer.written == 10
+    assert writer.free_buffers.qsize() == 2
+    with open(str(tmp_path / "7.jpg"), "rb") as f:
+        assert f.read() == b"image 7"
+
+def test_checksum_and_size_reach_on_written(tmp_path):
+    written = []
+    writer = ImageWriter(checksum="sha256")
+    buffer = writer.acquire()
+    buffer.write(b"jpeg data")
+    writer.submit(buffer, str(tmp_path / "a.jpg"), lambda path, size, checksum: written.append((path, size, checksum)))
+    writer.close()
+    assert written == [(str(tmp_path / "a.jpg"), 9, hashlib.sha256(b"jpeg data").hexdigest())]
+
+def test_failing_write_keeps_the_writer_going(tmp_path):
+    blocker = tmp_path / "not_a_folder"
+    blocker.write_bytes(b"")
+    writer = ImageWriter(buffer_count=1)
+    for path in (blocker / "a.jpg", tmp_path / "b.jpg"):
+        buffer = writer.acquire()
+        buffer.write(b"jpeg")
+        writer.submit(buffer, str(path))
+    writer.close()
+    assert len(writer.errors) == 1
+    assert os.path.exists(str(tmp_path / "b.jpg"))
+
+def test_failing_on_written_keeps_the_writer_going(tmp_path):
+    def on_written(path, size, checksum):
+        raise RuntimeError("journal closed")
+    writer = ImageWriter(buffer_count=1)
+    for name in ("a.jpg", "b.jpg"):
+        buffer = writer.acquire()
+        buffer.write(b"jpeg")
+        writer.submit(buffer, str(tmp_path / name), on_written)
+    writer.close()
+    assert writer.written == 2
+    assert [type(e) for _, e in writer.errors] == [RuntimeError, RuntimeError]
@@ -0,0 +1,15 @@
+import pytest
+
+import motion_profiles as mprof
+
+def test_configured_profile_is_used():
+    name = mprof.profile_names()[-1]
+    assert mprof.get_profile(name).name == name
+
+def test_legacy_is_always_available(monkeypatch):
+    monkeypatch.setattr(mprof.cfg, "motion_profiles", {"fast": {"hop_feedrate": 6000}})
+    assert mprof.get_profile("legacy").hop_feedrate == 800
+
+def test_unknown_profile_names_the_valid_ones():
+    with pytest.raises(ValueError, match="balanced"):
+        mprof.get_profile("balanced_typo")
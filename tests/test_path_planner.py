@@ -0,0 +1,37 @@
+import numpy as np
+
+import path_planner as pp
+from io_helper import Waypoint
+
+FEEDRATE = 100.0
+MAX_FEEDRATE = (500, 500, 5)
+
+def travel(waypoints, start):
+    return pp.estimate_path_time(waypoints, start, FEEDRATE, MAX_FEEDRATE)
+
+def test_two_opt_undoes_a_crossing():
+    # Visiting the corners of a square diagonally crosses the path over itself
+    points = np.array([(0, 0, 0), (0, 0, 0), (10, 10, 0), (10, 0, 0), (0, 10, 0)], dtype=float)
+    costs = pp.travel_time_matrix(points, FEEDRATE, MAX_FEEDRATE)
+    order = pp._two_opt(np.array([1, 2, 3, 4]), costs, 10)
+    assert pp.path_time(order, costs) < pp.path_time(np.array([1, 2, 3, 4]), costs)
+    assert sorted(order) == [1, 2, 3, 4]
+
+def test_plan_is_a_permutation_no_slower_than_the_csv_order():
+    rng = np.random.default_rng(3)
+    waypoints = [Waypoint(n, float(x), float(y), 40.0) for n, (x, y) in enumerate(rng.uniform(0, 200, (40, 2)), start=1)]
+    start = (0.0, 0.0, 40.0)
+    planned = pp.plan_path(waypoints, start, FEEDRATE, MAX_FEEDRATE)
+    assert sorted(w.well for w in planned) == list(range(1, 41))
+    assert travel(planned, start) <= travel(waypoints, start)
+
+def test_serpentine_plate_is_left_as_good_as_it_was():
+    waypoints = [Waypoint(r * 6 + c + 1, float(c if r % 2 == 0 else 5 - c) * 9, float(r) * 9, 40.0)
+                 for r in range(4) for c in range(6)]
+    start = (0.0, 0.0, 40.0)
+    planned = pp.plan_path(waypoints, start, FEEDRATE, MAX_FEEDRATE)
+    assert travel(planned, start) <= travel(waypoints, start) + 1e-9
+
+def test_short_lists_are_returned_as_given():
+    waypoints = [Waypoint(1, 10.0, 0.0, 0.0), Waypoint(2, 0.0, 0.0, 0.0)]
+    assert pp.plan_path(waypoints, (0.0, 0.0, 0.0), FEEDRATE, MAX_FEEDRATE) == waypoints
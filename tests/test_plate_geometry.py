@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import plate_geometry as pg
+
+CORNERS = ((10.0, 20.0, 40.0), (109.0, 20.0, 40.2), (10.0, 83.0, 40.1), (109.0, 83.0, 40.3))
+
+@pytest.mark.parametrize("model", pg.MODELS)
+def test_corners_land_on_the_measured_wells(model):
+    calibration = pg.corner_calibration(8, 12, *CORNERS, model=model)
+    centers = pg.well_centers(calibration)
+    assert centers[0] == pytest.approx(CORNERS[0], abs=1e-6)
+    assert centers[95] == pytest.approx(CORNERS[3], abs=0.05)
+    assert pg.validate([(None, calibration)]) == []
+
+@pytest.mark.parametrize("model", pg.MODELS)
+def test_single_row_is_a_line_between_its_ends(model):
+    start, end = (10.0, 20.0, 40.0), (109.0, 20.0, 40.2)
+    calibration = pg.corner_calibration(1, 12, start, end, start, end, model=model)
+    centers = pg.well_centers(calibration)
+    assert centers[0] == pytest.approx(start)
+    assert centers[11] == pytest.approx(end)
+    assert np.allclose(np.diff(centers[:, 0]), 9.0)
+    assert pg.validate([(None, calibration)], (220, 220, 250)) == []
+
+@pytest.mark.parametrize("model", pg.MODELS)
+def test_single_column_and_single_well(model):
+    top, bottom = (10.0, 20.0, 40.0), (10.0, 83.0, 40.1)
+    column = pg.well_centers(pg.corner_calibration(8, 1, top, top, bottom, bottom, model=model))
+    assert column[7] == pytest.approx(bottom)
+    assert np.allclose(np.diff(column[:, 1]), 9.0)
+    well = pg.well_centers(pg.corner_calibration(1, 1, top, top, top, top, model=model))
+    assert well[0] == pytest.approx(top)
+
+def test_degenerate_projective_corners_raise_value_error():
+    collinear = ((10.0, 20.0, 40.0), (50.0, 20.0, 40.0), (30.0, 20.0, 40.0), (70.0, 20.0, 40.0))
+    with pytest.raises(ValueError):
+        pg.well_centers(pg.corner_calibration(8, 12, *collinear, model="projective"))
+
+def test_unknown_model_raises_value_error():
+    with pytest.raises(ValueError):
+        pg.well_centers(pg.corner_calibration(1, 12, *CORNERS, model="cylindrical"))
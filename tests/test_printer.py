@@ -0,0 +1,28 @@
+import threading
+
+import printer
+from config import config as cfg
+from virtual_printer import VirtualPrinter
+
+def connect_in_thread(timeout=10):
+    # A deadlocked connect would hang the test run; a daemon thread lets it fail instead
+    outcome = {}
+    thread = threading.Thread(target=lambda: outcome.update(ser=printer.get_printer()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "get_printer did not return"
+    return outcome["ser"]
+
+def test_connect_with_position_auto_report(monkeypatch):
+    monkeypatch.setattr(cfg, "position_auto_report", 1)
+    with VirtualPrinter(time_scale=0.01, busy_interval=0) as vp:
+        monkeypatch.setattr(cfg, "device_path", vp.device_path)
+        printer.set_log_sink(lambda line: None)
+        try:
+            assert connect_in_thread() is not None
+            printer.flush_gcode()
+            assert vp.auto_report_interval == 1
+            # Later calls reuse the connection without sending M154 again
+            assert printer.get_printer() is printer.printer
+        finally:
+            printer.close_printer()
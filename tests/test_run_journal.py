@@ -0,0 +1,88 @@
+import os
+import time
+
+import capture_engine as ce
+import capture_plan as cp
+import run_journal as rj
+from io_helper import Waypoint
+
+def write_run(directory, images, settings=None):
+    journal = rj.RunJournal(str(directory))
+    journal.start(settings or {"frames": 1}, run_id="run1")
+    for plate, well, level, frame in images:
+        journal.record(plate, well, level, frame, os.path.join(str(directory), f"well{well}_{level}_{frame}.jpg"))
+    journal.close()
+
+def test_load_journal_skips_a_line_cut_short(tmp_path):
+    write_run(tmp_path, [(None, 1, 0, None), (None, 2, 0, None)])
+    path = rj.journal_path(str(tmp_path))
+    with open(path, "rb+") as f:
+        f.truncate(os.path.getsize(path) - 10)
+    state = rj.load_journal(str(tmp_path))
+    assert state.run_id == "run1"
+    assert state.completed_shots() == {(None, 1, 0)}
+
+def test_journal_reopened_after_a_crash_starts_a_fresh_line(tmp_path):
+    write_run(tmp_path, [(None, 1, 0, None), (None, 2, 0, None)])
+    path = rj.journal_path(str(tmp_path))
+    with open(path, "rb+") as f:
+        f.truncate(os.path.getsize(path) - 10)
+    journal = rj.RunJournal(str(tmp_path))
+    journal.start(None, resumed=True, run_id="run1")
+    journal.record(None, 2, 0, None, "well2_0.jpg")
+    journal.close()
+    state = rj.load_journal(str(tmp_path))
+    assert state.completed_shots() == {(None, 1, 0), (None, 2, 0)}
+    assert state.settings == {"frames": 1}
+    assert not state.complete
+
+def test_new_run_header_forgets_earlier_images(tmp_path):
+    write_run(tmp_path, [(None, 1, 0, None)])
+    write_run(tmp_path, [(None, 3, 0, None)], settings={"frames": 2})
+    state = rj.load_journal(str(tmp_path))
+    assert state.completed_shots() == {(None, 3, 0)}
+    assert state.settings == {"frames": 2}
+
+def test_burst_shot_counts_only_with_every_frame(tmp_path):
+    write_run(tmp_path, [("A", 1, 0, 0), ("A", 1, 0, 1), ("A", 2, 0, 0)])
+    state = rj.load_journal(str(tmp_path))
+    assert state.completed_shots(frames_per_shot=2) == {("A", 1, 0)}
+
+def test_missing_journal_is_none(tmp_path):
+    assert rj.load_journal(str(tmp_path)) is None
+
+def shots_for(wells, levels):
+    return [cp.Shot(i, Waypoint(well, 0.0, 0.0, 0.0), level) for i, (well, level) in enumerate((w, l) for w in wells for l in levels)]
+
+def test_remaining_shots_skips_journaled_levels(tmp_path):
+    write_run(tmp_path, [(None, 1, -1, None), (None, 1, 0, None), (None, 2, -1, None)])
+    state = rj.load_journal(str(tmp_path))
+    remaining = ce.remaining_shots(shots_for([1, 2], [-1, 0]), state, 1)
+    assert [(shot.waypoint.well, shot.level) for shot in remaining] == [(2, 0)]
+
+def test_remaining_shots_autofocused_well_needs_every_kept_level(tmp_path):
+    # Autofocus plans one shot per well; it is done only once all its kept levels are on disk
+    write_run(tmp_path, [(None, 1, -1, None), (None, 1, 0, None), (None, 1, 1, None), (None, 2, -1, None), (None, 2, 0, None)])
+    state = rj.load_journal(str(tmp_path))
+    remaining = ce.remaining_shots(shots_for([1, 2, 3], [0]), state, 1, levels=[-1, 0, 1])
+    assert [shot.waypoint.well for shot in remaining] == [2, 3]
+
+def test_remaining_shots_retakes_images_lost_from_the_shards(tmp_path):
+    write_run(tmp_path, [(None, 1, 0, None), (None, 2, 0, None)])
+    state = rj.load_journal(str(tmp_path))
+    remaining = ce.remaining_shots(shots_for([1, 2], [0]), state, 1, stored={"well1_0_None.jpg"})
+    assert [shot.waypoint.well for shot in remaining] == [2]
+
+def test_last_lines_are_synced_without_another_image(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(rj.os, "fsync", lambda fd: (synced.append(fd), fsync(fd)))
+    journal = rj.RunJournal(str(tmp_path), sync_every=100, sync_interval=0.05)
+    journal.start({}, run_id="run1")
+    synced.clear()
+    journal.record(None, 1, 0, None, "well1.jpg")
+    deadline = time.monotonic() + 2
+    while not synced and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert synced
+    journal.close()
@@ -0,0 +1,41 @@
+import threading
+
+import capture_engine as ce
+import scheduler as sc
+
+class Log:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+    def __getattr__(self, name):
+        return lambda message: None
+
+def occurrences(count):
+    run = sc.ScheduledRun("plate", ce.RunSettings(input_csv="plate.csv", output_dir="out"), repeat=count)
+    return [sc.Occurrence(run, index, 0.0, sc.occurrence_settings(run, index), 1.0) for index in range(count)]
+
+def test_failed_run_does_not_end_the_schedule(monkeypatch):
+    started = []
+    def run_capture(settings, session, log, stop_event, progress=ce.no_progress):
+        started.append(settings.output_dir)
+        if len(started) == 2:
+            raise OSError("No space left on device")
+        return ce.RunResult()
+    monkeypatch.setattr(ce, "run_capture", run_capture)
+    log = Log()
+    results = sc.RunScheduler([], "back_to_back", log).run(None, threading.Event(), occurrences(3))
+    assert len(started) == 3
+    assert [bool(result.errors) for _, result in results] == [False, True, False]
+    assert "No space left on device" in log.errors[0]
+
+def test_stop_ends_the_schedule_after_a_failed_run(monkeypatch):
+    stop_event = threading.Event()
+    def run_capture(settings, session, log, stop_event_, progress=ce.no_progress):
+        stop_event.set()
+        raise ConnectionError("Printer is not connected")
+    monkeypatch.setattr(ce, "run_capture", run_capture)
+    results = sc.RunScheduler([], "back_to_back", Log()).run(None, stop_event, occurrences(3))
+    assert len(results) == 1
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Virtual Marlin printer on a pseudo-terminal, used in place of the Ender 3 for testing and benchmarking
+Usage:
+    python virtual_printer.py --link /tmp/ttyFLYCAM      (then set printer.device_path to /tmp/ttyFLYCAM)
+    python virtual_printer.py bench --wells 48 --window 1 4
+"""
+import argparse
+import math
+import os
+import pty
+import random
+import re
+import threading
+import time
+import tty
+from collections import deque
+
+from motion_estimator import trapezoid_time
+
+AXES = ("X", "Y", "Z")
+STEPS_PER_MM = {"X": 80.0, "Y": 80.0, "Z": 400.0}      # Ender 3 stock M92 values
+CODE_PATTERN = re.compile(r"([GM]\d+)")
+WORD_PATTERN = re.compile(r"([A-Z])([-+]?\d*\.?\d+)")
+
+class VirtualPrinter:
+    def __init__(self,
+                 latency=0.002,              # Per-command processing time (s)
+                 link_latency=0.004,         # Host-to-printer transfer delay per line, e.g. the USB-serial adapter (s)
+                 buffer_size=4,              # Marlin BUFSIZE: commands that can wait in the serial command queue
+                 planner_size=16,            # Marlin BLOCK_BUFFER_SIZE: moves that can be planned ahead
+                 max_feedrate=(500, 500, 5), # M203 limits (mm/s)
+                 max_acceleration=(500, 500, 100),   # M201 limits (mm/s^2)
+                 travel_acceleration=500,    # M204 T (mm/s^2)
+                 max_position=(220, 220, 250),
+                 homing_time=1.0,            # Simulated G28 duration (s)
+                 drop_ok_rate=0.0,           # Probability that an 'ok' is never sent
+                 busy_rate=0.0,              # Probability of an unsolicited 'echo:busy: processing' after a command
+                 busy_interval=2.0,          # Marlin HOST_KEEPALIVE interval while blocked (s); 0 disables
+                 time_scale=1.0,             # Multiplies motion and homing durations; <1 runs faster than real time
+                 seed=None):
+        self.latency = latency
+        self.link_latency = link_latency
+        self.buffer_size = buffer_size
+        self.planner_size = planner_size
+        self.max_feedrate = dict(zip(AXES, max_feedrate))
+        self.max_acceleration = dict(zip(AXES, max_acceleration))
+        self.travel_acceleration = travel_acceleration
+        self.max_position = dict(zip(AXES, max_position))
+        self.homing_time = homing_time
+        self.drop_ok_rate = drop_ok_rate
+        self.busy_rate = busy_rate
+        self.busy_interval = busy_interval
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+
+        # Machine state
+        self.absolute = True
+        self.feedrate = 50.0                # mm/s; Marlin starts at F3000
+        self.planned = {axis: 0.0 for axis in AXES}     # Position after the last planned move, what M114 reports
+        self.current = {axis: 0.0 for axis in AXES}     # Position of the executed moves
+        self.auto_report_interval = 0
+
+        # Statistics
+        self.commands_received = 0
+        self.oks_dropped = 0
+        self.overflows = 0
+        self.busy_time = 0.0
+
+        self._commands = deque()
+        self._planner = deque()
+        self._lock = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self.master_fd = None
+        self.slave_fd = None
+        self.device_path = None
+        self.link_path = None
+
+    # ===== Lifecycle =====
+    def start(self, link_path=None):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.device_path = os.ttyname(self.slave_fd)
+        if link_path:
+            if os.path.islink(link_path):
+                os.remove(link_path)
+            os.symlink(self.device_path, link_path)
+            self.link_path = link_path
+
+        for target, name in ((self._read_loop, "VirtualPrinterRX"),
+                             (self._command_loop, "VirtualPrinterCommands"),
+                             (self._motion_loop, "VirtualPrinterMotion"),
+                             (self._report_loop, "VirtualPrinterReports")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        self._send("start")
+        self._send("echo:Marlin 2.0.9.3 (virtual)")
+        return self.link_path or self.device_path
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._lock.notify_all()
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except (OSError, TypeError):
+                pass
+        if self.link_path and os.path.islink(self.link_path):
+            os.remove(self.link_path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ===== Serial I/O =====
+    def _send(self, line):
+        with self._write_lock:
+            try:
+                os.write(self.master_fd, (line + "\n").encode())
+            except OSError:
+                pass
+
+    def _ok(self, line="ok"):
+        if self.drop_ok_rate and self.random.random() < self.drop_ok_rate:
+            self.oks_dropped += 1
+            return
+        self._send(line)
+
+    def _read_loop(self):
+        buffer = b""
+        while not self._stop.is_set():
+            try:
+                data = os.read(self.master_fd, 1024)
+            except OSError:
+                return
+            buffer += data
+            while b"\n" in buffer:
+                raw, buffer = buffer.split(b"\n", 1)
+                line = raw.decode(errors="ignore").split(";")[0].strip()
+                if not line:
+                    continue
+                with self._lock:
+                    if len(self._commands) >= self.buffer_size:
+                        # Marlin would drop characters once its receive buffer is full
+                        self.overflows += 1
+                        self._send(f"Error:Command queue overflow, dropped: {line}")
+                        continue
+                    self._commands.append((time.monotonic() + self.link_latency, line))
+                    self._lock.notify_all()
+
+    def _sleep(self, seconds):
+        self._stop.wait(seconds * self.time_scale)
+
+    def _wait_until(self, predicate):
+        # Block the command queue like Marlin does, sending keepalives while waiting
+        started = time.monotonic()
+        last_busy = started
+        with self._lock:
+            while not predicate() and not self._stop.is_set():
+                self._lock.wait(0.01)
+                now = time.monotonic()
+                if self.busy_interval and now - last_busy >= self.busy_interval:
+                    self._send("echo:busy: processing")
+                    last_busy = now
+        self.busy_time += time.monotonic() - started
+
+    # ===== Command Processing =====
+    def _command_loop(self):
+        while not self._stop.is_set():
+            with self._lock:
+                while not self._commands and not self._stop.is_set():
+                    self._lock.wait(0.1)
+                if self._stop.is_set():
+                    return
+                ready_at, line = self._commands[0]
+            # Lines sent back to back arrive back to back; only an idle link pays the full transfer delay
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            if self.latency:
+                self._stop.wait(self.latency)
+            self.commands_received += 1
+            ack = self._process(line)
+            # Marlin's receive buffer holds the next line while this slot is freed, so free it before acknowledging
+            with self._lock:
+                self._commands.popleft()
+                self._lock.notify_all()
+            self._ok(ack)
+            if self.busy_rate and self.random.random() < self.busy_rate:
+                self._send("echo:busy: processing")
+
+    def _process(self, line):
+        # Commands may be written without spaces, like io_helper's "G0X1.0Y2.0Z3.0"
+        match = CODE_PATTERN.match(line.upper())
+        code = match.group(1) if match else line.split()[0].upper()
+        words = {letter: float(value) for letter, value in WORD_PATTERN.findall(line.upper()[len(code):])}
+
+        if code in ("G0", "G1"):
+            self._plan_move(words)
+        elif code == "G28":
+            self._wait_until(lambda: not self._planner)
+            self._sleep(self.homing_time)
+            for axis in AXES:
+                self.planned[axis] = self.current[axis] = 0.0
+            self._send("X:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0")
+        elif code == "G90":
+            self.absolute = True
+        elif code == "G91":
+            self.absolute = False
+        elif code == "M400":
+            self._wait_until(lambda: not self._planner)
+        elif code == "M114":
+            self._send(self._position_report())
+        elif code == "M115":
+            self._send("FIRMWARE_NAME:Marlin 2.0.9.3 (virtual) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin "
+                       "PROTOCOL_VERSION:1.0 MACHINE_TYPE:Ender-3 EXTRUDER_COUNT:1 UUID:00000000-0000-0000-0000-000000000000")
+            self._send("Cap:AUTOREPORT_POS:1")
+            self._send("Cap:EMERGENCY_PARSER:0")
+        elif code == "M154":
+            self.auto_report_interval = words.get("S", 0)
+        elif code == "M201":
+            for axis in AXES:
+                if axis in words:
+                    self.max_acceleration[axis] = words[axis]
+        elif code == "M203":
+            for axis in AXES:
+                if axis in words:
+                    self.max_feedrate[axis] = words[axis]
+        elif code == "M204":
+            if "T" in words:
+                self.travel_acceleration = words["T"]
+        elif code == "M503":
+            for setting in self._settings_report():
+                self._send(setting)
+        elif code == "M105":
+            return "ok T:25.00 /0.00 B:25.00 /0.00 @:0 B@:0"
+        elif code in ("M211", "M155", "M110", "M84", "M18"):
+            pass
+        else:
+            self._send(f'echo:Unknown command: "{line}"')
+        return "ok"
+
+    def _plan_move(self, words):
+        if "F" in words:
+            self.feedrate = words["F"] / 60
+        target = dict(self.planned)
+        for axis in AXES:
+            if axis in words:
+                value = words[axis] if self.absolute else target[axis] + words[axis]
+                # Software endstops clamp the move like M211 S1
+                target[axis] = min(max(value, 0.0), float(self.max_position[axis]))
+
+        deltas = {axis: target[axis] - self.planned[axis] for axis in AXES}
+        distance = math.sqrt(sum(d * d for d in deltas.values()))
+        feedrate = self.feedrate
+        acceleration = self.travel_acceleration
+        for axis, delta in deltas.items():
+            if delta:
+                share = abs(delta) / distance
+                feedrate = min(feedrate, self.max_feedrate[axis] / share)
+                acceleration = min(acceleration, self.max_acceleration[axis] / share)
+        duration = trapezoid_time(distance, feedrate, acceleration)
+
+        # A full planner blocks the command queue, which in turn withholds the 'ok'
+        self._wait_until(lambda: len(self._planner) < self.planner_size)
+        with self._lock:
+            self._planner.append((target, duration))
+            self._lock.notify_all()
+        self.planned = target
+
+    def _motion_loop(self):
+        while not self._stop.is_set():
+            with self._lock:
+                while not self._planner and not self._stop.is_set():
+                    self._lock.wait(0.1)
+                if self._stop.is_set():
+                    return
+                target, duration = self._planner[0]
+            self._sleep(duration)
+            with self._lock:
+                self.current = dict(target)
+                self._planner.popleft()
+                self._lock.notify_all()
+
+    def _report_loop(self):
+        while not self._stop.is_set():
+            interval = self.auto_report_interval
+            if interval:
+                self._send(self._position_report(self.current))
+                self._sleep(interval)
+            else:
+                self._stop.wait(0.1)
+
+    def _position_report(self, position=None):
+        position = position or self.planned
+        counts = " ".join(f"{axis}:{round(self.current[axis] * STEPS_PER_MM[axis])}" for axis in AXES)
+        return f"X:{position['X']:.2f} Y:{position['Y']:.2f} Z:{position['Z']:.2f} E:0.00 Count {counts}"
+
+    def _settings_report(self):
+        feed = self.max_feedrate
+        accel = self.max_acceleration
+        return [
+            "echo:; Steps per unit:",
+            f"echo: M92 X{STEPS_PER_MM['X']:.2f} Y{STEPS_PER_MM['Y']:.2f} Z{STEPS_PER_MM['Z']:.2f} E93.00",
+            "echo:; Maximum feedrates (units/s):",
+            f"echo: M203 X{feed['X']:.2f} Y{feed['Y']:.2f} Z{feed['Z']:.2f} E25.00",
+            "echo:; Maximum Acceleration (units/s2):",
+            f"echo: M201 X{accel['X']:.2f} Y{accel['Y']:.2f} Z{accel['Z']:.2f} E5000.00",
+            "echo:; Acceleration (units/s2): P<print_accel> R<retract_accel> T<travel_accel>",
+            f"echo: M204 P500.00 R500.00 T{self.travel_acceleration:.2f}",
+        ]
+
+    def stats(self):
+        return {
+            "commands": self.commands_received,
+            "oks_dropped": self.oks_dropped,
+            "overflows": self.overflows,
+            "busy_time": round(self.busy_time, 3),
+        }
+
+# ===== Benchmark =====
+def bench(wells, windows, latency, link_latency, time_scale, row_length=8):
+    # Times a plate's worth of moves through printer.py for each send window
+    # Each row is streamed and synced once at its end, so a larger window can keep Marlin's queue full between syncs;
+    # syncing after every move would leave one command in flight whatever the window
+    from config import config as cfg
+    import printer
+
+    results = {}
+    for window in windows:
+        with VirtualPrinter(latency=latency, link_latency=link_latency, time_scale=time_scale, busy_interval=0) as vp:
+            cfg.device_path = vp.device_path
+            cfg.stream_window = window
+            printer.get_printer()
+            started = time.perf_counter()
+            printer.abs_pos()
+            for well in range(wells):
+                printer.stream_gcode(f"G0X{10 + (well % row_length) * 13}Y{10 + (well // row_length) * 13}Z40 F800")
+                if (well + 1) % row_length == 0 or well == wells - 1:
+                    printer.wait()
+            printer.get_pos()
+            results[window] = time.perf_counter() - started
+            printer.close_printer()
+    print(f"{wells} wells, synced every {row_length}, motion time x{time_scale}")
+    print("  ".join(f"{f'window={window}':>16}" for window in windows))
+    print("  ".join(f"{results[window]:>8.3f} s total" for window in windows))
+    print("  ".join(f"{results[window] / wells * 1000:>8.1f} ms/well" for window in windows))
+    if len(windows) > 1:
+        print(f"window={windows[-1]} takes {results[windows[-1]] / results[windows[0]]:.2f}x the time of window={windows[0]}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Virtual Marlin printer on a pseudo-terminal")
+    parser.add_argument("mode", nargs="?", choices=["serve", "bench"], default="serve")
+    parser.add_argument("--link", default="/tmp/ttyFLYCAM", help="Symlink pointing at the pty, use as printer.device_path")
+    parser.add_argument("--latency", type=float, default=0.002, help="Per-command processing time (s)")
+    parser.add_argument("--link-latency", type=float, default=0.004, help="Host-to-printer transfer delay per line (s)")
+    parser.add_argument("--buffer-size", type=int, default=4, help="Serial command queue depth (BUFSIZE)")
+    parser.add_argument("--planner-size", type=int, default=16, help="Planner depth (BLOCK_BUFFER_SIZE)")
+    parser.add_argument("--drop-ok-rate", type=float, default=0.0, help="Probability of never sending an 'ok'")
+    parser.add_argument("--busy-rate", type=float, default=0.0, help="Probability of an unsolicited busy line per command")
+    parser.add_argument("--time-scale", type=float, default=None,
+                        help="Scale motion and homing durations (<1 is faster); default 1, or 0.001 for bench")
+    parser.add_argument("--wells", type=int, default=48, help="bench: number of wells")
+    parser.add_argument("--window", type=int, nargs="+", default=[1, 4], help="bench: stream windows to compare")
+    parser.add_argument("--row", type=int, default=8, help="bench: moves streamed between syncs")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.mode == "bench":
+        # Full-length moves hide the link behind motion whatever the window, so the bench scales motion right down
+        bench(args.wells, args.window, args.latency, args.link_latency, 0.001 if args.time_scale is None else args.time_scale, args.row)
+        return
+
+    vp = VirtualPrinter(latency=args.latency, link_latency=args.link_latency, buffer_size=args.buffer_size, planner_size=args.planner_size,
+                        drop_ok_rate=args.drop_ok_rate, busy_rate=args.busy_rate,
+                        time_scale=1.0 if args.time_scale is None else args.time_scale,
+                        seed=args.seed)
+    path = vp.start(link_path=args.link)
+    print(f"Virtual printer listening on {path} ({vp.device_path})")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        vp.stop()
+        print(f"Virtual printer stopped: {vp.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,235 @@
-import numpy as np
+import argparse
 import csv
+import json
+import os
+
+import numpy as np
+
+import plate_geometry as pg
+
+def _bilinear_grid_calculation(num_rows, num_cols, tl, tr, bl, br, model="bilinear"):
+    # Cycle is the serpentine visiting order, well the row-major plate position
+    waypoints = pg.plate_waypoints(pg.corner_calibration(num_rows, num_cols, tl, tr, bl, br, model))
+    return [(int(w["cycle"]), int(w["well"]), float(w["x"]), float(w["y"]), float(w["z"])) for w in waypoints]
+
+def generate_csv(num_rows, num_cols, tl, tr, bl, br, filename, model="bilinear", limits=None):
+    # Returns what plate_geometry.validate found wrong with the layout; the CSV is written either way
+    calibration = pg.corner_calibration(num_rows, num_cols, tl, tr, bl, br, model)
+    pg.write_csv(pg.plate_waypoints(calibration), filename)
+    return pg.validate([(None, calibration)], limits)
+
+# ===== Focal surface =====
+# Z of best focus across the bed, fitted to focus points measured anywhere on the plate (not only the corners)
+# z = sum of c * x^i * y^j for i + j <= degree; degree 1 is a tilted plane, 2 also takes up a sagging or warped plate
+
+def _terms(degree):
+    return [(i, total - i) for total in range(degree + 1) for i in range(total, -1, -1)]
+
+def microns_text(value):
+    return f"{value * 1000:.0f} um" if np.isfinite(value) else "unknown"
+
+def _design(x, y, degree):
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    return np.stack([x ** i * y ** j for i, j in _terms(degree)], axis=-1)
+
+class FocalSurface:
+    def __init__(self, degree, coefficients, center, scale, points):
+        self.degree = int(degree)
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.center = np.asarray(center, dtype=float)     # XY are centred and scaled before the powers are taken
+        self.scale = float(scale)
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)    # Measured (x, y, z) the fit came from
+
+    def predict(self, x, y):
+        return _design((np.asarray(x) - self.center[0]) / self.scale, (np.asarray(y) - self.center[1]) / self.scale,
+                       self.degree) @ self.coefficients
+
+    def covers(self, x, y):
+        # Whether (x, y) is inside the bounding box of the focus points, where the fit is interpolating
+        low, high = self.points[:, :2].min(axis=0), self.points[:, :2].max(axis=0)
+        return bool(low[0] - 1e-6 <= x <= high[0] + 1e-6 and low[1] - 1e-6 <= y <= high[1] + 1e-6)
+
+    def clamp(self, x, y):
+        # Nearest point of that bounding box; a polynomial runs away quickly outside the points it was fitted to
+        low, high = self.points[:, :2].min(axis=0), self.points[:, :2].max(axis=0)
+        return float(np.clip(x, low[0], high[0])), float(np.clip(y, low[1], high[1]))
+
+    def residuals(self):
+        # Measured minus predicted Z at each focus point (mm)
+        return self.points[:, 2] - self.predict(self.points[:, 0], self.points[:, 1])
+
+    def prediction_errors(self):
+        # Leave-one-out residuals: how far off each point would be had it not been measured; a fair guess for unmeasured wells
+        basis = _design((self.points[:, 0] - self.center[0]) / self.scale, (self.points[:, 1] - self.center[1]) / self.scale, self.degree)
+        leverage = np.einsum("ij,ji->i", basis, np.linalg.pinv(basis))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(leverage < 1 - 1e-9, self.residuals() / (1 - leverage), np.nan)
+
+    @property
+    def rms(self):
+        return float(np.sqrt(np.mean(self.residuals() ** 2)))
+
+    @property
+    def prediction_rms(self):
+        # NaN when there are no spare points to check the fit with
+        errors = self.prediction_errors()
+        return float(np.sqrt(np.mean(errors ** 2))) if np.all(np.isfinite(errors)) else float("nan")
+
+    def stack_levels(self, step_distance, coverage=2.0):
+        # Z-stack levels either side of the predicted Z that cover coverage x the expected prediction error;
+        # None when every point went into the fit, so there is nothing to tell how far off it is
+        error = self.prediction_rms
+        if not np.isfinite(error):
+            return None
+        return int(np.ceil(coverage * error / float(step_distance) - 1e-9))
+
+    def stack_advice(self, step_distance):
+        levels = self.stack_levels(step_distance)
+        return f"+/- {levels} levels" if levels is not None else "unknown, add a focus point or two to check the fit"
+
+    def report(self):
+        lines = [f"Focal surface: degree {self.degree} from {len(self.points)} points, "
+                 f"RMS {microns_text(self.rms)}, prediction RMS {microns_text(self.prediction_rms)}"]
+        for (x, y, z), residual in zip(self.points, self.residuals()):
+            lines.append(f"  X {x:8.3f}  Y {y:8.3f}  Z {z:7.3f}  residual {residual * 1000:+6.0f} um")
+        if not np.isfinite(self.prediction_rms):
+            lines.append("  Every point is needed for the fit itself, so its accuracy is unknown; add a point or two")
+        return lines
+
+    def to_dict(self):
+        return {"degree": self.degree, "coefficients": self.coefficients.tolist(), "center": self.center.tolist(),
+                "scale": self.scale, "points": self.points.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["degree"], data["coefficients"], data["center"], data["scale"], data["points"])
+
+def fit_focal_surface(points, degree=1):
+    # points: (x, y, z) focus positions; needs at least as many as the degree has terms (3 for a plane, 6 for degree 2)
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    terms = len(_terms(degree))
+    center = points[:, :2].mean(axis=0)
+    scale = max(float(np.abs(points[:, :2] - center).max()), 1e-9)
+    basis = _design((points[:, 0] - center[0]) / scale, (points[:, 1] - center[1]) / scale, degree)
+    if len(points) < terms or np.linalg.matrix_rank(basis) < terms:
+        raise ValueError(f"A degree {degree} focal surface needs at least {terms} focus points, not all in a line")
+    coefficients = np.linalg.lstsq(basis, points[:, 2], rcond=None)[0]
+    return FocalSurface(degree, coefficients, center, scale, points)
+
+def choose_focal_surface(points, max_degree=2):
+    # Lowest prediction error over the degrees the points can support; a plane unless the extra terms really help
+    best = None
+    for degree in range(1, max_degree + 1):
+        try:
+            surface = fit_focal_surface(points, degree)
+        except ValueError:
+            break
+        error = surface.prediction_rms
+        if best is None or (np.isfinite(error) and (error < best.prediction_rms or not np.isfinite(best.prediction_rms))):
+            best = surface
+    if best is None:
+        raise ValueError("A focal surface needs at least 3 focus points, not all in a line")
+    return best
+
+def apply_focal_surfaces(waypoints, surfaces, log=None):
+    # Waypoints with Z from their plate's surface; surfaces maps plate label (None for the run's named surface) to a FocalSurface
+    # A labelled plate without a surface of its own only takes the named one if it sits inside the area that surface was
+    # measured over; elsewhere on the bed it keeps the Z it had, rather than another plate's fit extrapolated
+    # Wells outside their surface's focus points are given the Z at the nearest edge of those points
+    from io_helper import Waypoint
+
+    plates = {}
+    for w in waypoints:
+        plates.setdefault(w.plate, []).append(w)
+    chosen = {}
+    for plate, wells in plates.items():
+        surface = surfaces.get(plate)
+        if surface is None and plate is not None and surfaces.get(None) is not None:
+            if surfaces[None].covers(np.mean([w.x for w in wells]), np.mean([w.y for w in wells])):
+                surface = surfaces[None]
+            elif log:
+                log.warn(f"Plate {plate} is outside the focus points of the focal surface and has none of its own; "
+                         f"keeping its CSV Z")
+        chosen[plate] = surface
+
+    result = []
+    clamped = {}
+    for w in waypoints:
+        surface = chosen[w.plate]
+        if surface is None:
+            result.append(w)
+            continue
+        x, y = surface.clamp(w.x, w.y)
+        if not surface.covers(w.x, w.y):
+            clamped[w.plate] = clamped.get(w.plate, 0) + 1
+        result.append(Waypoint(w.well, w.x, w.y, round(float(surface.predict(x, y)), 3), w.plate))
+    for plate, count in clamped.items():
+        if log:
+            log.warn(f"{count} wells{'' if plate is None else f' of plate {plate}'} are outside the focus points; "
+                     f"their Z is the focal surface's at the nearest edge of the points")
+    return result
+
+def run_focal_surfaces(name, path):
+    # Surfaces for a run using the saved surface name; in a multi-plate CSV, wells of a plate that has a surface
+    # saved under its own label use that one instead (see apply_focal_surfaces for plates that have none)
+    saved = load_focal_surfaces(path)
+    if name not in saved:
+        raise KeyError(f"No focal surface named '{name}' in {path}")
+    return {**saved, None: saved[name]}
 
-def _bilinear_grid_calculation(num_rows, num_cols, tl, tr, bl, br):
-    positions = []
+# ----- Saved calibrations -----
+# One JSON file holds every plate's surface by name, so a plate measured once can be reused in later runs
 
-    tl = np.array(tl)
-    tr = np.array(tr)
-    bl = np.array(bl)
-    br = np.array(br)
+def load_focal_surfaces(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {name: FocalSurface.from_dict(data) for name, data in json.load(f).items()}
 
-    well_id = 1
+def load_focal_surface(name, path):
+    surfaces = load_focal_surfaces(path)
+    if name not in surfaces:
+        raise KeyError(f"No focal surface named '{name}' in {path}")
+    return surfaces[name]
 
-    for r in range(num_rows):
-        v = r / (num_rows - 1)
+def save_focal_surface(name, surface, path):
+    surfaces = load_focal_surfaces(path)
+    surfaces[name] = surface
+    data = {key: value.to_dict() for key, value in surfaces.items()}
+    # Written next to the old file and swapped in, so a crash never leaves half a calibration file
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary, path)
 
-        col_range = range(num_cols)
-        if r % 2 == 1:
-            col_range = reversed(col_range)
-        
-        for c in col_range:
-            u = c / (num_cols - 1)
+def load_focus_points(filename):
+    # CSV with X, Y, Z columns, e.g. positions saved while focusing by hand
+    with open(filename, newline='') as f:
+        return [(float(row['X']), float(row['Y']), float(row['Z'])) for row in csv.DictReader(f)]
 
-            top = (1 - u) * tl + u * tr
-            bottom = (1 - u) * bl + u * br
-            pos = (1 - v) * top + v * bottom
+def main():
+    from config import config as cfg
 
-            x, y, z = np.round(pos, 3)
-            positions.append((well_id, x, y, z))
-            well_id += 1
-    
-    return positions
+    parser = argparse.ArgumentParser(description="Fit and store a plate's focal surface from measured focus points")
+    parser.add_argument("points", nargs="?", help="CSV of focus points (X, Y, Z)")
+    parser.add_argument("--name", default="default", help="Name the surface is saved under, e.g. the plate label")
+    parser.add_argument("--degree", type=int, default=None, help="1 for a plane, 2 or 3 for a curved plate; default picks the best")
+    parser.add_argument("--file", default=cfg.focal_surfaces, help="Calibration file")
+    parser.add_argument("--list", action="store_true", help="Show the saved surfaces")
+    args = parser.parse_args()
 
-def generate_csv(num_rows, num_cols, tl, tr, bl, br, filename):
-    positions = _bilinear_grid_calculation(num_rows, num_cols, tl, tr, bl, br)
+    if args.list or not args.points:
+        for name, surface in load_focal_surfaces(args.file).items():
+            print(f"{name}: degree {surface.degree}, {len(surface.points)} points, prediction RMS {microns_text(surface.prediction_rms)}")
+        return
+    points = load_focus_points(args.points)
+    surface = fit_focal_surface(points, args.degree) if args.degree else choose_focal_surface(points)
+    for line in surface.report():
+        print(line)
+    print(f"Suggested z-stack: {surface.stack_advice(cfg.zstack_step_distance)} "
+          f"(currently +/- {cfg.zstack_plus_minus_count} levels of {cfg.zstack_step_distance} mm)")
+    save_focal_surface(args.name, surface, args.file)
+    print(f"Saved as '{args.name}' in {args.file}")
 
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['cycle', 'X', 'Y', 'Z'])
-        writer.writerows(positions)
+if __name__ == "__main__":
+    main()